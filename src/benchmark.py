@@ -0,0 +1,297 @@
+import argparse
+import json
+import multiprocessing
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from os import getenv
+from typing import Iterator
+from dotenv import load_dotenv
+import numpy as np
+import pandas as pd
+from bulk_loader import bulk_upsert
+from db import get_db_connection
+from fact_encoding import FactEncoder
+from geocoder import GeocoderBackend, GeocodingEngine
+from hierarcy_location_handler import add_coordinates, fill_missing_coordinates, process_geographic_hierarchy
+from instrumentation import RunReport
+
+load_dotenv()
+
+# Benchmark of the pipeline stages on synthetic data shaped like ISTAT's: a dim_cl_itter107 code tree (macro-areas,
+# regions, provinces, communes with the 3-digit province prefix and the capital named like its province) and a
+# facts_turismo-like table, at three scales. Every scale runs in a fresh process, so its peak RSS doesn't include the
+# previous ones; geocoding goes to a deterministic stub and the loads to a local Postgres or to a SQLite stand-in.
+# Results are appended to a JSON lines file and compared with the last run of the same scale, stage and backend
+
+RESULTS_PATH = getenv('benchmark_results', os.path.join('csv', 'benchmarks', 'results.jsonl'))
+TOLERANCE = 0.2     # Slower throughput or higher memory than this fraction is reported as a regression
+MIN_SECONDS = 0.5   # Stages faster than this are too noisy to compare their throughput
+FACT_CHUNK_PROVINCES = 10   # Provinces per generated fact chunk, so the big scale is never in memory at once
+
+# Regions per macro-area, provinces per region, communes per province and years of monthly + annual data
+SCALES = {
+    'liguria': {'regions': {'ITC': 1}, 'provinces': 4, 'communes': 59, 'years': 2},
+    'italia': {'regions': {'ITC': 4, 'ITH': 5, 'ITI': 4, 'ITF': 6, 'ITG': 2}, 'provinces': 5, 'communes': 75, 'years': 3},
+    'italia_x10': {'regions': {'ITC': 4, 'ITH': 5, 'ITI': 4, 'ITF': 6, 'ITG': 2}, 'provinces': 5, 'communes': 750,
+                   'years': 10},
+}
+DATA_TYPES = ['NI', 'AR']
+ACCOMMODATIONS = ['ALL', 'HOTELLIERI']
+REGION_DIGITS = '1234567890ABCDEFGHIJ'
+
+
+def generate_itter107(scale: str) -> pd.DataFrame:
+    """id, nome of an ITTER107-like code tree, in the shuffled order of a SELECT without ORDER BY"""
+    spec = SCALES[scale]
+    rows = [('IT', 'Italia')]
+    province_number = 0
+    for macro, regions in spec['regions'].items():
+        rows.append((macro, f"Macroarea {macro}"))
+        for r in range(regions):
+            region = f"{macro}{REGION_DIGITS[r]}"
+            rows.append((region, f"Regione {region}"))
+            for p in range(spec['provinces']):
+                province_number += 1
+                prefix = f"{province_number:03d}"
+                capital = f"Citta {prefix}"
+                rows.append((f"{region}{p + 1}", capital))     # The province is named like its capital commune
+                rows += [(f"{prefix}{c:03d}", capital if c == 1 else f"Comune {prefix}-{c:03d}")
+                         for c in range(1, spec['communes'] + 1)]
+    df = pd.DataFrame(rows, columns=['id', 'nome'])
+    return df.sample(frac=1, random_state=0).reset_index(drop=True)
+
+def periods(years: int, last_year: int = 2024) -> list[tuple[str, str]]:
+    """(FREQ, TIME_PERIOD) of the monthly and annual data of the last years"""
+    result = []
+    for year in range(last_year - years + 1, last_year + 1):
+        result += [('M', f"{year}-{month:02d}") for month in range(1, 13)]
+        result.append(('A', str(year)))
+    return result
+
+def generate_facts(itter107: pd.DataFrame, scale: str, seed: int = 0) -> Iterator[pd.DataFrame]:
+    """Fact chunks (every commune x period x DATA_TYPE x TYPE_ACCOMMODATION) of FACT_CHUNK_PROVINCES provinces each"""
+    rng = np.random.default_rng(seed)
+    communes = np.sort(itter107.loc[itter107['id'].str.isdigit(), 'id'].to_numpy())
+    prefixes = np.unique([code[:3] for code in communes])
+    freq_periods = periods(SCALES[scale]['years'])
+    for start in range(0, len(prefixes), FACT_CHUNK_PROVINCES):
+        chunk_communes = communes[np.isin([code[:3] for code in communes], prefixes[start:start + FACT_CHUNK_PROVINCES])]
+        index = pd.MultiIndex.from_product([chunk_communes, range(len(freq_periods)), DATA_TYPES, ACCOMMODATIONS],
+                                           names=['REF_AREA', 'period', 'DATA_TYPE', 'TYPE_ACCOMMODATION'])
+        chunk = index.to_frame(index=False)
+        chunk['FREQ'] = [freq_periods[i][0] for i in chunk['period']]
+        chunk['TIME_PERIOD'] = [freq_periods[i][1] for i in chunk['period']]
+        chunk['OBS_VALUE'] = rng.integers(0, 5000, len(chunk)).astype('float64')
+        yield chunk[['FREQ', 'REF_AREA', 'DATA_TYPE', 'TYPE_ACCOMMODATION', 'TIME_PERIOD', 'OBS_VALUE']].astype(
+            {'REF_AREA': str, 'DATA_TYPE': str, 'TYPE_ACCOMMODATION': str})
+
+
+class StubGeocoder(GeocoderBackend):
+    """Deterministic coordinates from the hash of the name, about 5% of the names are not found"""
+    name = 'stub'
+    threaded = False
+
+    def geocode(self, comune: str, provincia: str, nazione: str, codice: str = None) -> tuple[float, float]:
+        digest = zlib.crc32(f"{comune}|{provincia}".encode())
+        if digest % 20 == 0:
+            return None, None
+        return 36.5 + (digest % 10007) / 10007 * 10.5, 6.6 + (digest >> 16) % 10009 / 10009 * 12
+
+
+def quote_columns(columns) -> str:
+    return ', '.join(f'"{col}"' for col in columns)
+
+
+class SqliteStandIn:
+    """Upserts into a SQLite file, for the machines without a local Postgres (timings are not comparable)"""
+    name = 'sqlite'
+
+    def __init__(self):
+        self.path = os.path.join(tempfile.mkdtemp(prefix='benchmark_'), 'benchmark.sqlite')
+        self.conn = sqlite3.connect(self.path)
+
+    def upsert(self, df: pd.DataFrame, table_name: str, key_columns: list[str]) -> int:
+        columns, keys = quote_columns(df.columns), quote_columns(key_columns)
+        placeholders = ', '.join('?' * len(df.columns))
+        updates = ', '.join(f'"{col}" = excluded."{col}"' for col in df.columns if col not in key_columns)
+        self.conn.execute(f'CREATE TABLE IF NOT EXISTS "{table_name}" ({columns})')
+        self.conn.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS "{table_name}_key" ON "{table_name}" ({keys})')
+        self.conn.executemany(f'INSERT INTO "{table_name}" ({columns}) VALUES ({placeholders}) '
+                              f'ON CONFLICT ({keys}) DO UPDATE SET {updates}',
+                              df.astype(object).where(df.notna(), None).itertuples(index=False, name=None))
+        self.conn.commit()
+        return len(df)
+
+    def close(self) -> None:
+        self.conn.close()
+        os.remove(self.path)
+
+
+class PostgresTarget:
+    """bulk_upsert into bench_* tables of the database of .env, dropped at the end"""
+    name = 'postgres'
+
+    def __init__(self):
+        self.conn = get_db_connection()
+        self.tables = set()
+
+    def upsert(self, df: pd.DataFrame, table_name: str, key_columns: list[str]) -> int:
+        if table_name not in self.tables:
+            self.drop(table_name)
+            self.tables.add(table_name)
+        return bulk_upsert(self.conn, df, table_name, key_columns)
+
+    def drop(self, table_name: str) -> None:
+        with self.conn.cursor() as cursor:
+            cursor.execute(f'DROP TABLE IF EXISTS "{table_name}"')
+        self.conn.commit()
+
+    def close(self) -> None:
+        for table_name in self.tables:
+            self.drop(table_name)
+        self.conn.close()
+
+def open_target(backend: str):
+    """Load target of the benchmark, the SQLite stand-in when Postgres is not reachable and backend is auto"""
+    if backend == 'sqlite':
+        return SqliteStandIn()
+    try:
+        return PostgresTarget()
+    except Exception as e:
+        if backend == 'postgres':
+            raise
+        print(f"Postgres not reachable ({e}), loading into the SQLite stand-in")
+        return SqliteStandIn()
+
+def run_scale(scale: str, backend: str = 'auto', seed: int = 0) -> list[dict]:
+    """Run every stage on a scale and return the measures of the stages"""
+    report = RunReport(f"benchmark_{scale}", report_dir=None)
+    with report.stage('generate') as stage:
+        itter107 = generate_itter107(scale)
+        stage.rows_out = len(itter107)
+
+    with report.stage('hierarchy', rows_in=len(itter107)) as stage:
+        df = process_geographic_hierarchy(itter107.copy())
+        stage.rows_out = int(df['Codice Regione'].notna().sum())
+    with report.stage('geocoding', rows_in=int(df['Comune'].notna().sum())) as stage:
+        df = add_coordinates(df, engine=GeocodingEngine(StubGeocoder()))
+        stage.rows_out = int(df['Latitudine'].notna().sum())
+    with report.stage('fill_coordinates', rows_in=len(df)) as stage:
+        df = fill_missing_coordinates(df, strategy='mean')
+        stage.rows_out = int(df['Latitudine'].notna().sum())
+
+    target = open_target(backend)
+    try:
+        with report.stage('load_dimension', rows_in=len(itter107)) as stage:
+            stage.rows_out = target.upsert(itter107, 'bench_itter107', ['id'])
+        dtypes = {'REF_AREA': pd.CategoricalDtype(sorted(itter107['id'])), 'DATA_TYPE': pd.CategoricalDtype(DATA_TYPES),
+                  'TYPE_ACCOMMODATION': pd.CategoricalDtype(ACCOMMODATIONS)}
+        encoder = FactEncoder(dtypes)
+        with report.stage('encode_load_facts') as stage:
+            stage.rows_in = stage.rows_out = 0
+            for chunk in generate_facts(itter107, scale, seed):
+                stage.rows_in += len(chunk)
+                started = time.perf_counter()
+                chunk = encoder.encode(chunk)
+                stage.add('encode_s', time.perf_counter() - started)
+                started = time.perf_counter()
+                stage.rows_out += target.upsert(chunk, 'bench_facts', ['REF_AREA', 'DATA_TYPE', 'TYPE_ACCOMMODATION', 'TIME_PERIOD'])
+                stage.add('load_s', time.perf_counter() - started)
+    finally:
+        target.close()
+
+    results = []
+    for stage in report.stages:
+        measures = stage.to_dict()
+        measures['rows_per_s'] = round(stage.rows_in / stage.wall_s) if stage.rows_in and stage.wall_s else None
+        measures['backend'] = target.name if stage.name.startswith(('load', 'encode_load')) else None
+        results.append(measures)
+    return results
+
+def current_commit() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except Exception:
+        return None
+
+def load_results(path: str) -> list[dict]:
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r', encoding='utf-8') as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+def find_regressions(previous: list[dict], current: list[dict], tolerance: float = TOLERANCE) -> list[str]:
+    """Stages slower or heavier than the last run of the same scale, stage and backend"""
+    last = {}
+    for entry in previous:
+        last[(entry['scale'], entry['name'], entry.get('backend'))] = entry
+    regressions = []
+    for entry in current:
+        before = last.get((entry['scale'], entry['name'], entry.get('backend')))
+        if before is None:
+            continue
+        slower = (before.get('rows_per_s') and entry.get('rows_per_s') and entry['wall_s'] >= MIN_SECONDS
+                  and entry['rows_per_s'] < before['rows_per_s'] * (1 - tolerance))
+        if slower:
+            regressions.append(f"{entry['scale']}/{entry['name']}: {entry['rows_per_s']} rows/s, "
+                               f"{before['rows_per_s']} at {before.get('commit')}")
+        same_scope = before.get('rss_scope', 'process') == entry.get('rss_scope', 'process')   # Stage peaks vs process peaks
+        if (same_scope and before.get('peak_rss_mb') and entry.get('peak_rss_mb')
+                and entry['peak_rss_mb'] > before['peak_rss_mb'] * (1 + tolerance)):
+            regressions.append(f"{entry['scale']}/{entry['name']}: peak RSS {entry['peak_rss_mb']} MB, "
+                               f"{before['peak_rss_mb']} MB at {before.get('commit')}")
+    return regressions
+
+def run_benchmarks(scales: list[str], backend: str = 'auto', seed: int = 0, results_path: str = RESULTS_PATH,
+                   tolerance: float = TOLERANCE) -> list[str]:
+    """Run the scales one process each, append the measures to results_path and return the regressions"""
+    run_at = datetime.now(timezone.utc).isoformat(timespec='seconds')
+    commit = current_commit()
+    current = []
+    for scale in scales:
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            for measures in executor.submit(run_scale, scale, backend, seed).result():
+                current.append({'run_at': run_at, 'commit': commit, 'scale': scale, 'seed': seed,
+                                'python': sys.version.split()[0], **measures})
+
+    regressions = find_regressions(load_results(results_path), current, tolerance)
+    os.makedirs(os.path.dirname(results_path) or '.', exist_ok=True)
+    with open(results_path, 'a', encoding='utf-8') as file:
+        for entry in current:
+            file.write(json.dumps(entry) + '\n')
+
+    print(f"{'scale':<12}{'stage':<20}{'rows':>10}{'seconds':>10}{'rows/s':>12}{'peak MB':>10}")
+    for entry in current:
+        print(f"{entry['scale']:<12}{entry['name']:<20}{entry['rows_in'] or entry['rows_out'] or 0:>10}{entry['wall_s']:>10.2f}"
+              f"{entry['rows_per_s'] or 0:>12}{entry['peak_rss_mb'] or 0:>10.0f}")
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    print(f"Results appended to {results_path}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages on synthetic ISTAT-shaped data")
+    parser.add_argument('scales', nargs='*', default=['liguria', 'italia'],
+                        help="scales to run, italia_x10 (10x the communes, 10 years) only when asked")
+    parser.add_argument('--backend', choices=('auto', 'postgres', 'sqlite'), default='auto',
+                        help="load target, auto = the Postgres of .env or the SQLite stand-in when it's not reachable")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--results', default=RESULTS_PATH, help="JSON lines file the measures are appended to")
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE, help="slowdown reported as a regression")
+    parser.add_argument('--check', action='store_true', help="exit with status 1 when there are regressions")
+    args = parser.parse_args()
+    if set(args.scales) - set(SCALES):
+        parser.error(f"unknown scales {', '.join(sorted(set(args.scales) - set(SCALES)))}, expected {', '.join(SCALES)}")
+
+    regressions = run_benchmarks(args.scales, args.backend, args.seed, args.results, args.tolerance)
+    if args.check and regressions:
+        sys.exit(1)
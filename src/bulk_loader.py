@@ -0,0 +1,171 @@
+import io
+import time
+import pandas as pd
+import psycopg2
+from psycopg2 import sql
+
+# Bulk loader shared by the writers: the dataframe is streamed with COPY FROM STDIN into a staging table and then
+# merged into the target with INSERT ... ON CONFLICT, so constraints, indexes and dependent views are preserved
+
+CHUNK_ROWS = 100000     # Rows serialized to CSV per COPY chunk
+NULL_MARKER = '\\N'
+LOAD_MODES = ('upsert', 'sync', 'append')
+MIN_SERVER_VERSION = 150000     # server_version_num of PostgreSQL 15, the first with UNIQUE NULLS NOT DISTINCT
+
+
+def sql_type(dtype) -> str:
+    """Postgres type of a pandas column, for the tables and columns that don't exist yet"""
+    if pd.api.types.is_bool_dtype(dtype):
+        return 'BOOLEAN'
+    if pd.api.types.is_integer_dtype(dtype):
+        return 'BIGINT'
+    if pd.api.types.is_float_dtype(dtype):
+        return 'DOUBLE PRECISION'
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        return 'TIMESTAMP'
+    return 'TEXT'
+
+def ensure_table(cursor: psycopg2.extensions.cursor, df: pd.DataFrame, table_name: str) -> None:
+    """Create the target table if missing and add the columns of the dataframe it doesn't have yet"""
+    cursor.execute("SELECT column_name FROM information_schema.columns WHERE table_schema = current_schema() AND table_name = %s",
+                   (table_name,))
+    existing = {row[0] for row in cursor.fetchall()}
+    if not existing:
+        columns = sql.SQL(', ').join(sql.SQL('{} {}').format(sql.Identifier(col), sql.SQL(sql_type(df[col].dtype)))
+                                     for col in df.columns)
+        cursor.execute(sql.SQL('CREATE TABLE {} ({})').format(sql.Identifier(table_name), columns))
+        print(f"Created table {table_name}")
+        return
+    for col in df.columns:
+        if col not in existing:
+            cursor.execute(sql.SQL('ALTER TABLE {} ADD COLUMN {} {}').format(
+                sql.Identifier(table_name), sql.Identifier(col), sql.SQL(sql_type(df[col].dtype))))
+            print(f"Added column {col} to {table_name}")
+
+def remove_duplicate_keys(cursor: psycopg2.extensions.cursor, table_name: str, key_columns: list[str]) -> int:
+    """Keep only the last written row (highest ctid) of every key, NULL keys compare equal, returns the rows deleted"""
+    cursor.execute(sql.SQL("""
+        DELETE FROM {table} WHERE ctid IN (
+            SELECT ctid FROM (SELECT ctid, row_number() OVER (PARTITION BY {keys} ORDER BY ctid DESC) AS copy
+                              FROM {table}) copies
+            WHERE copy > 1)
+    """).format(table=sql.Identifier(table_name), keys=sql.SQL(', ').join(map(sql.Identifier, key_columns))))
+    return cursor.rowcount
+
+def unique_key_name(table_name: str) -> str:
+    """Name of the unique index of the upserts, on the natural key of the table"""
+    return f"{table_name}_upsert_key"[:63]
+
+def index_columns(cursor: psycopg2.extensions.cursor, index_name: str) -> list[str]:
+    """Columns of an index in order, empty when it doesn't exist"""
+    cursor.execute("""SELECT a.attname FROM pg_index i, unnest(i.indkey) WITH ORDINALITY AS k (attnum, position)
+                      JOIN pg_attribute a ON a.attnum = k.attnum
+                      WHERE i.indexrelid = to_regclass(%s) AND a.attrelid = i.indrelid ORDER BY k.position""",
+                   (sql.Identifier(index_name).as_string(cursor),))
+    return [row[0] for row in cursor.fetchall()]
+
+def ensure_unique_key(cursor: psycopg2.extensions.cursor, table_name: str, key_columns: list[str],
+                      dedupe: bool = False) -> None:
+    """
+    Create the unique index ON CONFLICT needs, NULL keys compare equal so they are upserted too (Postgres 15+)
+    dedupe = remove the duplicate keys of an existing table first (e.g. left by the old append loads), keeping the last
+             copy of each key, otherwise they raise
+    """
+    index_name = unique_key_name(table_name)
+    existing = index_columns(cursor, index_name)
+    if existing:    # ON CONFLICT only matches a unique index on the same columns
+        if set(existing) != set(key_columns):
+            raise ValueError(f"The upsert key of {table_name} is ({', '.join(existing)}), the rows are keyed on "
+                             f"({', '.join(key_columns)})")
+        return
+    if cursor.connection.server_version < MIN_SERVER_VERSION:
+        raise RuntimeError(f"Upserting into {table_name} needs PostgreSQL 15 or later (UNIQUE NULLS NOT DISTINCT), "
+                           f"the server is version {cursor.connection.server_version}")
+
+    keys = sql.SQL(', ').join(map(sql.Identifier, key_columns))
+    cursor.execute(sql.SQL("SELECT COUNT(*), COALESCE(SUM(copies), 0) FROM (SELECT COUNT(*) AS copies FROM {} "
+                           "GROUP BY {} HAVING COUNT(*) > 1) duplicates").format(sql.Identifier(table_name), keys))
+    duplicate_keys, duplicate_rows = cursor.fetchone()
+    if duplicate_keys and not dedupe:
+        raise ValueError(f"{table_name} has {duplicate_keys} keys ({', '.join(key_columns)}) on more than one row "
+                         f"({duplicate_rows} rows), the unique index of the upsert can't be created: remove them first "
+                         f"(bulk_upsert(..., dedupe=True) keeps the last copy of each key)")
+    if duplicate_keys:
+        print(f"Removed {remove_duplicate_keys(cursor, table_name, key_columns)} duplicate rows from {table_name}")
+    cursor.execute(sql.SQL('CREATE UNIQUE INDEX IF NOT EXISTS {} ON {} ({}) NULLS NOT DISTINCT').format(
+        sql.Identifier(index_name), sql.Identifier(table_name), keys))
+
+def copy_frame(cursor: psycopg2.extensions.cursor, df: pd.DataFrame, table_name: str, chunk_rows: int = CHUNK_ROWS) -> int:
+    """Stream the dataframe into a table with COPY FROM STDIN, chunk by chunk, and return the rows copied"""
+    copy_query = sql.SQL("COPY {} ({}) FROM STDIN WITH (FORMAT CSV, NULL '\\N')").format(
+        sql.Identifier(table_name), sql.SQL(', ').join(map(sql.Identifier, df.columns)))
+    for start in range(0, len(df), chunk_rows):
+        buffer = io.StringIO()
+        df.iloc[start:start + chunk_rows].to_csv(buffer, index=False, header=False, na_rep=NULL_MARKER)
+        buffer.seek(0)
+        cursor.copy_expert(copy_query, buffer)
+    return len(df)
+
+def merge_staging(cursor: psycopg2.extensions.cursor, staging: str, table_name: str, columns: list[str],
+                  key_columns: list[str], mode: str) -> None:
+    """Merge the staging table into the target: upsert on the key columns, or plain insert for append"""
+    target, stage = sql.Identifier(table_name), sql.Identifier(staging)
+    column_list = sql.SQL(', ').join(map(sql.Identifier, columns))
+    insert = sql.SQL('INSERT INTO {} ({}) SELECT {} FROM {}').format(target, column_list, column_list, stage)
+    if mode == 'append':
+        cursor.execute(insert)
+        return
+
+    # Rows without other columns still "update" a key, so that RETURNING reports them for the sync mode
+    updates = [col for col in columns if col not in key_columns] or key_columns[:1]
+    upsert = sql.SQL('{} ON CONFLICT ({}) DO UPDATE SET {}').format(
+        insert, sql.SQL(', ').join(map(sql.Identifier, key_columns)),
+        sql.SQL(', ').join(sql.SQL('{0} = EXCLUDED.{0}').format(sql.Identifier(col)) for col in updates))
+    if mode == 'upsert':
+        cursor.execute(upsert)
+        return
+
+    # Sync: keep the physical ids of the rows just written and delete every other row of the target
+    kept = sql.Identifier(f"{staging}_kept"[:63])
+    cursor.execute(sql.SQL('CREATE TEMP TABLE {} (row_id tid) ON COMMIT DROP').format(kept))
+    cursor.execute(sql.SQL('WITH written AS ({} RETURNING ctid) INSERT INTO {} SELECT ctid FROM written').format(upsert, kept))
+    cursor.execute(sql.SQL('DELETE FROM {} t WHERE NOT EXISTS (SELECT 1 FROM {} k WHERE k.row_id = t.ctid)').format(target, kept))
+
+def bulk_upsert(conn: psycopg2.extensions.connection, df: pd.DataFrame, table_name: str, key_columns: list[str] = None,
+                mode: str = 'upsert', chunk_rows: int = CHUNK_ROWS, dedupe: bool = False) -> int:
+    """
+    Load a dataframe into a table in a single transaction and return the rows loaded
+    key_columns = columns identifying a row, needed by the upsert and sync modes
+    mode = 'upsert': insert new rows and update the existing ones
+           'sync': upsert and delete the rows that are not in the dataframe (replace without dropping the table)
+           'append': insert every row
+    dedupe = remove the rows of the table that duplicate a key before creating its unique index, instead of raising
+    """
+    if mode not in LOAD_MODES:
+        raise ValueError(f"Unknown mode {mode}, expected one of {LOAD_MODES}")
+    key_columns = list(key_columns or [])
+    if mode != 'append' and not key_columns:
+        raise ValueError(f"Mode {mode} needs the key columns of {table_name}")
+
+    start = time.perf_counter()
+    if key_columns:     # A row can't be upserted twice by the same statement, the last occurrence of a key wins
+        df = df.drop_duplicates(key_columns, keep='last')
+    staging = f"{table_name}_staging"[:63]
+    columns = list(df.columns)
+    try:
+        with conn.cursor() as cursor:
+            ensure_table(cursor, df, table_name)
+            if key_columns:
+                ensure_unique_key(cursor, table_name, key_columns, dedupe)
+            cursor.execute(sql.SQL('CREATE TEMP TABLE {} (LIKE {} INCLUDING DEFAULTS) ON COMMIT DROP').format(
+                sql.Identifier(staging), sql.Identifier(table_name)))
+            rows = copy_frame(cursor, df, staging, chunk_rows)
+            merge_staging(cursor, staging, table_name, columns, key_columns, mode)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    elapsed = time.perf_counter() - start
+    print(f"Loaded {rows} rows into {table_name} ({mode}) in {elapsed:.2f}s, {rows / max(elapsed, 1e-9):.0f} rows/s")
+    return rows
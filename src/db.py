@@ -0,0 +1,152 @@
+import itertools
+import threading
+from contextlib import contextmanager
+from os import getenv
+from typing import Iterator
+from dotenv import load_dotenv
+import pandas as pd
+import psycopg2
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from psycopg2.pool import ThreadedConnectionPool
+from instrumentation import count
+
+load_dotenv()
+
+# Database access shared by the scripts: connection settings read once from .env, a process-wide pool of
+# connections so pipelines touching several tables don't connect again for every query, and server-side (named)
+# cursors that stream large results into DataFrames chunk by chunk instead of fetching them whole
+
+POOL_MAX = int(getenv('db_pool_max', 8))
+FETCH_ROWS = 50000      # Rows per round trip of the named cursors
+_pool = None
+_pool_lock = threading.Lock()
+_pool_slots = threading.BoundedSemaphore(POOL_MAX)     # Callers wait for a free connection instead of a PoolError
+_cursor_ids = itertools.count()
+
+
+class CountingCursor(psycopg2.extensions.cursor):
+    """Cursor that counts its round trips to the server for the run reports"""
+
+    def execute(self, query, vars=None):
+        count('db_round_trips')
+        return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        count('db_round_trips')
+        return super().executemany(query, vars_list)
+
+    def copy_expert(self, sql, file, size=8192):
+        count('db_round_trips')
+        return super().copy_expert(sql, file, size)
+
+    def fetchmany(self, size=None):
+        if self.name is not None:   # Every fetch of a named cursor goes to the server
+            count('db_round_trips')
+        return super().fetchmany(size) if size is not None else super().fetchmany()
+
+
+def connection_params() -> dict[str, str]:
+    """Connection settings of .env, 'User' is still read for the .env files written before it was renamed 'user'"""
+    return {
+        'dbname': getenv('database'),
+        'user': getenv('user') or getenv('User'),
+        'password': getenv('password'),
+        'host': getenv('host'),
+        'port': getenv('port'),
+    }
+
+def get_connection_string() -> str:
+    """Create a connection string."""
+    params = connection_params()
+    return f"postgresql://{params['user']}:{params['password']}@{params['host']}:{params['port']}/{params['dbname']}"
+
+def get_db_connection() -> psycopg2.extensions.connection:
+    """Create and return a dedicated database connection, the caller closes it"""
+    return psycopg2.connect(**connection_params(), cursor_factory=CountingCursor)
+
+def create_pool(maxconn: int) -> ThreadedConnectionPool:
+    """New pool of up to maxconn connections, for the loaders that size it to their workers"""
+    return ThreadedConnectionPool(1, maxconn, **connection_params(), cursor_factory=CountingCursor)
+
+def get_pool() -> ThreadedConnectionPool:
+    """Pool shared by the whole process, created on first use with up to db_pool_max connections"""
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.closed:
+            _pool = create_pool(POOL_MAX)
+        return _pool
+
+def close_pool() -> None:
+    global _pool
+    with _pool_lock:
+        if _pool is not None and not _pool.closed:
+            _pool.closeall()
+        _pool = None
+
+@contextmanager
+def connection() -> Iterator[psycopg2.extensions.connection]:
+    """
+    Pooled connection, committed when the block ends and rolled back otherwise (an exception, or the GeneratorExit
+    of an iter_query left before its end), blocking while all the db_pool_max connections are in use
+    """
+    with _pool_slots:
+        pool = get_pool()
+        conn = pool.getconn()
+        try:
+            yield conn
+            conn.commit()
+        finally:
+            if not conn.closed and conn.info.transaction_status != TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:   # Broken connection, it is closed and not given back to the pool
+                    conn.close()
+            pool.putconn(conn, close=bool(conn.closed))
+
+@contextmanager
+def use_connection(conn: psycopg2.extensions.connection = None) -> Iterator[psycopg2.extensions.connection]:
+    """conn itself (the caller handles its transaction), or a pooled connection for the duration of the block"""
+    if conn is not None:
+        yield conn
+        return
+    with connection() as pooled:
+        yield pooled
+
+@contextmanager
+def cursor(conn: psycopg2.extensions.connection = None) -> Iterator[psycopg2.extensions.cursor]:
+    """Cursor of conn, or of a pooled connection committed at the end of the block"""
+    with use_connection(conn) as active, active.cursor() as cur:
+        yield cur
+
+def iter_query(query, params=None, conn: psycopg2.extensions.connection = None,
+               chunk_rows: int = FETCH_ROWS) -> Iterator[pd.DataFrame]:
+    """
+    Stream the result of a SELECT in DataFrames of chunk_rows rows through a server-side cursor, only one chunk is in
+    memory at a time (an empty result gives one empty DataFrame with the columns)
+    query = string or psycopg2.sql object
+    conn = connection to use instead of a pooled one, the cursor lives in its transaction which is left open
+    """
+    if isinstance(query, str):
+        query = query.strip().rstrip(';')   # The query goes inside DECLARE ... CURSOR FOR
+    with use_connection(conn) as active, active.cursor(name=f"stream_{next(_cursor_ids)}") as cur:
+        cur.itersize = chunk_rows
+        cur.execute(query, params)
+        rows = cur.fetchmany(chunk_rows)
+        columns = [desc[0] for desc in cur.description]
+        yield pd.DataFrame(rows, columns=columns)
+        while len(rows) == chunk_rows:
+            rows = cur.fetchmany(chunk_rows)
+            if rows:
+                yield pd.DataFrame(rows, columns=columns)
+
+def read_query(query, params=None, conn: psycopg2.extensions.connection = None,
+               chunk_rows: int = FETCH_ROWS) -> pd.DataFrame:
+    """Whole result of a SELECT as a DataFrame, built from the streamed chunks"""
+    chunks = list(iter_query(query, params, conn, chunk_rows))
+    return pd.concat(chunks, ignore_index=True) if len(chunks) > 1 else chunks[0]
+
+def fetch_data_from_db(sql_file: str) -> pd.DataFrame:
+    """Fetch data from database using SQL file"""
+    with open(sql_file, 'r') as file:   # Read the SQL file
+        sql_query = file.read()
+    return read_query(sql_query)
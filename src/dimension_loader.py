@@ -0,0 +1,121 @@
+import argparse
+import glob
+import hashlib
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from psycopg2.pool import ThreadedConnectionPool
+from db import create_pool
+from insert_csv import create_table, load_csv_to_db
+from load_state import get_content_hashes, set_content_hash
+
+# Parallel loader of the codelist CSVs (dim_CL_*.csv) extracted for every dataflow: each dimension table is COPYed
+# into a staging table and merged into the live one in a single transaction, on its own pooled connection.
+# The live table is never dropped, the facts reference it with ON DELETE CASCADE and the views depend on it.
+# Tables whose files have the same content hash of the last load are skipped
+
+EXTRACTED_DIR = os.path.join('csv', 'istat_metadata_extractor', 'extracted')
+DEFAULT_WORKERS = 4
+
+
+def discover_dimensions(base_dir: str = EXTRACTED_DIR) -> dict[str, list[str]]:
+    """Return {table: CSV files}, the dataflows that share a codelist contribute a file each"""
+    tables = {}
+    for path in sorted(glob.glob(os.path.join(base_dir, '*', 'dim_csv', '*.csv'))):
+        table_name = os.path.basename(path)[:-4].lower()  # Postgres folds the unquoted dim_CL_* names
+        tables.setdefault(table_name, []).append(path)
+    return tables
+
+def content_hash(paths: list[str]) -> str:
+    """sha256 of the files of a table"""
+    digest = hashlib.sha256()
+    for path in paths:
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+def load_dimension(pool: ThreadedConnectionPool, table_name: str, paths: list[str], file_hash: str,
+                   prune: bool = False) -> int:
+    """COPY the files into a staging table and merge it into the dimension in one transaction, returns the codes"""
+    conn = pool.getconn()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("CREATE TEMP TABLE dim_staging (id VARCHAR(50), nome TEXT) ON COMMIT DROP")
+            for path in paths:
+                load_csv_to_db(cursor, 'dim_staging', path, create=False)
+
+            create_table(cursor, table_name)
+            cursor.execute("SELECT column_name FROM information_schema.columns WHERE table_schema = current_schema() "
+                           "AND table_name = %s ORDER BY ordinal_position", (table_name,))
+            id_column, name_column = [row[0] for row in cursor.fetchall()][:2]  # Tables of the old script have id, name
+            cursor.execute(f"""
+                INSERT INTO {table_name} ({id_column}, {name_column})
+                SELECT DISTINCT ON (id) id, nome FROM dim_staging WHERE id IS NOT NULL ORDER BY id
+                ON CONFLICT ({id_column}) DO UPDATE SET {name_column} = EXCLUDED.{name_column}
+                WHERE {table_name}.{name_column} IS DISTINCT FROM EXCLUDED.{name_column}
+            """)
+            changed = cursor.rowcount
+            removed = 0
+            if prune:   # The facts of the removed codes are deleted too (ON DELETE CASCADE)
+                cursor.execute(f"DELETE FROM {table_name} t WHERE NOT EXISTS (SELECT 1 FROM dim_staging s WHERE s.id = t.{id_column})")
+                removed = cursor.rowcount
+            cursor.execute("SELECT COUNT(DISTINCT id) FROM dim_staging")
+            codes = cursor.fetchone()[0]
+            set_content_hash(cursor, table_name, file_hash, codes)
+        conn.commit()
+        print(f"Loaded {table_name}: {codes} codes, {changed} new or renamed" + (f", {removed} removed" if prune else ""))
+        return codes
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        pool.putconn(conn)
+
+def load_dimensions(base_dir: str = EXTRACTED_DIR, max_workers: int = DEFAULT_WORKERS, force: bool = False,
+                    prune: bool = False) -> dict[str, int]:
+    """
+    Load every codelist CSV under base_dir/*/dim_csv in parallel and return {table: codes loaded}
+    force = load the tables even when their files didn't change
+    prune = delete the codes missing from the files (and, by cascade, their facts)
+    """
+    start = time.time()
+    tables = discover_dimensions(base_dir)
+    pool = create_pool(max_workers)
+    results, failed = {}, []
+    try:
+        conn = pool.getconn()
+        hashes = get_content_hashes(conn)
+        pool.putconn(conn)
+
+        pending = {}
+        for table_name, paths in tables.items():
+            file_hash = content_hash(paths)
+            if force or hashes.get(table_name) != file_hash:
+                pending[table_name] = (paths, file_hash)
+        print(f"Found {len(tables)} dimension tables, {len(tables) - len(pending)} unchanged")
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(load_dimension, pool, table_name, paths, file_hash, prune): table_name
+                       for table_name, (paths, file_hash) in pending.items()}
+            for future in as_completed(futures):
+                try:
+                    results[futures[future]] = future.result()
+                except Exception as e:
+                    failed.append(futures[future])
+                    print(f"Error loading {futures[future]}: {e}")
+    finally:
+        pool.closeall()
+
+    print(f"Loaded {len(results)} dimension tables in {time.time() - start:.1f}s, {len(failed)} failed")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load the codelist CSVs of the extracted metadata into the dim_cl_* tables")
+    parser.add_argument('--dir', default=EXTRACTED_DIR, help="folder of the extracted metadata")
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS)
+    parser.add_argument('--force', action='store_true', help="load also the tables whose files didn't change")
+    parser.add_argument('--prune', action='store_true', help="delete the codes missing from the files, with their facts")
+    args = parser.parse_args()
+    load_dimensions(args.dir, args.workers, args.force, args.prune)
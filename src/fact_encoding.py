@@ -0,0 +1,130 @@
+import os
+from collections import defaultdict
+import pandas as pd
+import psycopg2
+from psycopg2 import sql
+
+# Compact encoding of the fact chunks: the dimension columns become categoricals over their codelist (a small integer
+# per row instead of a Python string) and the codes are checked against the dim_cl_* tables before the load, so an
+# unknown code is reported with its dimension instead of failing the foreign key in the middle of the COPY.
+# The CSV parser reads the dimensions straight into categoricals (csv_dtypes), they are then recoded to the codelist
+# categories, so the codes never exist as a column of Python strings
+
+TIME_PERIOD_PATTERN = r'\d{4}(-(\d{2}(-\d{2})?|[SHQ]\d|W\d{2}))?'   # 2023, 2023-05, 2023-05-14, 2023-Q2, 2023-W07
+ON_INVALID = ('raise', 'drop')
+MB = 1024 * 1024
+
+
+def load_codelists(conn: psycopg2.extensions.connection, dimensions: dict[str, str], csv_dir: str = None) -> dict[str, pd.CategoricalDtype]:
+    """
+    Categorical dtype of every dimension ({dimension: codelist}) with the codes of its dim_cl_* table, or of the
+    dim_csv file in csv_dir when the table doesn't exist yet. Dimensions without either are left as strings
+    """
+    dtypes = {}
+    with conn.cursor() as cursor:
+        for dimension, codelist in dimensions.items():
+            table_name = f"dim_{codelist}".lower()
+            csv_path = os.path.join(csv_dir, f"dim_{codelist}.csv") if csv_dir else None
+            cursor.execute("SELECT to_regclass(%s) IS NOT NULL", (table_name,))
+            if cursor.fetchone()[0]:
+                cursor.execute(sql.SQL("SELECT id FROM {}").format(sql.Identifier(table_name)))
+                codes = [row[0] for row in cursor.fetchall()]
+            elif csv_path and os.path.exists(csv_path):
+                codes = pd.read_csv(csv_path, dtype=str, usecols=[0], keep_default_na=False).iloc[:, 0].tolist()
+            else:
+                print(f"No codelist found for {dimension} ({codelist}), its codes are not checked")
+                continue
+            dtypes[dimension] = pd.CategoricalDtype(sorted(set(codes)))
+    conn.commit()
+    return dtypes
+
+def string_bytes(chunk: pd.DataFrame) -> int:
+    """Memory of a chunk with its categorical columns counted as strings, as read_csv(dtype=str) gives them"""
+    total = chunk.index.memory_usage()
+    for col in chunk.columns:
+        values = chunk[col]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            # Memory of the codelist as strings, shared among its codes by length (missing values, code -1, count 0)
+            categories = pd.Series(values.cat.categories, dtype=str)
+            lengths = pd.Series(list(categories.str.len()) + [0]).to_numpy()
+            per_char = categories.memory_usage(deep=True, index=False) / max(int(lengths.sum()), 1)
+            total += int(lengths[values.cat.codes.to_numpy()].sum() * per_char)
+        else:
+            total += values.memory_usage(deep=True, index=False)
+    return int(total)
+
+def to_codelist(values: pd.Series, dtype: pd.CategoricalDtype) -> pd.Series:
+    """Recode a column to the categories of its codelist, the codes outside it become NaN"""
+    if not isinstance(values.dtype, pd.CategoricalDtype):
+        values = values.astype('category')
+    return values.cat.set_categories(dtype.categories)
+
+
+class FactEncoder:
+    """Encodes the chunks of a load with the codelist dtypes and keeps the memory and validation totals"""
+
+    def __init__(self, dtypes: dict[str, pd.CategoricalDtype], on_invalid: str = 'raise'):
+        """on_invalid = raise on unknown codes and malformed periods, or drop their rows"""
+        if on_invalid not in ON_INVALID:
+            raise ValueError(f"on_invalid must be one of {', '.join(ON_INVALID)}")
+        self.dtypes = dtypes
+        self.on_invalid = on_invalid
+        self.raw_bytes = 0
+        self.encoded_bytes = 0
+        self.rows = 0
+        self.dropped = 0
+
+    def csv_dtypes(self) -> defaultdict:
+        """dtype of read_csv: the dimensions and TIME_PERIOD as categoricals (their categories are the codes found, so
+        unknown codes can still be reported), strings for the other columns"""
+        return defaultdict(lambda: str, {col: 'category' for col in [*self.dtypes, 'TIME_PERIOD']})
+
+    def invalid_rows(self, chunk: pd.DataFrame, encoded: dict[str, pd.Series]) -> pd.Series:
+        """Rows with a code outside its codelist (it becomes NaN in the categorical) or a malformed TIME_PERIOD"""
+        invalid = pd.Series(False, index=chunk.index)
+        problems = []
+        for dimension, values in encoded.items():
+            unknown = values.isna() & chunk[dimension].notna()
+            if unknown.any():
+                codes = chunk.loc[unknown, dimension].unique()
+                problems.append(f"{dimension}: {len(codes)} unknown codes ({', '.join(map(str, codes[:10]))})")
+                invalid |= unknown
+        if 'TIME_PERIOD' in chunk.columns:
+            periods = chunk['TIME_PERIOD'].astype('category')    # Only the distinct periods are matched
+            categories = periods.cat.categories
+            malformed = periods.isin(categories[~categories.astype(str).str.fullmatch(TIME_PERIOD_PATTERN)])
+            if malformed.any():
+                problems.append(f"TIME_PERIOD: {malformed.sum()} malformed periods ({', '.join(chunk.loc[malformed, 'TIME_PERIOD'].unique()[:10])})")
+                invalid |= malformed
+        if problems and self.on_invalid == 'raise':
+            raise ValueError("Codes not found in the dimension tables, " + "; ".join(problems))
+        for problem in problems:
+            print(f"Dropping rows, {problem}")
+        return invalid
+
+    def encode(self, chunk: pd.DataFrame) -> pd.DataFrame:
+        """Categorical dimensions and TIME_PERIOD, numeric OBS_VALUE, invalid rows raised or dropped"""
+        self.raw_bytes += string_bytes(chunk)
+        encoded = {dim: to_codelist(chunk[dim], dtype) for dim, dtype in self.dtypes.items() if dim in chunk.columns}
+        invalid = self.invalid_rows(chunk, encoded)
+
+        chunk = chunk.assign(**encoded)
+        if 'TIME_PERIOD' in chunk.columns:
+            chunk['TIME_PERIOD'] = chunk['TIME_PERIOD'].astype('category')
+        if 'OBS_VALUE' in chunk.columns:
+            chunk['OBS_VALUE'] = pd.to_numeric(chunk['OBS_VALUE'], errors='coerce').astype('float64')
+        if invalid.any():
+            self.dropped += int(invalid.sum())
+            chunk = chunk.loc[~invalid]
+
+        self.rows += len(chunk)
+        self.encoded_bytes += chunk.memory_usage(deep=True).sum()
+        return chunk
+
+    def report(self) -> str:
+        """Memory of the chunks as strings against the encoded ones"""
+        saved = 1 - self.encoded_bytes / self.raw_bytes if self.raw_bytes else 0
+        message = (f"Encoded {self.rows} rows: {self.raw_bytes / MB:.1f} MB as strings, {self.encoded_bytes / MB:.1f} MB "
+                   f"categorical ({saved:.0%} saved)" + (f", {self.dropped} invalid rows dropped" if self.dropped else ""))
+        print(message)
+        return message
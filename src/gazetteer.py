@@ -0,0 +1,113 @@
+import difflib
+from os import getenv
+import numpy as np
+import pandas as pd
+from geocoder import GeocoderBackend
+from geocoding_cache import normalize_name
+
+# Offline geocoding backend: a local gazetteer loaded into an in-memory index keyed by ISTAT code and normalized name
+
+DEFAULT_GAZETTEER_PATH = 'csv//gerarchia luogo con coordinate.csv'
+FUZZY_CUTOFF = 0.85     # Minimum similarity (0-1) accepted by the fuzzy name matching
+
+# Accepted column names of a CSV gazetteer (e.g. ISTAT commune centroids or a gerarchia_luogo export)
+CODE_COLUMNS = ('Codice Comune', 'Codice ISTAT', 'PRO_COM_T', 'codice', 'code')
+NAME_COLUMNS = ('Comune', 'COMUNE', 'nome', 'name')
+PROVINCE_COLUMNS = ('Provincia', 'DEN_UTS', 'provincia', 'province')
+LAT_COLUMNS = ('Latitudine', 'lat', 'latitude')
+LON_COLUMNS = ('Longitudine', 'lon', 'longitude')
+
+# Columns of a GeoNames dump (e.g. IT.txt), communes are the ADM3 features and admin3 is their ISTAT code
+GEONAMES_COLUMNS = ['geonameid', 'name', 'asciiname', 'alternatenames', 'lat', 'lon', 'feature_class', 'feature_code',
+                    'country_code', 'cc2', 'admin1', 'admin2', 'admin3', 'admin4', 'population', 'elevation', 'dem',
+                    'timezone', 'modification_date']
+
+
+def find_column(df: pd.DataFrame, candidates: tuple) -> str | None:
+    """Return the first candidate column present in the dataframe"""
+    return next((col for col in candidates if col in df.columns), None)
+
+def read_gazetteer(path: str) -> pd.DataFrame:
+    """Read a CSV or GeoNames gazetteer into a (code, name, province, lat, lon) dataframe"""
+    if path.endswith('.txt'):   # GeoNames dump, tab separated without header
+        df = pd.read_csv(path, sep='\t', header=None, names=GEONAMES_COLUMNS, dtype=str,
+                         usecols=['name', 'lat', 'lon', 'feature_code', 'admin2', 'admin3'], keep_default_na=False)
+        df = df.loc[df['feature_code'] == 'ADM3']
+        return pd.DataFrame({'code': df['admin3'], 'name': df['name'], 'province': df['admin2'],
+                             'lat': df['lat'].astype(float), 'lon': df['lon'].astype(float)})
+
+    df = pd.read_csv(path, dtype=str)
+    code_col, name_col, province_col = (find_column(df, cols) for cols in (CODE_COLUMNS, NAME_COLUMNS, PROVINCE_COLUMNS))
+    lat_col, lon_col = find_column(df, LAT_COLUMNS), find_column(df, LON_COLUMNS)
+    if name_col is None or lat_col is None or lon_col is None:
+        raise ValueError(f"Gazetteer {path} needs a name, a latitude and a longitude column")
+    df = df.loc[df[name_col].notna() & df[lat_col].notna() & df[lon_col].notna()]
+    return pd.DataFrame({'code': df[code_col] if code_col else None, 'name': df[name_col],
+                         'province': df[province_col] if province_col else None,
+                         'lat': df[lat_col].astype(float), 'lon': df[lon_col].astype(float)})
+
+
+class GazetteerIndex:
+    """Compact index of a gazetteer: coordinates in two float arrays, codes and names mapped to their positions"""
+
+    def __init__(self, gazetteer: pd.DataFrame):
+        self.lat = gazetteer['lat'].to_numpy(dtype=np.float64)
+        self.lon = gazetteer['lon'].to_numpy(dtype=np.float64)
+        self.by_code = {code: pos for pos, code in enumerate(gazetteer['code']) if pd.notna(code)}
+        self.by_name = {}   # normalized name -> positions, homonyms share the key
+        self.by_name_province = {}
+        for pos, (name, province) in enumerate(zip(gazetteer['name'], gazetteer['province'])):
+            name = normalize_name(name)
+            self.by_name.setdefault(name, []).append(pos)
+            if pd.notna(province):
+                self.by_name_province.setdefault((name, normalize_name(province)), pos)
+        self.names = list(self.by_name)
+
+    def __len__(self) -> int:
+        return len(self.lat)
+
+    def position(self, comune: str, provincia: str = None, codice: str = None) -> int | None:
+        """Position of a place: by ISTAT code first, then by exact name (and province), then by fuzzy name"""
+        if codice is not None and codice in self.by_code:
+            return self.by_code[codice]
+        name = normalize_name(comune)
+        if provincia is not None and (name, normalize_name(provincia)) in self.by_name_province:
+            return self.by_name_province[(name, normalize_name(provincia))]
+        positions = self.by_name.get(name)
+        if positions is None:
+            close = difflib.get_close_matches(name, self.names, n=1, cutoff=FUZZY_CUTOFF)
+            positions = self.by_name[close[0]] if close else None
+        if positions is None or len(positions) > 1:     # Homonyms in different provinces can't be told apart by name
+            return None
+        return positions[0]
+
+    def lookup_codes(self, codes: pd.Series) -> tuple[np.ndarray, np.ndarray]:
+        """Vectorized lookup of ISTAT codes, NaN where the code is unknown"""
+        positions = codes.map(self.by_code).to_numpy(dtype=np.float64)
+        found = ~np.isnan(positions)
+        lat, lon = np.full(len(codes), np.nan), np.full(len(codes), np.nan)
+        lat[found] = self.lat[positions[found].astype(int)]
+        lon[found] = self.lon[positions[found].astype(int)]
+        return lat, lon
+
+
+class GazetteerBackend(GeocoderBackend):
+    """Offline backend resolving names (and ISTAT codes) against a local gazetteer, with no rate limit"""
+    name = 'gazetteer'
+    threaded = False
+
+    def __init__(self, path: str = None):
+        super().__init__(rate=None)
+        self.path = path or getenv('gazetteer_path', DEFAULT_GAZETTEER_PATH)
+        self.index = GazetteerIndex(read_gazetteer(self.path))
+        print(f"Loaded {len(self.index)} places from {self.path}")
+
+    def geocode_codes(self, codes: list[str]) -> dict[str, tuple[float, float]]:
+        lat, lon = self.index.lookup_codes(pd.Series(codes, dtype=object))
+        return {code: (float(la), float(lo)) for code, la, lo in zip(codes, lat, lon) if not np.isnan(la)}
+
+    def geocode(self, comune: str, provincia: str, nazione: str, codice: str = None) -> tuple[float, float]:
+        pos = self.index.position(comune, provincia, codice)
+        if pos is None:
+            return None, None
+        return float(self.index.lat[pos]), float(self.index.lon[pos])
@@ -0,0 +1,209 @@
+from abc import ABC, abstractmethod
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from os import getenv
+import requests
+from requests.adapters import HTTPAdapter
+from geocoding_cache import GeocodingCache, normalize_code, query_key
+from instrumentation import count
+
+# Concurrent geocoding engine: pluggable backends, each one with its own token-bucket rate limit
+
+NOMINATIM_URL = 'https://nominatim.openstreetmap.org'
+USER_AGENT = 'CommuneCoordinatesFinder/1.0'
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+class TokenBucket:
+    """Thread-safe token bucket: `rate` tokens per second, up to `capacity` tokens spent in a burst"""
+
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """Block until a token is available and take it"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)    # Sleep outside the lock so that other threads can refill
+
+
+class GeocoderBackend(ABC):
+    """
+    Interface of the geocoding backends
+    geocode() returns (lat, lon), (None, None) when the name is not found, and raises on errors (errors are not cached)
+    rate = requests per second allowed by the backend (None = unlimited), burst = requests allowed at once
+    codice = ISTAT code of the place, used by the backends that can look it up
+    """
+    name = 'backend'
+    threaded = True     # False for in-memory backends, where a thread pool only adds overhead
+
+    def __init__(self, rate: float = None, burst: float = 1):
+        self.limiter = TokenBucket(rate, burst) if rate else None
+
+    def wait_turn(self) -> None:
+        """Respect the rate limit of the backend"""
+        if self.limiter is not None:
+            self.limiter.acquire()
+
+    @abstractmethod
+    def geocode(self, comune: str, provincia: str, nazione: str, codice: str = None) -> tuple[float, float]:
+        """(lat, lon) of the place, (None, None) when it is not found"""
+
+    def geocode_codes(self, codes: list[str]) -> dict[str, tuple[float, float]]:
+        """{code: (lat, lon)} of the ISTAT codes the backend resolves in bulk, the others go through geocode()"""
+        return {}
+
+    def close(self) -> None:
+        """Release the resources of the backend"""
+
+
+class HttpBackend(GeocoderBackend):
+    """
+    Base of the HTTP backends: pooled session and retries with exponential backoff and jitter on 429/5xx, connection
+    errors and timeouts
+    """
+
+    def __init__(self, rate: float = None, burst: float = 1, pool_size: int = 10, max_retries: int = 4,
+                 backoff: float = 1.0, timeout: float = 30):
+        super().__init__(rate, burst)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = USER_AGENT
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get_json(self, url: str, params: dict = None):
+        """GET a JSON document, retrying the throttled and failed requests"""
+        for attempt in range(self.max_retries + 1):
+            self.wait_turn()
+            count('http_calls')
+            try:
+                response = self.session.get(url, params=params, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.max_retries:
+                    raise
+                response = None
+            if response is not None and (response.status_code not in RETRY_STATUS or attempt == self.max_retries):
+                break
+            retry_after = response.headers.get('Retry-After', '') if response is not None else ''
+            delay = float(retry_after) if retry_after.isdigit() else self.backoff * 2 ** attempt
+            time.sleep(delay + random.uniform(0, self.backoff))     # Jitter, so that workers don't retry in lockstep
+        response.raise_for_status()
+        return response.json()
+
+    def close(self) -> None:
+        self.session.close()
+
+
+class NominatimBackend(HttpBackend):
+    """Nominatim search API, public (1 request/s) or self-hosted with a higher rate"""
+    name = 'nominatim'
+
+    def __init__(self, base_url: str = None, rate: float = None, **kwargs):
+        self.base_url = (base_url or getenv('nominatim_url', NOMINATIM_URL)).rstrip('/')
+        rate = rate or float(getenv('nominatim_rate', 1))
+        super().__init__(rate=rate, **kwargs)
+
+    def geocode(self, comune: str, provincia: str, nazione: str, codice: str = None) -> tuple[float, float]:
+        data = self.get_json(f"{self.base_url}/search",
+                             params={'q': f"{comune}, {provincia}, {nazione}", 'format': 'json', 'limit': 1})
+        if data and len(data) > 0:
+            return float(data[0]['lat']), float(data[0]['lon'])
+        return None, None
+
+
+_default_backend = None
+
+def default_backend() -> GeocoderBackend:
+    """
+    Return the shared backend chosen by the geocoding_backend env variable ('nominatim' or 'gazetteer'),
+    so that separate calls share the same rate limit, session or index
+    """
+    global _default_backend
+    if _default_backend is None:
+        if getenv('geocoding_backend', 'nominatim') == 'gazetteer':
+            from gazetteer import GazetteerBackend  # Imported here, the gazetteer module depends on this one
+            _default_backend = GazetteerBackend()
+        else:
+            _default_backend = NominatimBackend()
+    return _default_backend
+
+
+class GeocodingEngine:
+    """Geocode many queries concurrently through a backend, reading and writing the cache from the calling thread"""
+
+    def __init__(self, backend: GeocoderBackend = None, cache: GeocodingCache = None, max_workers: int = 4):
+        self.backend = backend or default_backend()
+        self.cache = cache
+        self.max_workers = max_workers
+
+    def _geocode(self, query: tuple) -> tuple[float, float] | None:
+        """Geocode a single query, None when the request failed"""
+        try:
+            return self.backend.geocode(*query)
+        except Exception as e:
+            print(f"Error fetching coordinates for {query[0]}: {e}")
+            return None
+
+    def geocode_many(self, queries: list[tuple]) -> dict[tuple, tuple[float, float]]:
+        """
+        Return {query: (lat, lon)}, each distinct query goes to the backend at most once
+        queries = (comune, provincia, nazione) or (comune, provincia, nazione, codice) tuples, deduplicated and cached
+        by ISTAT code when they have one (homonymous communes of a province share the names), by the names otherwise
+        """
+        unique = {}
+        for query in queries:
+            unique.setdefault(query_key(*query), query)
+
+        results, misses = {}, []
+        for key, query in unique.items():
+            cached = self.cache.get(*query) if self.cache is not None else None
+            if cached is not None:
+                results[key] = cached
+            else:
+                misses.append((key, query))
+
+        # The codes first, in bulk, only the ones the backend can't resolve go through the names (and fuzzy matching)
+        entries, by_code = [], 0
+        codes = {normalize_code(query[3]): key for key, query in misses if len(query) > 3 and normalize_code(query[3])}
+        if codes:
+            for code, coordinates in self.backend.geocode_codes(list(codes)).items():
+                results[codes[code]] = coordinates
+            entries = [(*query[:3], *results[key], query[3]) for key, query in misses if key in results]
+            by_code = len(entries)
+            misses = [(key, query) for key, query in misses if key not in results]
+
+        if misses:
+            if self.backend.threaded:
+                with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                    found = list(executor.map(self._geocode, [query for _, query in misses]))
+            else:
+                found = [self._geocode(query) for _, query in misses]
+            for (key, query), coordinates in zip(misses, found):
+                results[key] = coordinates if coordinates is not None else (None, None)
+                if coordinates is not None:
+                    entries.append((*query[:3], *coordinates, query[3] if len(query) > 3 else None))
+        if self.cache is not None and entries:
+            self.cache.set_many(entries)
+        cached = len(unique) - len(misses) - by_code
+        count('geocode_cache_hits', cached)
+        print(f"Geocoded {len(unique)} places: {cached} from cache, {by_code} by ISTAT code and {len(misses)} by name "
+              f"from {self.backend.name}")
+
+        return {query: results[query_key(*query)] for query in queries}
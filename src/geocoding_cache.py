@@ -0,0 +1,137 @@
+import sqlite3
+import time
+import unicodedata
+from os import getenv
+import pandas as pd
+
+# Persistent cache of the geocoding results, so that rebuilding gerarchia_luogo only queries new or expired names
+
+DEFAULT_CACHE_PATH = 'csv//geocoding_cache.sqlite'
+DEFAULT_NEGATIVE_TTL_DAYS = 30  # Names not found are retried after a month, found coordinates never expire by default
+SECONDS_PER_DAY = 86400
+CODE_PREFIX = 'istat:'  # Keys of the queries with an ISTAT code, the others are keyed by their normalized names
+
+
+def normalize_name(value: str) -> str:
+    """Normalize a place name: strip accents, lowercase and collapse whitespace"""
+    if pd.isna(value):
+        return ""
+    value = unicodedata.normalize('NFKD', str(value))
+    value = "".join(char for char in value if not unicodedata.combining(char))
+    return " ".join(value.lower().split())
+
+def normalize_key(comune: str, provincia: str, nazione: str) -> str:
+    """Create the cache key of a (comune, provincia, nazione) query"""
+    return "|".join(normalize_name(part) for part in (comune, provincia, nazione))
+
+def normalize_code(codice: str) -> str | None:
+    """ISTAT code of a query, None when missing"""
+    if codice is None or pd.isna(codice) or str(codice).strip() == "":
+        return None
+    return str(codice).strip()
+
+def query_key(comune: str, provincia: str, nazione: str, codice: str = None) -> str:
+    """Cache key of a query: its ISTAT code when known (homonyms of a province differ only by code), else its names"""
+    code = normalize_code(codice)
+    return f"{CODE_PREFIX}{code}" if code is not None else normalize_key(comune, provincia, nazione)
+
+
+class GeocodingCache:
+    """SQLite backed cache of (comune, provincia, nazione[, codice]) -> (lat, lon), including the places not found"""
+
+    def __init__(self, path: str = None, ttl_days: float = None, negative_ttl_days: float = DEFAULT_NEGATIVE_TTL_DAYS):
+        self.path = path or getenv('geocoding_cache', DEFAULT_CACHE_PATH)
+        self.ttl_days = ttl_days
+        self.negative_ttl_days = negative_ttl_days
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS geocoding_cache (
+                query_key TEXT PRIMARY KEY,
+                comune TEXT,
+                provincia TEXT,
+                nazione TEXT,
+                lat REAL,
+                lon REAL,
+                fetched_at REAL NOT NULL
+            )
+        """)
+        self.conn.commit()
+
+    def _is_expired(self, lat: float, fetched_at: float, now: float) -> bool:
+        """Check if an entry is older than its TTL (negative results have their own TTL)"""
+        ttl_days = self.ttl_days if lat is not None else self.negative_ttl_days
+        return ttl_days is not None and now - fetched_at > ttl_days * SECONDS_PER_DAY
+
+    def get(self, comune: str, provincia: str, nazione: str, codice: str = None) -> tuple[float, float] | None:
+        """Return the cached coordinates, (None, None) for a cached negative result or None on a miss"""
+        row = self.conn.execute("SELECT lat, lon, fetched_at FROM geocoding_cache WHERE query_key = ?",
+                                (query_key(comune, provincia, nazione, codice),)).fetchone()
+        if row is None or self._is_expired(row[0], row[2], time.time()):
+            return None
+        return row[0], row[1]
+
+    def set(self, comune: str, provincia: str, nazione: str, lat: float, lon: float, fetched_at: float = None,
+            codice: str = None) -> None:
+        """Store the result of a query, lat and lon are None when the place was not found"""
+        self.set_many([(comune, provincia, nazione, lat, lon, codice)], fetched_at)
+
+    def set_many(self, entries: list[tuple], fetched_at: float = None) -> None:
+        """Store several (comune, provincia, nazione, lat, lon[, codice]) results in a single transaction"""
+        fetched_at = fetched_at or time.time()
+        rows = [(query_key(comune, provincia, nazione, codice[0] if codice else None), comune, provincia, nazione,
+                 None if pd.isna(lat) else float(lat), None if pd.isna(lon) else float(lon), fetched_at)
+                for comune, provincia, nazione, lat, lon, *codice in entries]
+        self.conn.executemany("INSERT OR REPLACE INTO geocoding_cache VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        self.conn.commit()
+
+    def invalidate(self, comune: str = None, provincia: str = None, nazione: str = None, older_than_days: float = None,
+                   negative_only: bool = False, codice: str = None) -> int:
+        """
+        Delete cache entries and return how many were removed
+        comune, provincia, nazione = delete the single query (all three are needed)
+        codice = delete the single query with this ISTAT code
+        older_than_days = delete the entries fetched before this many days ago
+        negative_only = delete only the names that were not found
+        Without arguments the whole cache is cleared
+        """
+        conditions, params = [], []
+        if comune is not None or codice is not None:
+            conditions.append("query_key = ?")
+            params.append(query_key(comune, provincia, nazione, codice))
+        if older_than_days is not None:
+            conditions.append("fetched_at < ?")
+            params.append(time.time() - older_than_days * SECONDS_PER_DAY)
+        if negative_only:
+            conditions.append("lat IS NULL")
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        deleted = self.conn.execute(f"DELETE FROM geocoding_cache{where}", params).rowcount
+        self.conn.commit()
+        return deleted
+
+    def seed_from_csv(self, csv_path: str, nazione: str = "Italy") -> int:
+        """Warm-start the cache from a gerarchia_luogo CSV with coordinates (e.g. 'gerarchia luogo con coordinate.csv')"""
+        df = pd.read_csv(csv_path, dtype={'Codice ISTAT': 'str'})
+        df = df.loc[df['Comune'].notna() & df['Latitudine'].notna() & df['Longitudine'].notna()]
+        provincia = df['Provincia'].where(df['Provincia'].notna() & (df['Provincia'] != ""), df['Regione'])  # Same query as add_coordinates
+        entries = list(zip(df['Comune'], provincia, [nazione] * len(df), df['Latitudine'], df['Longitudine']))
+        if 'Codice ISTAT' in df.columns:    # The same coordinates under the codes, the key of the queries that have one
+            entries += list(zip(df['Comune'], provincia, [nazione] * len(df), df['Latitudine'], df['Longitudine'],
+                                df['Codice ISTAT']))
+        self.set_many(entries)
+        print(f"Seeded {len(df)} coordinates from {csv_path}")
+        return len(df)
+
+    def close(self) -> None:
+        """Close the cache database"""
+        self.conn.close()
+
+    def __enter__(self) -> 'GeocodingCache':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+if __name__ == "__main__":
+    with GeocodingCache() as cache:
+        cache.seed_from_csv('csv//gerarchia luogo con coordinate.csv')
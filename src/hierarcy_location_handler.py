@@ -1,218 +1,234 @@
 from dotenv import load_dotenv
-from os import getenv
+from typing import Iterable
 import pandas as pd
-import requests
-import time
-import psycopg2
+from bulk_loader import bulk_upsert
+from db import connection, fetch_data_from_db
+from geocoding_cache import GeocodingCache
+from instrumentation import RunReport
+from location_rollup import HIERARCHY_COLUMNS, HIERARCHY_TABLE
+from geocoder import GeocoderBackend, GeocodingEngine, default_backend
 
 load_dotenv()
 
 
-def get_db_connection() -> psycopg2.extensions.connection:
-    """Create and return a database connection"""
-    return psycopg2.connect(
-        dbname = getenv('database'),
-        user = getenv('User'),
-        password = getenv('password'),
-        host = getenv('host'),
-        port = getenv('port')
-    )
-
-def get_connection_string() -> str:
-    """Create a connection string."""
-    return f"postgresql://{getenv('user')}:{getenv('password')}@{getenv('host')}:{getenv('port')}/{getenv('database')}"
-
-def fetch_data_from_db(sql_file) -> pd.DataFrame:
-    """Fetch data from database using SQL file"""
-    conn = get_db_connection()
-    
-    with open(sql_file, 'r') as file:   # Read the SQL file
-        sql_query = file.read()
-    
-    cursor = conn.cursor()
-    cursor.execute(sql_query)
-    rows = cursor.fetchall()    # Fetch all rows from the executed query
-    colnames = [desc[0] for desc in cursor.description] # Get column names from the cursor
-    
-    # Close the cursor and connection
-    cursor.close()
-    conn.close()
-    
-    return pd.DataFrame(rows, columns=colnames) # Create a Pandas DataFrame from the fetched data
-
-def save_to_db(df: pd.DataFrame, table_name: str) -> None:
-    """Save dataframe to database"""
-    conn = get_db_connection()
-    
+def save_to_db(df: pd.DataFrame, table_name: str, key_columns: tuple[str, ...] = ('id',)) -> None:
+    """Save dataframe to database, rows are COPYed into a staging table and merged so the table keeps its constraints"""
     try:
-        df.to_sql(table_name, get_connection_string(), if_exists='replace', index=False)
+        with connection() as conn:  # Pooled, committed or rolled back at the end of the block
+            bulk_upsert(conn, df, table_name, key_columns, mode='sync')   # Rows missing from df are deleted, like a replace
         print(f"Data successfully saved to {table_name} table")
     except Exception as e:
         print(f"Error saving to database: {e}")
-    finally:
-        conn.close()
 
 
-def assign_data(df: pd.DataFrame, filter_condition: bool, id_column: str, columns_to_assign: dict) -> pd.DataFrame:
-    """Helper function to assign data to dataframe rows matching a condition"""
-    for col_name, value in columns_to_assign.items():
-        df.loc[filter_condition, col_name] = value
-    return df
+NUTS_MACRO_AREAS = ('ITC', 'ITD', 'ITE', 'ITF', 'ITG', 'ITH', 'ITI')   # NUTS 1 macro-areas (2006 and 2010 codes)
+COMUNE_CODE_LEN = 3     # Commune codes are 6 digits, the first three identify the province
 
-def process_geographic_hierarchy(df: pd.DataFrame, searchId: str) -> pd.DataFrame:
+def build_hierarchy_index(df: pd.DataFrame, searchId: str | Iterable[str] = NUTS_MACRO_AREAS) -> tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    """
+    Build the region, province and commune-prefix indexes of the location hierarchy in one pass
+    Regions: macro-area id + 1 character (e.g., ITC3)
+    Provinces: region id + 1 character (e.g., ITC31)
+    Prefixes: first three digits of the communes named like a province (e.g., Genova 010025 -> 010)
+    Every frame is sorted in search order (macro-area, region, province), so later rows win on conflicts
+    """
+    searchIds = [searchId] if isinstance(searchId, str) else list(searchId)
+    ids = df['id'].astype(str)
+    parent_ids = ids.str[:-1]   # Regions and provinces are their parent id + 1 character
+
+    # Step 1: regions, ordered by macro-area and then by position in the dataframe
+    area_rank = pd.Series(range(len(searchIds)), index=searchIds)
+    area_rank = area_rank[~area_rank.index.duplicated()]
+    regions = pd.DataFrame({'region_id': ids, 'region_name': df['nome'], 'rank': parent_ids.map(area_rank)})
+    regions = regions.dropna(subset=['rank']).sort_values('rank', kind='stable')
+    regions = regions.drop_duplicates('region_id')[['region_id', 'region_name']].reset_index(drop=True)
+
+    # Step 2: provinces, ordered by region and then by position in the dataframe
+    region_rank = pd.Series(regions.index, index=regions['region_id'])
+    provinces = pd.DataFrame({'province_id': ids, 'province_name': df['nome'],
+                              'region_id': parent_ids, 'rank': parent_ids.map(region_rank)})
+    provinces = provinces.dropna(subset=['rank']).sort_values('rank', kind='stable')
+    provinces = provinces.merge(regions, on='region_id', how='left', sort=False)
+    provinces = provinces[['province_id', 'province_name', 'region_id', 'region_name']]
+
+    # Step 3: commune prefixes, found by searching the communes named like each province
+    is_commune = ids.str.isdigit() & (ids.str.len() >= COMUNE_CODE_LEN * 2)
+    main_communes = pd.DataFrame({'province_name': df.loc[is_commune, 'nome'],
+                                  'prefix': ids[is_commune].str[:COMUNE_CODE_LEN]})
+    prefixes = provinces.reset_index(names='rank').merge(main_communes, on='province_name', how='inner', sort=False)
+    prefixes = prefixes.sort_values('rank', kind='stable').drop(columns='rank').reset_index(drop=True)
+
+    return regions, provinces, prefixes
+
+def process_geographic_hierarchy(df: pd.DataFrame, searchId: str | Iterable[str] = NUTS_MACRO_AREAS) -> pd.DataFrame:
     """
-    searchid = # Starting search string (macroregion id ex: ITC For north West Italy)
+    searchid = # Starting search string or list of them (macroregion id ex: ITC For north West Italy), defaults to every macro-area
     Process regions, provinces, and communes in the dataframe
     Regions: ITC + 1 character (e.g., ITC3)
     Provinces: Region code + 1 character (e.g., ITC3)
     Communes: Numbers found by searching province's name, first three numbers indicate province
+    The indexes are built once and every column is assigned with a vectorized pass per level
     """
     # Add columns to the dataframe
     hierarchy_columns = ['Codice Regione', 'Codice Provincia', 'Codice Comune', 
                          'Regione', 'Provincia', 'Comune', 'Latitudine', 'Longitudine']
     for col in hierarchy_columns:
         df[col] = None
-    
-    # Step 1: Process regions
-    comuneCodeLen = 3
-    region_rows = df.loc[(df['id'].str.len() == len(searchId) + 1) & (df['id'].str.startswith(searchId))]
-    
-    # Process each region found
-    for _, region_row in region_rows.iterrows():
-        region_id = region_row['id']
-        region_name = region_row['nome']
-        
-        # Assign region data
-        assign_data(df, df['id'] == region_id, 'id', {
-            'Regione': region_name,
-            'Codice Regione': region_id
-        })
-        
-        # Step 2: Process provinces for this region
-        province_rows = df.loc[(df['id'].str.len() == len(region_id) + 1) & 
-                               (df['id'].str.startswith(region_id))]
-        
-        # Process each province found
-        for _, province_row in province_rows.iterrows():
-            province_id = province_row['id']
-            province_name = province_row['nome']
-            
-            # Assign province data
-            assign_data(df, df['id'] == province_id, 'id', {
-                'Provincia': province_name,
-                'Codice Provincia': province_id,
-                'Codice Regione': region_id
-            })
-            
-            # Step 3: Find communes for this province by searching for province name
-            main_com_rows = df.loc[df['nome'] == province_name]
-            
-            for _, main_com_row in main_com_rows.iterrows():
-                commune_id = main_com_row['id']
-                
-                # Skip if this is the province ID itself
-                if commune_id == province_id:
-                    continue
-                    
-                # Extract the first three digits to use as the commune prefix
-                if commune_id.isdigit() and len(commune_id) >= comuneCodeLen*2:
-                    province_search_id = commune_id[:comuneCodeLen]
-                    
-                    # Find all communes of this province
-                    commune_rows = df.loc[df['id'].str.startswith(province_search_id) & 
-                                          (df['id'].str.isdigit())]
-                    
-                    # Process each commune found
-                    for _, commune_row in commune_rows.iterrows():
-                        commune_id = commune_row['id']
-                        commune_name = commune_row['nome']
-                        
-                        # Assign commune data
-                        assign_data(df, df['id'] == commune_id, 'id', {
-                            'Comune': commune_name,
-                            'Codice Comune': commune_id,
-                            'Codice Provincia': province_id,
-                            'Codice Regione': region_id,
-                            'Provincia': province_name,
-                            'Regione': region_name
-                        })
-    
+
+    regions, provinces, prefixes = build_hierarchy_index(df, searchId)
+    ids = df['id'].astype(str)
+
+    # Step 1: assign region data
+    region_rows = ids.isin(regions['region_id'])
+    df.loc[region_rows, 'Regione'] = df.loc[region_rows, 'nome']
+    df.loc[region_rows, 'Codice Regione'] = ids[region_rows]
+
+    # Step 2: assign province data
+    province_index = provinces.drop_duplicates('province_id', keep='last').set_index('province_id')
+    province_rows = ids.isin(province_index.index)
+    df.loc[province_rows, 'Provincia'] = df.loc[province_rows, 'nome']
+    df.loc[province_rows, 'Codice Provincia'] = ids[province_rows]
+    df.loc[province_rows, 'Codice Regione'] = ids[province_rows].map(province_index['region_id'])
+
+    # Step 3: assign commune data through the prefix index (the last province found wins, as in the search order)
+    prefix_index = prefixes.drop_duplicates('prefix', keep='last').set_index('prefix')
+    commune_prefix = ids.str[:COMUNE_CODE_LEN].where(ids.str.isdigit())
+    commune_rows = commune_prefix.isin(prefix_index.index)
+    matched = commune_prefix[commune_rows]
+    df.loc[commune_rows, 'Comune'] = df.loc[commune_rows, 'nome']
+    df.loc[commune_rows, 'Codice Comune'] = ids[commune_rows]
+    df.loc[commune_rows, 'Codice Provincia'] = matched.map(prefix_index['province_id'])
+    df.loc[commune_rows, 'Codice Regione'] = matched.map(prefix_index['region_id'])
+    df.loc[commune_rows, 'Provincia'] = matched.map(prefix_index['province_name'])
+    df.loc[commune_rows, 'Regione'] = matched.map(prefix_index['region_name'])
+
     return df
 
-# Function to get coordinates using OpenStreetMap Nominatim API
-def get_coordinates(comune: str, provincia: str="Liguria", nazione: str="Italy") -> tuple[float, float]:
-    """Get geographic coordinates for a location using Nominatim API"""
+# Function to get coordinates using OpenStreetMap Nominatim API (or another geocoding backend)
+def get_coordinates(comune: str, provincia: str="Liguria", nazione: str="Italy", cache: GeocodingCache = None,
+                    backend: GeocoderBackend = None, codice: str = None) -> tuple[float, float]:
+    """Get geographic coordinates for a location using Nominatim API, the cache (if given) is checked first"""
     if pd.notna(comune) and comune != "":
-        search_query = f"{comune}, {provincia}, {nazione}"  # Format the search query
-        url = f"https://nominatim.openstreetmap.org/search?q={search_query}&format=json&limit=1"
-        
+        if cache is not None:
+            cached = cache.get(comune, provincia, nazione, codice)
+            if cached is not None:  # Hit, (None, None) when the name was not found on a previous run
+                return cached
+
         try:
-            # Add a delay to respect API rate limits
-            time.sleep(1)
-            response = requests.get(url, headers={"User-Agent": "CommuneCoordinatesFinder/1.0"})
-            data = response.json()
-            
-            if data and len(data) > 0:
-                return float(data[0]['lat']), float(data[0]['lon'])
+            # The backend respects its own API rate limit
+            lat, lon = (backend or default_backend()).geocode(comune, provincia, nazione, codice)
+            if cache is not None:   # Negative results are cached too, errors are not
+                cache.set(comune, provincia, nazione, lat, lon, codice=codice)
+            return lat, lon
         except Exception as e:
             print(f"Error fetching coordinates for {comune}: {e}")
     
     return None, None
 
-def add_coordinates(df: pd.DataFrame) -> pd.DataFrame:
-    """Add geographic coordinates to communes in the dataframe"""
-    for index, row in df.iterrows():
-        if pd.notna(row['Comune']) and row['Comune'] != "":
-            # Get province name if available
-            provincia = row['Regione']
-            if pd.notna(row['Provincia']) and row['Provincia'] != "":
-                provincia = row['Provincia']
-            
-            # Get coordinates
-            #print(f"Getting coordinates for {row['Comune']}")  # Uncomment to see progress
-            lat, lon = get_coordinates(row['Comune'], provincia)
-            
-            # Update the dataframe
-            df.at[index, 'Latitudine'] = lat
-            df.at[index, 'Longitudine'] = lon
+def add_coordinates(df: pd.DataFrame, cache: GeocodingCache = None, engine: GeocodingEngine = None) -> pd.DataFrame:
+    """Add geographic coordinates to communes in the dataframe, only names missing from the cache go to the network"""
+    engine = engine or GeocodingEngine(cache=cache)
+    commune_rows = df['Comune'].notna() & (df['Comune'] != "")
+
+    # Get province name if available, the region otherwise
+    provincia = df['Provincia'].where(df['Provincia'].notna() & (df['Provincia'] != ""), df['Regione'])
+    # The ISTAT code goes with the names, offline backends resolve it before matching the name
+    queries = [(comune, prov, "Italy", codice) for comune, prov, codice
+               in zip(df.loc[commune_rows, 'Comune'], provincia[commune_rows], df.loc[commune_rows, 'Codice Comune'])]
+
+    # Get coordinates of the distinct names concurrently, then update the dataframe
+    coordinates = engine.geocode_many(queries)
+    df.loc[commune_rows, 'Latitudine'] = [coordinates[query][0] for query in queries]
+    df.loc[commune_rows, 'Longitudine'] = [coordinates[query][1] for query in queries]
 
     return df
 
-def fill_missing_coordinates(df: pd.DataFrame) -> pd.DataFrame:
-    """Fill missing coordinates for regions and provinces"""
-    missing_coord_rows = df.loc[df['Latitudine'].isnull()]
-    
-    for idx, row in missing_coord_rows.iterrows():
-        if pd.notna(row['Provincia']):
-            # Try to find coordinates from the commune with the same name as the province
-            matching_commune = df.loc[df['Comune'] == row['Provincia']]
-            
-            if not matching_commune.empty:
-                lat = matching_commune.iloc[0]['Latitudine']
-                lon = matching_commune.iloc[0]['Longitudine']
-                
-                if pd.notna(lat) and pd.notna(lon):
-                    df.at[idx, 'Latitudine'] = lat
-                    df.at[idx, 'Longitudine'] = lon
-    
+FILL_STRATEGIES = ('capital', 'mean', 'weighted', 'bbox')
+
+def aggregate_coordinates(lat: pd.Series, lon: pd.Series, keys: pd.Series, strategy: str, weights: pd.Series = None) -> pd.DataFrame:
+    """Aggregate the coordinates of the communes by key: mean, weighted mean or center of the bounding box"""
+    coords = pd.DataFrame({'lat': lat, 'lon': lon, 'key': keys}).dropna()
+    grouped = coords.groupby('key')[['lat', 'lon']]
+    if strategy == 'mean':
+        return grouped.mean()
+    if strategy == 'bbox':
+        return (grouped.min() + grouped.max()) / 2
+    # Population-weighted centroid, communes without a weight are left out
+    coords['w'] = pd.to_numeric(weights, errors='coerce')
+    coords = coords.loc[coords['w'] > 0]
+    weighted = coords[['lat', 'lon']].mul(coords['w'], axis=0).groupby(coords['key']).sum()
+    return weighted.div(coords.groupby('key')['w'].sum(), axis=0)
+
+def fill_missing_coordinates(df: pd.DataFrame, strategy: str = 'capital', weights: str | pd.Series = 'Popolazione') -> pd.DataFrame:
+    """
+    Fill missing coordinates for regions and provinces (and for communes that were not geocoded)
+    strategy = 'capital': coordinates of the commune with the same name as the province (provinces only)
+               'mean': mean of the communes of each province, region and macro-area
+               'weighted': mean of the communes weighted by population (weights = column name or series)
+               'bbox': center of the bounding box of the communes
+    """
+    if strategy not in FILL_STRATEGIES:
+        raise ValueError(f"Unknown strategy {strategy}, expected one of {FILL_STRATEGIES}")
+    missing = df['Latitudine'].isnull()
+
+    if strategy == 'capital':
+        # Try to find coordinates from the (first) commune with the same name as the province
+        capitals = df.loc[df['Comune'].notna(), ['Comune', 'Latitudine', 'Longitudine']].drop_duplicates('Comune')
+        capitals = capitals.loc[capitals['Latitudine'].notna() & capitals['Longitudine'].notna()].set_index('Comune')
+        targets = df['Provincia'].where(missing)
+    else:
+        lat = pd.to_numeric(df['Latitudine'], errors='coerce')
+        lon = pd.to_numeric(df['Longitudine'], errors='coerce')
+        if strategy == 'weighted':
+            weights = df[weights] if isinstance(weights, str) and weights in df.columns else weights
+            if not isinstance(weights, pd.Series):
+                raise ValueError(f"The weighted strategy needs a population column or series, got {weights}")
+
+        # Communes give coordinates to their province, region and macro-area (the region code without its last character)
+        communes = df['Comune'].notna()
+        region_keys = df['Codice Regione'].where(communes)
+        capitals = pd.concat([aggregate_coordinates(lat, lon, df['Codice Provincia'].where(communes), strategy, weights),
+                              aggregate_coordinates(lat, lon, region_keys, strategy, weights),
+                              aggregate_coordinates(lat, lon, region_keys.str[:-1], strategy, weights)])
+        capitals.columns = ['Latitudine', 'Longitudine']
+
+        # Every row takes the coordinates of the smallest area containing it: province, then region, then itself
+        id_column = 'Codice ISTAT' if 'Codice ISTAT' in df.columns else 'id'
+        targets = df['Codice Provincia'].fillna(df['Codice Regione']).fillna(df[id_column]).where(missing)
+
+    filled = targets.isin(capitals.index)
+    df.loc[filled, 'Latitudine'] = targets[filled].map(capitals['Latitudine'])
+    df.loc[filled, 'Longitudine'] = targets[filled].map(capitals['Longitudine'])
+
     return df
 
 
-def main(sqlRequestPath: str) -> None:
+def main(sqlRequestPath: str, report: RunReport = None) -> None:
+    """report = run report the stages are measured in, a new one saved at the end when missing"""
+    own_report = report is None
+    report = report or RunReport('hierarchy')
     searchId = 'ITC' # Starting search string
-    df = fetch_data_from_db(sqlRequestPath)
-    df = process_geographic_hierarchy(df,searchId)
+    with report.stage('fetch') as stage:
+        df = fetch_data_from_db(sqlRequestPath)
+        stage.rows_out = len(df)
+    with report.stage('hierarchy', rows_in=len(df)) as stage:
+        df = process_geographic_hierarchy(df,searchId)
+        stage.rows_out = len(df)
     
     # Print summary
     print(f"Processed {df['Codice Regione'].notna().sum()} regions")
     print(f"Processed {df['Codice Provincia'].notna().sum()} provinces")
     print(f"Processed {df['Codice Comune'].notna().sum()} communes")
     
-    # Clean up dataframe
-    df = df.drop(columns=['nome'])
-    df = df.rename(columns={'id': 'Codice ISTAT'})
-    df = add_coordinates(df)
-    df = fill_missing_coordinates(df)
+    # Same schema as the pipeline: id, nome and parent_ID (heriarcy_location imports this module, so it is imported here)
+    from heriarcy_location import process_geographic_hierarchy as assign_parents
+    df = assign_parents(df)
+    with report.stage('geocoding', rows_in=len(df)) as stage, GeocodingCache() as cache:
+        df = add_coordinates(df, cache)
+        stage.rows_out = int(df['Latitudine'].notna().sum())
+    with report.stage('fill_coordinates', rows_in=len(df)) as stage:
+        df = fill_missing_coordinates(df)
+        stage.rows_out = int(df['Latitudine'].notna().sum())
 
     # Print summary
     print(f"Processed {df['Latitudine'].notna().sum()} coordinates")
@@ -222,9 +238,12 @@ def main(sqlRequestPath: str) -> None:
     #print("Coordinates added and saved to 'gerarchia luogo con coordinate.csv'")
         
     # Save to database
-    save_to_db(df, "gerarchia_luogo")
+    with report.stage('save', rows_in=len(df)):
+        save_to_db(df[HIERARCHY_COLUMNS + ['Latitudine', 'Longitudine']], HIERARCHY_TABLE)
+    if own_report:
+        report.save()
 
 
-    if __name__ == "__main__":
-        sqlRequestPath = 'Progetto-industriale\src\script_sql\select_location_hierarchy.sql'
-        main(sqlRequestPath)
\ No newline at end of file
+if __name__ == "__main__":
+    sqlRequestPath = 'script_sql//select_location_hierarchy.sql'
+    main(sqlRequestPath)
@@ -0,0 +1,283 @@
+import gzip
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from os import getenv
+from typing import BinaryIO
+import requests
+from geocoder import TokenBucket
+from instrumentation import count
+
+# On-disk cache of the SDMX REST responses (data and structures), so that rerunning the notebooks or the importer
+# doesn't download the same dataflow again. Bodies are stored gzip compressed and addressed by the sha256 of their
+# content (identical responses of different URLs share the file), the index maps URL + Accept to the body and keeps
+# the ETag/Last-Modified validators used to revalidate it
+#
+# Modes:
+#   use      serve from the cache, revalidating with the server (304 = no download)
+#   offline  serve only from the cache, never touch the network
+#   refresh  always download again and replace the cached body
+#   off      plain streaming request, nothing is read or stored
+
+DEFAULT_CACHE_DIR = os.path.join('csv', 'http_cache')
+DEFAULT_MAX_MB = 2048
+MODES = ('use', 'offline', 'refresh', 'off')
+BLOCK_SIZE = 1 << 20
+
+
+def cache_key(url: str, accept: str) -> str:
+    """Key of a request: the same URL with another Accept is another response"""
+    return hashlib.sha256(f"{url}\n{accept or ''}".encode()).hexdigest()
+
+
+class PinnedBlob(gzip.GzipFile):
+    """Open body of the cache, its blob is kept out of the eviction until it is closed"""
+
+    def __init__(self, path: str, release):
+        super().__init__(path, 'rb')
+        self.release = release
+
+    def close(self) -> None:
+        try:
+            super().close()
+        finally:
+            if self.release is not None:
+                self.release()
+                self.release = None
+
+
+class HttpCache:
+    """Content-addressed, compressed cache of GET responses with revalidation, LRU size cap and offline mode"""
+
+    def __init__(self, path: str = None, max_mb: float = None, mode: str = None, max_age: float = None,
+                 session: requests.Session = None, limiter: TokenBucket = None):
+        """
+        path = folder of the cache (index + bodies)
+        max_mb = size cap of the compressed bodies, the least recently used are evicted above it
+        mode = use, offline, refresh or off (see above)
+        max_age = seconds a cached response is served without revalidating it (None = always revalidate)
+        limiter = rate limit of the host, a token is taken before every request that goes to the network
+        """
+        self.path = path or getenv('http_cache_dir', DEFAULT_CACHE_DIR)
+        self.max_bytes = int(float(max_mb or getenv('http_cache_max_mb', DEFAULT_MAX_MB)) * 1024 * 1024)
+        self.mode = mode or getenv('http_cache_mode', 'use')
+        if self.mode not in MODES:
+            raise ValueError(f"Unknown cache mode {self.mode}, use one of {', '.join(MODES)}")
+        self.max_age = max_age
+        self.session = session or requests.Session()
+        self.limiter = limiter
+        self.lock = threading.Lock()    # The importer scheduler shares one cache between its workers
+        self.pins = {}                  # digest -> bodies open by the workers, never evicted
+
+        os.makedirs(os.path.join(self.path, 'objects'), exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(self.path, 'index.sqlite'), check_same_thread=False)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS blobs (
+                digest TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                url TEXT NOT NULL,
+                accept TEXT,
+                digest TEXT NOT NULL REFERENCES blobs (digest),
+                etag TEXT,
+                last_modified TEXT,
+                fetched_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS blobs_last_used ON blobs (last_used);
+        """)
+        self.conn.commit()
+
+    def _blob_path(self, digest: str) -> str:
+        return os.path.join(self.path, 'objects', digest[:2], f"{digest}.gz")
+
+    def _lookup(self, key: str) -> tuple | None:
+        with self.lock:
+            row = self.conn.execute("SELECT digest, etag, last_modified, fetched_at FROM entries WHERE key = ?",
+                                    (key,)).fetchone()
+        if row is not None and not os.path.exists(self._blob_path(row[0])):    # Body deleted by hand
+            return None
+        return row
+
+    def _touch(self, key: str, digest: str, revalidated: bool = False) -> None:
+        with self.lock:
+            self.conn.execute("UPDATE blobs SET last_used = ? WHERE digest = ?", (time.time(), digest))
+            if revalidated:
+                self.conn.execute("UPDATE entries SET fetched_at = ? WHERE key = ?", (time.time(), key))
+            self.conn.commit()
+
+    def _store(self, response: requests.Response, key: str, url: str, accept: str) -> str:
+        """Stream the body to a compressed temporary file, then move it to its content address"""
+        digest = hashlib.sha256()
+        tmp_path = os.path.join(self.path, 'objects', f"tmp-{threading.get_ident()}-{time.time_ns()}.gz")
+        try:
+            with gzip.open(tmp_path, 'wb', compresslevel=6) as blob:
+                for block in response.iter_content(chunk_size=BLOCK_SIZE):
+                    digest.update(block)
+                    blob.write(block)
+            digest = digest.hexdigest()
+            blob_path = self._blob_path(digest)
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            os.replace(tmp_path, blob_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO blobs VALUES (?, ?, ?)",
+                              (digest, os.path.getsize(blob_path), time.time()))
+            self.conn.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                              (key, url, accept, digest, response.headers.get('ETag'),
+                               response.headers.get('Last-Modified'), time.time()))
+            self.conn.commit()
+        self.evict(keep={digest})   # The body just written is about to be read, even when it is larger than the cap
+        return digest
+
+    def fetch(self, url: str, headers: dict = None, timeout: tuple = (30, 600)) -> str:
+        """Make sure the response of a GET is cached and return the digest of its body"""
+        headers = dict(headers or {})
+        accept = headers.get('Accept')
+        key = cache_key(url, accept)
+        cached = self._lookup(key) if self.mode != 'refresh' else None
+
+        if cached is not None:
+            digest, etag, last_modified, fetched_at = cached
+            if self.mode == 'offline' or (self.max_age is not None and time.time() - fetched_at < self.max_age):
+                self._touch(key, digest)
+                count('http_cache_hits')
+                return digest
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+        elif self.mode == 'offline':
+            raise FileNotFoundError(f"{url} is not in the cache (offline mode)")
+
+        self._wait_turn()
+        count('http_calls')
+        with self.session.get(url, headers=headers, stream=True, timeout=timeout) as response:
+            if response.status_code == 304 and cached is not None:
+                self._touch(key, cached[0], revalidated=True)
+                count('http_cache_hits')
+                return cached[0]
+            if response.status_code != 200:
+                print(f"Error: Status code {response.status_code}")
+                print(response.text[:1000])
+                response.raise_for_status()
+            return self._store(response, key, url, accept)
+
+    def open(self, url: str, headers: dict = None) -> BinaryIO:
+        """Binary stream of the response body, from the cache when possible"""
+        if self.mode == 'off':
+            self._wait_turn()
+            count('http_calls')
+            response = self.session.get(url, headers=headers, stream=True, timeout=(30, 600))
+            if response.status_code != 200:
+                print(f"Error: Status code {response.status_code}")
+                print(response.text[:1000])
+                response.raise_for_status()
+            response.raw.decode_content = True  # Let urllib3 decompress gzip/deflate while reading
+            return response.raw
+        for attempt in range(2):
+            digest = self.fetch(url, headers)
+            self._pin(digest)
+            try:
+                return PinnedBlob(self._blob_path(digest), lambda: self._unpin(digest))
+            except FileNotFoundError:   # Evicted by another worker between fetch and open, download it again
+                self._unpin(digest)
+                if attempt:
+                    raise
+
+    def _wait_turn(self) -> None:
+        """Respect the rate limit of the host"""
+        if self.limiter is not None:
+            self.limiter.acquire()
+
+    def _pin(self, digest: str) -> None:
+        with self.lock:
+            self.pins[digest] = self.pins.get(digest, 0) + 1
+
+    def _unpin(self, digest: str) -> None:
+        with self.lock:
+            self.pins[digest] -= 1
+            if not self.pins[digest]:
+                del self.pins[digest]
+
+    def get_bytes(self, url: str, headers: dict = None) -> bytes:
+        """Whole response body, for the small structure/metadata requests"""
+        with self.open(url, headers) as stream:
+            return stream.read()
+
+    def size(self) -> int:
+        """Bytes used by the compressed bodies"""
+        with self.lock:
+            return self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+
+    def evict(self, max_bytes: int = None, keep: set[str] = None) -> int:
+        """
+        Delete the least recently used bodies (and their entries) until the cache fits the cap
+        keep = digests not to evict, besides the bodies open by the workers
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        evicted = 0
+        with self.lock:
+            total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+            if total <= max_bytes:
+                return 0
+            for digest, size in self.conn.execute("SELECT digest, size FROM blobs ORDER BY last_used").fetchall():
+                if total <= max_bytes:
+                    break
+                if digest in self.pins or digest in (keep or ()):
+                    continue
+                self.conn.execute("DELETE FROM entries WHERE digest = ?", (digest,))
+                self.conn.execute("DELETE FROM blobs WHERE digest = ?", (digest,))
+                if os.path.exists(self._blob_path(digest)):
+                    os.remove(self._blob_path(digest))
+                total -= size
+                evicted += 1
+            self.conn.commit()
+        if evicted:
+            print(f"Evicted {evicted} responses from the HTTP cache")
+        return evicted
+
+    def invalidate(self, url_prefix: str = None) -> int:
+        """Forget the responses whose URL starts with url_prefix (all of them without it), returns how many"""
+        with self.lock:
+            prefix = url_prefix or ''
+            deleted = self.conn.execute("DELETE FROM entries WHERE substr(url, 1, ?) = ?", (len(prefix), prefix)).rowcount
+            orphans = [row[0] for row in self.conn.execute(
+                "SELECT digest FROM blobs WHERE digest NOT IN (SELECT digest FROM entries)").fetchall()
+                       if row[0] not in self.pins]     # The open bodies go at the next eviction
+            self.conn.executemany("DELETE FROM blobs WHERE digest = ?", [(digest,) for digest in orphans])
+            self.conn.commit()
+        for digest in orphans:
+            if os.path.exists(self._blob_path(digest)):
+                os.remove(self._blob_path(digest))
+        return deleted
+
+    def close(self) -> None:
+        """Close the cache index"""
+        self.session.close()
+        self.conn.close()
+
+    def __enter__(self) -> 'HttpCache':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+_default_cache = None
+_default_lock = threading.Lock()
+
+def get_default_cache() -> HttpCache:
+    """Cache shared by the whole process, configured from .env"""
+    global _default_cache
+    with _default_lock:
+        if _default_cache is None:
+            _default_cache = HttpCache()
+        return _default_cache
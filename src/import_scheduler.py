@@ -0,0 +1,142 @@
+import argparse
+import json
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import product
+from urllib.parse import urlparse
+from psycopg2.pool import ThreadedConnectionPool
+from geocoder import TokenBucket
+from db import create_pool
+from http_cache import HttpCache
+from load_state import clear_checkpoints, get_done_slices, save_checkpoint
+from indicators import update_indicators
+from location_rollup import update_rollups
+from reporting_layer import refresh_reports
+from sdmx_importer import SDMX_DATA_URL, get_table_name, import_dataflow
+
+# Scheduler of the SDMX imports: a job manifest (dataflows x filter slices x time windows) is expanded into slices
+# that are downloaded concurrently, with a rate limit per host and a shared connection pool. Every finished slice
+# is checkpointed, so rerunning the manifest after a failure only retries the failed slices
+#
+# Manifest example:
+# {
+#   "run_id": "turismo_nightly",            (optional, the file name by default)
+#   "max_workers": 4,
+#   "host_rate": 1,                         (requests/s per host)
+#   "defaults": {"format": "csv", "incremental": false, "lookback": 3},
+#   "jobs": [
+#     {"dataflow": "122_54", "table": "facts_turismo",
+#      "filters": ["....ITC31......", "....ITC32......"],
+#      "windows": [["2016-01-01", "2019-12-31"], ["2020-01-01", null]]}
+#   ]
+# }
+
+DEFAULT_WORKERS = 4
+DEFAULT_HOST_RATE = 1.0
+MAX_ATTEMPTS = 3
+
+
+def window_timeframe(window) -> str | None:
+    """Query string of a [start, end] window, either side can be null"""
+    if not window:
+        return None
+    start, end = (list(window) + [None])[:2]
+    params = ([f"startPeriod={start}"] if start else []) + ([f"endPeriod={end}"] if end else [])
+    return "&".join(params) or None
+
+def expand_manifest(manifest: dict) -> list[dict]:
+    """Expand every job into its slices: one per filter and time window"""
+    slices = []
+    for job in manifest['jobs']:
+        options = {**manifest.get('defaults', {}), **job}
+        filters = options.pop('filters', None) or [options.pop('filter', None)]
+        windows = options.pop('windows', None) or [None]
+        for filter, window in product(filters, windows):
+            timeframe = window_timeframe(window) or options.get('timeframe')
+            slices.append({**options, 'filter': filter, 'timeframe': timeframe,
+                           'slice_id': f"{options['dataflow']}|{filter or ''}|{timeframe or ''}"})
+    return slices
+
+def run_slice(task: dict, pool: ThreadedConnectionPool, cache: HttpCache) -> int:
+    """Import a slice with a pooled connection, retrying with backoff (and jitter) when it fails"""
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        conn = pool.getconn()
+        try:
+            return import_dataflow(task['dataflow'], task['filter'], task['timeframe'], task.get('format', 'csv'),
+                                   task.get('table'), incremental=task.get('incremental', False),
+                                   lookback=task.get('lookback', 3), conn=conn, cache=cache, refresh=False)
+        except Exception as e:
+            conn.rollback()
+            if attempt == MAX_ATTEMPTS:
+                raise
+            print(f"Slice {task['slice_id']} failed (attempt {attempt}): {e}")
+            time.sleep(2 ** attempt + random.uniform(0, 1))
+        finally:
+            pool.putconn(conn)
+
+def run_manifest(manifest_path: str, restart: bool = False, max_workers: int = None) -> dict[str, int]:
+    """Run every slice of a manifest that isn't done yet and return {slice_id: rows loaded}"""
+    with open(manifest_path, 'r') as file:
+        manifest = json.load(file)
+    run_id = manifest.get('run_id') or os.path.splitext(os.path.basename(manifest_path))[0]
+    max_workers = max_workers or manifest.get('max_workers', DEFAULT_WORKERS)
+    # Every request the workers send to the SDMX host (retries included) takes a token of its rate limit
+    limiter = TokenBucket(manifest.get('host_rate', DEFAULT_HOST_RATE))
+    print(f"Rate limit of {urlparse(SDMX_DATA_URL).netloc}: {limiter.rate} requests/s")
+    cache = HttpCache(limiter=limiter)
+
+    pool = create_pool(max_workers + 1)
+    results, failed = {}, []
+    try:
+        conn = pool.getconn()
+        if restart:
+            clear_checkpoints(conn, run_id)
+        done = get_done_slices(conn, run_id)
+        pool.putconn(conn)
+
+        pending = [task for task in expand_manifest(manifest) if task['slice_id'] not in done]
+        print(f"Run {run_id}: {len(pending)} slices to load, {len(done)} already done")
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {}
+            for task in pending:
+                futures[executor.submit(run_slice, task, pool, cache)] = task
+            for future in as_completed(futures):
+                task = futures[future]
+                conn = pool.getconn()
+                try:
+                    results[task['slice_id']] = future.result()
+                    save_checkpoint(conn, run_id, task['slice_id'], 'done', results[task['slice_id']])
+                except Exception as e:
+                    failed.append(task['slice_id'])
+                    print(f"Error loading slice {task['slice_id']}: {e}")
+                    save_checkpoint(conn, run_id, task['slice_id'], 'failed', error=str(e))
+                finally:
+                    pool.putconn(conn)
+
+        # The reports, the rollup cubes and the indicators are refreshed once per table at the end, not after every
+        # slice
+        loaded_tables = {task.get('table') or get_table_name(task['dataflow']) for task in pending
+                         if results.get(task['slice_id'])}
+        conn = pool.getconn()
+        for table_name in sorted(loaded_tables):
+            refresh_reports(conn, table_name)
+            update_rollups(conn, table_name)
+            update_indicators(conn, table_name)
+        pool.putconn(conn)
+    finally:
+        pool.closeall()
+        cache.close()
+
+    print(f"Run {run_id}: {len(results)} slices loaded ({sum(results.values())} rows), {len(failed)} failed")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Download several SDMX dataflows/slices concurrently into Postgres")
+    parser.add_argument('manifest', help="JSON job manifest")
+    parser.add_argument('--restart', action='store_true', help="ignore the checkpoints and reload every slice")
+    parser.add_argument('--workers', type=int, help="concurrent downloads (overrides the manifest)")
+    args = parser.parse_args()
+    run_manifest(args.manifest, args.restart, args.workers)
@@ -0,0 +1,211 @@
+import argparse
+import time
+import numpy as np
+import pandas as pd
+import psycopg2
+from psycopg2 import sql
+from bulk_loader import copy_frame
+from db import get_db_connection, iter_query
+from location_rollup import TOTAL_CODES
+from reporting_layer import FACT_TABLES, relation_exists
+
+# Derived tourism indicators (occupancy, average length of stay, share of foreign guests, ...) computed in pandas
+# instead of DAX on every refresh: the fact rows of the input DATA_TYPEs are pivoted to one column per measure
+# (arrivals, nights, beds, ...) for every area, accommodation type and period, the indicators are ratios of those
+# columns and are stored in a narrow table (one row per indicator). After a load only the years of the changed
+# periods are computed again
+
+INDICATOR_TABLE = 'indicators_turismo'
+KEY_COLUMNS = ['REF_AREA', 'TYPE_ACCOMMODATION', 'FREQ', 'TIME_PERIOD']
+
+# Fact tables read and their column names when they differ from the concepts ({concept: column}). The capacity table
+# is the one named after the title of 122_54, where the loads made before FACT_TABLES went: a measure of a key is
+# taken from the first table that has it, so a dataflow loaded in both tables isn't counted twice
+FACTS = {
+    FACT_TABLES['122_54']: {},
+    'Capacity_of_collective_accommodation_establishments': {},
+}
+
+# Measure -> fact rows it sums. The capacity is published once a year, the annual measures are also used for the
+# months of that year. The dimensions not in KEY_COLUMNS or in the filter are fixed to their total code (TOTAL_CODES)
+INPUTS = {
+    'arrivals': {'filter': {'DATA_TYPE': 'AR', 'COUNTRY_RES_GUESTS': 'WORLD'}},
+    'nights': {'filter': {'DATA_TYPE': 'NI', 'COUNTRY_RES_GUESTS': 'WORLD'}},
+    'foreign_arrivals': {'filter': {'DATA_TYPE': 'AR', 'COUNTRY_RES_GUESTS': 'WRL_X_ITA'}},
+    'foreign_nights': {'filter': {'DATA_TYPE': 'NI', 'COUNTRY_RES_GUESTS': 'WRL_X_ITA'}},
+    'beds': {'filter': {'DATA_TYPE': 'BEDS'}, 'annual': True},
+    'bedrooms': {'filter': {'DATA_TYPE': 'BED_RMS'}, 'annual': True},
+    'establishments': {'filter': {'DATA_TYPE': 'NUM_EST'}, 'annual': True},
+}
+
+# Indicator = numerator / product of the denominators * scale, 'days' is the length of the period
+INDICATORS = {
+    'average_stay': {'numerator': 'nights', 'denominator': ['arrivals']},
+    'bed_occupancy': {'numerator': 'nights', 'denominator': ['beds', 'days'], 'scale': 100},
+    'foreign_share_arrivals': {'numerator': 'foreign_arrivals', 'denominator': ['arrivals'], 'scale': 100},
+    'foreign_share_nights': {'numerator': 'foreign_nights', 'denominator': ['nights'], 'scale': 100},
+    'beds_per_establishment': {'numerator': 'beds', 'denominator': ['establishments']},
+    'beds_per_bedroom': {'numerator': 'beds', 'denominator': ['bedrooms']},
+}
+DAYS_IN_MONTH = np.array([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+
+
+def days_in_period(periods: pd.Series) -> pd.Series:
+    """Days of the yearly (2023) and monthly (2023-02) periods, NaN for the other frequencies"""
+    periods = periods.astype(str)
+    years = pd.to_numeric(periods.str[:4], errors='coerce')
+    months = pd.to_numeric(periods.str.extract(r'^\d{4}-(\d{2})$')[0], errors='coerce')
+    leap = ((years % 4 == 0) & (years % 100 != 0)) | (years % 400 == 0)
+    days = pd.Series(np.nan, index=periods.index)
+    yearly = periods.str.fullmatch(r'\d{4}')
+    days[yearly] = 365 + leap[yearly]
+    monthly = months.between(1, 12)
+    days[monthly] = DAYS_IN_MONTH[months[monthly].astype(int) - 1] + (leap[monthly] & (months[monthly] == 2))
+    return days
+
+def input_filters(columns: dict[str, str | None]) -> dict[str, dict[str, str]]:
+    """Filter of every input in a fact table: its own codes and the total code of the other dimensions the table has"""
+    totals = {concept: code for concept, code in TOTAL_CODES.items() if columns.get(concept) is not None}
+    return {measure: {**totals, **spec['filter']} for measure, spec in INPUTS.items()}
+
+def input_query(fact: str, columns: dict[str, str | None], years: list[str] = None) -> sql.Composed:
+    """SELECT of the rows of the inputs of a fact table, its columns renamed to the concepts"""
+    selected = [sql.SQL("{} AS {}").format(sql.Identifier(column), sql.Identifier(concept))
+                for concept, column in sorted(columns.items()) if column is not None]
+    filters = list(input_filters(columns).values())
+    shared = set.intersection(*(set(filter) for filter in filters))    # Columns every input filters, e.g. DATA_TYPE
+    conditions = [sql.SQL("{} = ANY({})").format(sql.Identifier(columns.get(concept) or concept),
+                                                 sql.Literal(sorted({filter[concept] for filter in filters})))
+                  for concept in sorted(shared)]
+    query = sql.SQL('SELECT {}, "OBS_VALUE" FROM {} WHERE {}').format(
+        sql.SQL(', ').join(selected), sql.Identifier(fact), sql.SQL(' AND ').join(conditions))
+    if years is not None:
+        query += sql.SQL(' AND left({}, 4) = ANY({})').format(sql.Identifier(columns['TIME_PERIOD']), sql.Literal(sorted(years)))
+    return query
+
+def fact_columns(cursor: psycopg2.extensions.cursor, fact: str) -> dict[str, str | None]:
+    """Column of every concept used by the inputs in a fact table, None when the table doesn't have it"""
+    cursor.execute("SELECT column_name FROM information_schema.columns WHERE table_schema = current_schema() "
+                   "AND table_name = %s", (fact,))
+    existing = {row[0] for row in cursor.fetchall()}
+    concepts = set(KEY_COLUMNS).union(TOTAL_CODES, *(spec['filter'] for spec in INPUTS.values()))
+    return {concept: FACTS[fact].get(concept, concept) if FACTS[fact].get(concept, concept) in existing else None
+            for concept in concepts}
+
+def read_measures(conn: psycopg2.extensions.connection, years: list[str] = None) -> pd.DataFrame:
+    """Long frame KEY_COLUMNS + measure + value, the fact rows of every input summed by key"""
+    parts = []
+    for rank, fact in enumerate(FACTS):
+        with conn.cursor() as cursor:
+            if not relation_exists(cursor, fact):
+                continue
+            columns = fact_columns(cursor, fact)
+        if any(columns[col] is None for col in KEY_COLUMNS + ['DATA_TYPE']):
+            print(f"Skipping {fact}, it doesn't have the columns {', '.join(KEY_COLUMNS + ['DATA_TYPE'])}")
+            continue
+        filters = input_filters(columns)
+        for chunk in iter_query(input_query(fact, columns, years), conn=conn):
+            chunk['OBS_VALUE'] = pd.to_numeric(chunk['OBS_VALUE'], errors='coerce')
+            for measure, filter in filters.items():
+                if any(columns[col] is None for col in filter):
+                    continue
+                mask = np.logical_and.reduce([chunk[col].to_numpy() == value for col, value in filter.items()])
+                if mask.any():
+                    parts.append(chunk.loc[mask, KEY_COLUMNS + ['OBS_VALUE']].assign(measure=measure, source=rank))
+        conn.commit()
+    if not parts:
+        return pd.DataFrame(columns=KEY_COLUMNS + ['measure', 'OBS_VALUE'])
+    measures = pd.concat(parts, ignore_index=True)
+    measures = measures.groupby(KEY_COLUMNS + ['measure', 'source'], as_index=False)['OBS_VALUE'].sum()
+    first = measures.groupby(KEY_COLUMNS + ['measure'])['source'].transform('min')     # First table of FACTS with it
+    return measures.loc[measures['source'] == first].drop(columns='source').reset_index(drop=True)
+
+def pivot_measures(measures: pd.DataFrame) -> pd.DataFrame:
+    """One column per measure, the annual measures filled in the months of their year, plus the days of the period"""
+    wide = measures.pivot_table(index=KEY_COLUMNS, columns='measure', values='OBS_VALUE', aggfunc='sum')
+    wide = wide.reindex(columns=list(INPUTS)).reset_index()
+    annual = [measure for measure, spec in INPUTS.items() if spec.get('annual')]
+    if annual and len(wide):
+        year = wide['TIME_PERIOD'].astype(str).str[:4]
+        yearly = wide.loc[wide['FREQ'] == 'A', ['REF_AREA', 'TYPE_ACCOMMODATION', 'TIME_PERIOD'] + annual]
+        yearly = yearly.rename(columns={'TIME_PERIOD': 'year'})
+        filled = wide[['REF_AREA', 'TYPE_ACCOMMODATION']].assign(year=year).merge(
+            yearly, on=['REF_AREA', 'TYPE_ACCOMMODATION', 'year'], how='left')
+        for measure in annual:
+            wide[measure] = wide[measure].fillna(pd.Series(filled[measure].to_numpy(), index=wide.index))
+    wide['days'] = days_in_period(wide['TIME_PERIOD'])
+    return wide
+
+def compute_indicators(wide: pd.DataFrame, indicators: list[str] = None) -> pd.DataFrame:
+    """Narrow frame KEY_COLUMNS + indicator + value, the keys missing a measure (or dividing by 0) are left out"""
+    values = {}
+    for name in indicators or INDICATORS:
+        spec = INDICATORS[name]
+        denominator = np.prod([wide[col].to_numpy(dtype='float64') for col in spec['denominator']], axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            values[name] = wide[spec['numerator']].to_numpy(dtype='float64') / denominator * spec.get('scale', 1)
+    narrow = wide[KEY_COLUMNS].assign(**values).melt(id_vars=KEY_COLUMNS, var_name='indicator', value_name='value')
+    return narrow.loc[np.isfinite(narrow['value'])]
+
+def ensure_indicator_table(cursor: psycopg2.extensions.cursor) -> None:
+    cursor.execute(sql.SQL("""
+        CREATE TABLE IF NOT EXISTS {table} (
+            "REF_AREA" VARCHAR(50) NOT NULL,
+            "TYPE_ACCOMMODATION" VARCHAR(50) NOT NULL,
+            "FREQ" VARCHAR(10) NOT NULL,
+            "TIME_PERIOD" VARCHAR(10) NOT NULL,
+            indicator VARCHAR(50) NOT NULL,
+            value DOUBLE PRECISION,
+            PRIMARY KEY (indicator, "REF_AREA", "TIME_PERIOD", "TYPE_ACCOMMODATION", "FREQ")
+        )
+    """).format(table=sql.Identifier(INDICATOR_TABLE)))
+    cursor.execute(sql.SQL('CREATE INDEX IF NOT EXISTS {} ON {} ("TIME_PERIOD")').format(
+        sql.Identifier(f"{INDICATOR_TABLE}_period"), sql.Identifier(INDICATOR_TABLE)))
+
+def build_indicators(conn: psycopg2.extensions.connection, years: list[str] = None, indicators: list[str] = None) -> int:
+    """
+    Compute the indicators again and replace their rows, readers see the old values until the commit
+    years = only the periods of these years (e.g. ['2023']), all of them by default
+    indicators = names in INDICATORS, all of them by default
+    """
+    start = time.time()
+    indicators = indicators or list(INDICATORS)
+    unknown = set(indicators) - set(INDICATORS)
+    if unknown:
+        raise ValueError(f"Unknown indicators {', '.join(sorted(unknown))}, expected some of {', '.join(INDICATORS)}")
+    narrow = compute_indicators(pivot_measures(read_measures(conn, years)), indicators)
+    with conn.cursor() as cursor:
+        ensure_indicator_table(cursor)
+        delete = sql.SQL("DELETE FROM {} WHERE indicator = ANY(%s)").format(sql.Identifier(INDICATOR_TABLE))
+        if years is not None:
+            delete += sql.SQL(' AND left("TIME_PERIOD", 4) = ANY(%s)')
+        cursor.execute(delete, (indicators, sorted(years)) if years is not None else (indicators,))
+        copy_frame(cursor, narrow[KEY_COLUMNS + ['indicator', 'value']], INDICATOR_TABLE)
+    conn.commit()
+    print(f"Computed {len(narrow)} indicator values" + (f" of {', '.join(sorted(years))}" if years is not None else "") +
+          f" into {INDICATOR_TABLE} in {time.time() - start:.1f}s")
+    return len(narrow)
+
+def update_indicators(conn: psycopg2.extensions.connection, fact: str, changes=None) -> None:
+    """Bring the indicators up to date after a load of a fact table, only the years of the changed periods if known"""
+    if fact not in FACTS:
+        return
+    if changes is None:
+        build_indicators(conn)
+        return
+    years = {str(period)[:4] for _, period in changes}
+    if years:   # A new annual capacity changes the months of its year too, so whole years are computed again
+        build_indicators(conn, sorted(years))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compute the derived tourism indicators into " + INDICATOR_TABLE)
+    parser.add_argument('indicators', nargs='*', help=f"indicators to compute ({', '.join(INDICATORS)}), all by default")
+    parser.add_argument('--year', action='append', help="compute only the periods of a year, can be repeated")
+    args = parser.parse_args()
+
+    conn = get_db_connection()
+    try:
+        build_indicators(conn, args.year, args.indicators or None)
+    finally:
+        conn.close()
@@ -1,34 +1,30 @@
 import os
 import pandas as pd
-import psycopg2
+from db import get_db_connection
 
 # Script per eseguire connessione a un Database PostgreSQL, creare tabelle vuote e riempirle con i dati dei file CSV presenti in una cartella
 
+DIMENSION_COLUMNS = "id VARCHAR(50) PRIMARY KEY, nome TEXT"  # Stesso schema delle tabelle dim_cl_* del database
+
 def connect_db():
-    """Crea una connessione al database Postgres."""
-    return psycopg2.connect(
-        database="postgres",   # Sostituisci con il tuo database
-        user="admin",         # Sostituisci con il tuo utente
-        password="adminpassword",   # Sostituisci con la tua password
-        host="localhost",          # Sostituisci con l'host del tuo database
-        port="5432"                # Sostituisci con la port del tuo database
-    )
-
-def create_table(cursor, table_name):
+    """Crea una connessione al database Postgres con le impostazioni del file .env."""
+    return get_db_connection()
+
+def create_table(cursor, table_name, columns=DIMENSION_COLUMNS):
     """Crea una tabella nel database per i file CSV specificati."""
     create_table_query = f"""
     CREATE TABLE IF NOT EXISTS {table_name} (
-        ID VARCHAR(50) PRIMARY KEY,
-        NAME VARCHAR(255)
+        {columns}
     );
     """
     cursor.execute(create_table_query)
     print(f"Created table {table_name}")
 
-def load_csv_to_db(cursor, table_name, csv_file_path):
+def load_csv_to_db(cursor, table_name, csv_file_path, create=True):
     """Carica un file CSV nella tabella specificata."""
-    # Crea la tabella se non esiste
-    create_table(cursor, table_name)
+    # Crea la tabella se non esiste (create=False quando la tabella esiste già, es. una tabella di staging)
+    if create:
+        create_table(cursor, table_name)
 
     # Carica il file CSV nel database
     with open(csv_file_path, 'r', encoding='utf-8') as f:
@@ -0,0 +1,207 @@
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from os import getenv
+from typing import Iterator
+from dotenv import load_dotenv
+
+try:    # Peak RSS on Linux/macOS
+    import resource
+except ImportError:
+    resource = None
+try:    # Optional, peak RSS of the stages sampled where the high-water mark can't be reset (macOS, Windows)
+    import psutil
+except ImportError:
+    psutil = None
+
+load_dotenv()
+
+# Instrumentation of the pipeline runs: every stage of a run (DB fetch, hierarchy pass, geocoding, load, ...) records
+# its wall time, rows in/out, its peak RSS and how many HTTP calls, cache hits and DB round trips it made. The counters
+# are bumped by http_cache, geocoder and the db cursors; the run is written as a JSON report and, when asked, every
+# stage is profiled with cProfile into its own .prof file.
+# The peak RSS of a stage is the high-water mark of the process reset when the stage starts (/proc/self/clear_refs on
+# Linux), or sampled with psutil. RSS and counters belong to the process: when stages run at the same time (pipeline
+# workers) each one gets the values of all of them, and its rss_scope/counters_scope say 'process' instead of 'stage'
+
+REPORT_DIR = getenv('run_report_dir', os.path.join('csv', 'run_reports'))
+PROFILE_DIR = getenv('run_profile_dir') or None     # cProfile of every stage, off when not set
+COUNTERS = ('http_calls', 'http_cache_hits', 'geocode_cache_hits', 'db_round_trips')
+MB = 1024 * 1024
+RSS_SAMPLE_S = 0.05     # Interval of the psutil sampling of the RSS
+_counts = dict.fromkeys(COUNTERS, 0)
+_counts_lock = threading.Lock()
+_active_stages = set()  # Stages running now, in any thread
+_active_lock = threading.Lock()
+
+
+def count(name: str, n: int = 1) -> None:
+    """Add n to a process-wide counter, thread safe"""
+    with _counts_lock:
+        _counts[name] = _counts.get(name, 0) + n
+
+def counters() -> dict[str, int]:
+    with _counts_lock:
+        return dict(_counts)
+
+def peak_rss_mb() -> float | None:
+    """Peak resident memory of the process so far, None when it can't be read"""
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss     # bytes on macOS, KB elsewhere
+        return round(peak / (MB if sys.platform == 'darwin' else 1024), 1)
+    if psutil is not None:
+        info = psutil.Process().memory_info()
+        return round(getattr(info, 'peak_wset', info.rss) / MB, 1)
+    return None
+
+def reset_peak_rss() -> bool:
+    """Reset the high-water mark of the RSS to the current RSS (Linux 4.0+), False when it can't be reset"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+        return True
+    except OSError:
+        return False
+
+def hwm_rss_mb() -> float | None:
+    """High-water mark of the RSS since the last reset_peak_rss (VmHWM), None when it can't be read"""
+    try:
+        with open('/proc/self/status', 'r') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return round(int(line.split()[1]) / 1024, 1)   # kB
+    except OSError:
+        pass
+    return None
+
+
+class RssSampler:
+    """Peak RSS of the process while it runs, sampled by a thread every interval seconds"""
+
+    def __init__(self, interval: float = RSS_SAMPLE_S):
+        self.process = psutil.Process()
+        self.peak = self.process.memory_info().rss
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, args=(interval,), daemon=True)
+        self.thread.start()
+
+    def run(self, interval: float) -> None:
+        while not self.stopped.wait(interval):
+            self.peak = max(self.peak, self.process.memory_info().rss)
+
+    def stop(self) -> float:
+        """Stop sampling and return the peak in MB"""
+        self.stopped.set()
+        self.thread.join()
+        self.peak = max(self.peak, self.process.memory_info().rss)
+        return round(self.peak / MB, 1)
+
+
+class Stage:
+    """Measures of one stage, rows_out and the extra values are set by the code inside the stage"""
+
+    def __init__(self, name: str, rows_in: int = None):
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.extra = {}
+        self.status = 'ok'
+        self.wall_s = None
+        self.peak_rss_mb = None
+        self.rss_scope = 'stage'
+        self.counters = {}
+        self.overlapped = False     # Another stage ran at the same time, RSS and counters include it
+
+    def add(self, key: str, value: float) -> None:
+        """Accumulate an extra measure, e.g. the seconds spent in a part of the stage"""
+        self.extra[key] = self.extra.get(key, 0) + value
+
+    def to_dict(self) -> dict:
+        return {'name': self.name, 'status': self.status, 'wall_s': self.wall_s, 'rows_in': self.rows_in,
+                'rows_out': self.rows_out, 'peak_rss_mb': self.peak_rss_mb, 'rss_scope': self.rss_scope,
+                'counters_scope': 'process' if self.overlapped else 'stage', **self.counters,
+                **{key: round(value, 3) if isinstance(value, float) else value for key, value in self.extra.items()}}
+
+
+class RunReport:
+    """Stages of a run, written as JSON by save()"""
+
+    def __init__(self, name: str, report_dir: str = REPORT_DIR, profile_dir: str = PROFILE_DIR):
+        """
+        report_dir = folder of the JSON reports, None to only print the stages
+        profile_dir = folder of the cProfile output of every stage (run_<name>_<stage>.prof), None to not profile,
+                      run_profile_dir of .env by default
+        """
+        self.name = name
+        self.report_dir = report_dir
+        self.profile_dir = profile_dir
+        self.started_at = datetime.now(timezone.utc)
+        self.start = time.perf_counter()
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name: str, rows_in: int = None) -> Iterator[Stage]:
+        """Measure the block as a stage of the run"""
+        stage = Stage(name, rows_in)
+        with _active_lock:
+            for other in _active_stages:
+                other.overlapped = stage.overlapped = True
+            reset = not _active_stages and reset_peak_rss()    # A reset would hide the peak of the running stages
+            _active_stages.add(stage)
+        sampler = RssSampler() if not reset and not stage.overlapped and psutil is not None else None
+        before = counters()
+        profiler = cProfile.Profile() if self.profile_dir else None
+        start = time.perf_counter()
+        if profiler:
+            profiler.enable()
+        try:
+            yield stage
+        except BaseException:
+            stage.status = 'failed'
+            raise
+        finally:
+            if profiler:
+                profiler.disable()
+                os.makedirs(self.profile_dir, exist_ok=True)
+                profiler.dump_stats(os.path.join(self.profile_dir, f"run_{self.name}_{name}.prof"))
+            stage.wall_s = round(time.perf_counter() - start, 3)
+            with _active_lock:
+                _active_stages.discard(stage)
+            if reset:
+                stage.peak_rss_mb = hwm_rss_mb()
+            elif sampler:
+                stage.peak_rss_mb = sampler.stop()
+            else:   # Peak of the whole process so far
+                stage.peak_rss_mb = peak_rss_mb()
+            if stage.overlapped or not (reset or sampler):
+                stage.rss_scope = 'process'
+            stage.counters = {key: value - before.get(key, 0) for key, value in counters().items()}
+            self.stages.append(stage)
+            parts = [f"{stage.wall_s:.2f}s", f"rows {'-' if stage.rows_in is None else stage.rows_in} -> {'-' if stage.rows_out is None else stage.rows_out}"]
+            if stage.peak_rss_mb is not None:
+                parts.append(f"peak RSS {stage.peak_rss_mb:.0f} MB" + (" (process)" if stage.rss_scope == 'process' else ""))
+            parts += [f"{key} {value}" for key, value in stage.counters.items() if value]
+            if stage.overlapped:
+                parts.append("counters of the overlapping stages included")
+            print(f"[{self.name}] {name} {stage.status}: " + ", ".join(parts))
+
+    def to_dict(self) -> dict:
+        return {'run': self.name, 'started_at': self.started_at.isoformat(timespec='seconds'),
+                'wall_s': round(time.perf_counter() - self.start, 3), 'peak_rss_mb': peak_rss_mb(),
+                'python': sys.version.split()[0], 'stages': [stage.to_dict() for stage in self.stages]}
+
+    def save(self) -> str | None:
+        """Write the report to report_dir/run_<name>_<timestamp>.json and return its path"""
+        if not self.report_dir:
+            return None
+        os.makedirs(self.report_dir, exist_ok=True)
+        path = os.path.join(self.report_dir, f"run_{self.name}_{self.started_at:%Y%m%dT%H%M%S}.json")
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump(self.to_dict(), file, indent=1)
+        print(f"Run report written to {path}")
+        return path
@@ -0,0 +1,159 @@
+import re
+from datetime import date
+import psycopg2
+
+# High-water marks of the incremental loads: the last TIME_PERIOD loaded for each dataflow, filter and FREQ.
+# ISTAT only appends new periods and revises the recent ones, so a refresh requests just the window after the
+# mark, moved back by a few periods to pick up the revisions
+
+STATE_TABLE = 'etl_high_water'
+DEFAULT_LOOKBACK = 3    # Periods (of each FREQ) requested again to pick up revisions
+MONTHS_PER_PERIOD = {'A': 12, 'S': 6, 'H': 6, 'Q': 3, 'M': 1}
+
+
+def ensure_state_table(cursor: psycopg2.extensions.cursor) -> None:
+    """Create the table of the high-water marks"""
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {STATE_TABLE} (
+            dataflow VARCHAR(100) NOT NULL,
+            series_filter TEXT NOT NULL DEFAULT '',
+            freq VARCHAR(10) NOT NULL,
+            time_period VARCHAR(20) NOT NULL,
+            loaded_at TIMESTAMP NOT NULL DEFAULT now(),
+            PRIMARY KEY (dataflow, series_filter, freq)
+        )
+    """)
+
+def get_high_water(conn: psycopg2.extensions.connection, dataflow: str, series_filter: str = None) -> dict[str, str]:
+    """Return {FREQ: last TIME_PERIOD loaded} of a dataflow and filter, empty if it was never loaded"""
+    with conn.cursor() as cursor:
+        ensure_state_table(cursor)
+        cursor.execute(f"SELECT freq, time_period FROM {STATE_TABLE} WHERE dataflow = %s AND series_filter = %s",
+                       (dataflow, series_filter or ''))
+        marks = dict(cursor.fetchall())
+    conn.commit()
+    return marks
+
+def save_high_water(conn: psycopg2.extensions.connection, dataflow: str, marks: dict[str, str], series_filter: str = None) -> None:
+    """Move the high-water marks forward (a mark never goes back, the delta can hold only revised periods)"""
+    with conn.cursor() as cursor:
+        ensure_state_table(cursor)
+        for freq, time_period in marks.items():
+            cursor.execute(f"""
+                INSERT INTO {STATE_TABLE} (dataflow, series_filter, freq, time_period) VALUES (%s, %s, %s, %s)
+                ON CONFLICT (dataflow, series_filter, freq) DO UPDATE
+                SET time_period = GREATEST({STATE_TABLE}.time_period, EXCLUDED.time_period), loaded_at = now()
+            """, (dataflow, series_filter or '', freq, time_period))
+    conn.commit()
+
+def update_marks(marks: dict[str, str], freqs, periods) -> None:
+    """Merge the (FREQ, TIME_PERIOD) pairs of a loaded chunk into the marks, keeping the latest period of each FREQ"""
+    for freq, time_period in zip(freqs, periods):
+        if isinstance(freq, str) and isinstance(time_period, str) and time_period > marks.get(freq, ''):
+            marks[freq] = time_period
+
+def period_start(time_period: str, freq: str, lookback: int = 0) -> date:
+    """First day of a TIME_PERIOD (2023, 2023-S1, 2023-Q2, 2023-05, 2023-W07, 2023-05-14) moved back by lookback periods"""
+    year = int(time_period[:4])
+    if freq == 'D' or re.fullmatch(r'\d{4}-\d{2}-\d{2}', time_period):
+        day = date.fromisoformat(time_period[:10])
+        return date.fromordinal(day.toordinal() - lookback)
+    if freq == 'W' or '-W' in time_period:
+        week = int(time_period.split('-W')[1]) if '-W' in time_period else 1
+        return date.fromordinal(date.fromisocalendar(year, week, 1).toordinal() - 7 * lookback)
+
+    months = MONTHS_PER_PERIOD.get(freq, 12)
+    match = re.fullmatch(r'\d{4}-([SHQ]?)(\d{1,2})', time_period)
+    month = 1
+    if match:
+        month = (int(match.group(2)) - 1) * months + 1 if match.group(1) else int(match.group(2))
+    index = year * 12 + month - 1 - months * lookback   # Months since year 0
+    return date(index // 12, index % 12 + 1, 1)
+
+def incremental_start(marks: dict[str, str], lookback: int = DEFAULT_LOOKBACK) -> str | None:
+    """startPeriod covering the lookback window of every FREQ, None when there is no mark (full load)"""
+    if not marks:
+        return None
+    return min(period_start(time_period, freq, lookback) for freq, time_period in marks.items()).isoformat()
+
+
+# Checkpoints of the scheduled imports: every slice (dataflow x filter x window) of a run is recorded when it
+# finishes, so a rerun of the same manifest only retries the failed or missing slices
+
+CHECKPOINT_TABLE = 'etl_job_checkpoint'
+
+def ensure_checkpoint_table(cursor: psycopg2.extensions.cursor) -> None:
+    """Create the table of the slice checkpoints"""
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {CHECKPOINT_TABLE} (
+            run_id VARCHAR(100) NOT NULL,
+            slice_id TEXT NOT NULL,
+            status VARCHAR(10) NOT NULL,
+            rows_loaded BIGINT,
+            error TEXT,
+            finished_at TIMESTAMP NOT NULL DEFAULT now(),
+            PRIMARY KEY (run_id, slice_id)
+        )
+    """)
+
+def get_done_slices(conn: psycopg2.extensions.connection, run_id: str) -> set[str]:
+    """Slices of a run that were already loaded"""
+    with conn.cursor() as cursor:
+        ensure_checkpoint_table(cursor)
+        cursor.execute(f"SELECT slice_id FROM {CHECKPOINT_TABLE} WHERE run_id = %s AND status = 'done'", (run_id,))
+        done = {row[0] for row in cursor.fetchall()}
+    conn.commit()
+    return done
+
+def save_checkpoint(conn: psycopg2.extensions.connection, run_id: str, slice_id: str, status: str,
+                    rows_loaded: int = None, error: str = None) -> None:
+    """Record the outcome ('done' or 'failed') of a slice"""
+    with conn.cursor() as cursor:
+        ensure_checkpoint_table(cursor)
+        cursor.execute(f"""
+            INSERT INTO {CHECKPOINT_TABLE} (run_id, slice_id, status, rows_loaded, error) VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (run_id, slice_id) DO UPDATE
+            SET status = EXCLUDED.status, rows_loaded = EXCLUDED.rows_loaded, error = EXCLUDED.error, finished_at = now()
+        """, (run_id, slice_id, status, rows_loaded, error))
+    conn.commit()
+
+def clear_checkpoints(conn: psycopg2.extensions.connection, run_id: str) -> None:
+    """Forget the slices of a run, so that it restarts from scratch"""
+    with conn.cursor() as cursor:
+        ensure_checkpoint_table(cursor)
+        cursor.execute(f"DELETE FROM {CHECKPOINT_TABLE} WHERE run_id = %s", (run_id,))
+    conn.commit()
+
+
+# Content hashes of the loaded codelist CSVs, a dimension table is loaded again only when its files change
+
+DIMENSION_HASH_TABLE = 'etl_dimension_hash'
+
+def ensure_hash_table(cursor: psycopg2.extensions.cursor) -> None:
+    """Create the table of the codelist hashes"""
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {DIMENSION_HASH_TABLE} (
+            table_name VARCHAR(100) PRIMARY KEY,
+            content_hash VARCHAR(64) NOT NULL,
+            rows_loaded BIGINT,
+            loaded_at TIMESTAMP NOT NULL DEFAULT now()
+        )
+    """)
+
+def get_content_hashes(conn: psycopg2.extensions.connection) -> dict[str, str]:
+    """Return {table: hash of the files it was last loaded from}"""
+    with conn.cursor() as cursor:
+        ensure_hash_table(cursor)
+        cursor.execute(f"SELECT table_name, content_hash FROM {DIMENSION_HASH_TABLE}")
+        hashes = dict(cursor.fetchall())
+    conn.commit()
+    return hashes
+
+def set_content_hash(cursor: psycopg2.extensions.cursor, table_name: str, content_hash: str, rows_loaded: int) -> None:
+    """Record the hash of a load, in the same transaction of the load (no commit)"""
+    ensure_hash_table(cursor)
+    cursor.execute(f"""
+        INSERT INTO {DIMENSION_HASH_TABLE} (table_name, content_hash, rows_loaded) VALUES (%s, %s, %s)
+        ON CONFLICT (table_name) DO UPDATE
+        SET content_hash = EXCLUDED.content_hash, rows_loaded = EXCLUDED.rows_loaded, loaded_at = now()
+    """, (table_name, content_hash, rows_loaded))
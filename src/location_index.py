@@ -0,0 +1,206 @@
+import argparse
+import time
+import numpy as np
+import pandas as pd
+import psycopg2
+from psycopg2 import sql
+from bulk_loader import copy_frame
+from db import get_db_connection, read_query
+from heriarcy_location import process_geographic_hierarchy
+from location_rollup import HIERARCHY_TABLE, REGION_PATTERN
+
+# Location hierarchy of the ITTER107 codelist as flat arrays: the codes are numbered in preorder (Euler tour), so the
+# descendants of a code are the contiguous positions lft..rgt and its parent is one array lookup away. The same
+# numbering is saved as a nested-set table and every (ancestor, descendant) pair as a closure table, so "all the
+# communes under ITC3" is an indexed range scan instead of a recursive query:
+#   SELECT ... FROM facts_turismo f JOIN gerarchia_luogo_closure c ON c.descendant = f."REF_AREA" WHERE c.ancestor = 'ITC3'
+
+SOURCE_TABLE = 'dim_cl_itter107'
+CLOSURE_TABLE = f"{HIERARCHY_TABLE}_closure"
+NESTED_TABLE = f"{HIERARCHY_TABLE}_nested"
+MACRO_AREA_PATTERN = '^IT[A-Z]$'
+COUNTRY = 'IT'
+
+
+def assign_parents(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    id, nome and parent_ID of every code: communes and provinces as in the hierarchy compiler, regions under their
+    macro-area and the macro-areas under Italy. The codes matching no rule (ATO, size classes, ...) are roots
+    """
+    df = process_geographic_hierarchy(df[['id', 'nome']].copy())[['id', 'nome', 'parent_ID']]
+    ids = df['id'].astype(str)
+    known = set(ids)
+    regions = ids.str.match(REGION_PATTERN) & ids.str[:3].isin(known)
+    df.loc[regions, 'parent_ID'] = ids[regions].str[:3]
+    if COUNTRY in known:
+        df.loc[ids.str.match(MACRO_AREA_PATTERN), 'parent_ID'] = COUNTRY
+    return df
+
+
+class LocationHierarchy:
+    """
+    Tree of location codes in preorder arrays, the subtree of the code at position i is the range i..end[i]-1
+    ids = codes in preorder, parent = position of the parent (-1 for the roots), depth = 0 for the roots
+    """
+
+    def __init__(self, ids, parents):
+        """ids and parents = codes and the code of their parent (None for the roots), in any order"""
+        ids = np.asarray(ids, dtype=object)
+        parents = pd.Index(ids).get_indexer(pd.Series(parents, dtype=object).where(lambda s: s.notna(), None))
+        if len(set(ids)) != len(ids):
+            raise ValueError("The codes of the hierarchy are not unique")
+
+        # Children of every node, ordered by code, as offsets into one array (roots first, their parent is -1)
+        order = np.lexsort((ids.astype(str), parents))
+        n_roots = int((parents < 0).sum())
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(parents[parents >= 0], minlength=len(ids)))]) + n_roots
+
+        preorder, depth = [], np.zeros(len(ids), dtype=np.int16)
+        stack = order[:n_roots][::-1].tolist()
+        while stack:
+            node = stack.pop()
+            preorder.append(node)
+            children = order[offsets[node]:offsets[node + 1]]
+            depth[children] = depth[node] + 1
+            stack.extend(children[::-1].tolist())
+        if len(preorder) != len(ids):
+            raise ValueError(f"{len(ids) - len(preorder)} codes are in a parent_ID cycle")
+
+        preorder = np.asarray(preorder, dtype=np.int64)
+        rank = np.empty(len(ids), dtype=np.int32)
+        rank[preorder] = np.arange(len(ids), dtype=np.int32)
+        self.ids = ids[preorder]
+        self.parent = np.where(parents[preorder] >= 0, rank[parents[preorder]], -1).astype(np.int32)
+        self.depth = depth[preorder]
+
+        # Subtree sizes, children come after their parent in preorder so one backward pass adds them up
+        size = np.ones(len(ids), dtype=np.int32)
+        for position in range(len(ids) - 1, 0, -1):
+            if self.parent[position] >= 0:
+                size[self.parent[position]] += size[position]
+        self.end = np.arange(len(ids), dtype=np.int32) + size
+        self.position = dict(zip(self.ids, range(len(ids))))
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame, id_column: str = 'id', parent_column: str = 'parent_ID') -> 'LocationHierarchy':
+        return cls(df[id_column].astype(str), df[parent_column])
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, code: str) -> bool:
+        return code in self.position
+
+    def parent_of(self, code: str) -> str | None:
+        parent = self.parent[self.position[code]]
+        return self.ids[parent] if parent >= 0 else None
+
+    def ancestors(self, code: str) -> list[str]:
+        """Codes above code, from its parent up to the root"""
+        result, position = [], self.parent[self.position[code]]
+        while position >= 0:
+            result.append(self.ids[position])
+            position = self.parent[position]
+        return result
+
+    def descendants(self, code: str, include_self: bool = False) -> np.ndarray:
+        """Codes below code, a slice of the preorder array"""
+        position = self.position[code]
+        return self.ids[position if include_self else position + 1:self.end[position]]
+
+    def is_descendant(self, code: str, ancestor: str) -> bool:
+        start = self.position[ancestor]
+        return start < self.position[code] < self.end[start]
+
+    def within(self, codes: pd.Series, ancestor: str) -> pd.Series:
+        """Mask of the codes in the subtree of ancestor (ancestor included), e.g. to filter the REF_AREA of the facts"""
+        start = self.position[ancestor]
+        positions = codes.map(self.position)
+        return (positions >= start) & (positions < self.end[start])
+
+    def to_frame(self) -> pd.DataFrame:
+        """Nested-set numbering, the descendants of a code have lft between its lft and rgt"""
+        return pd.DataFrame({'id': self.ids, 'parent_ID': [self.ids[p] if p >= 0 else None for p in self.parent],
+                             'depth': self.depth, 'lft': np.arange(len(self), dtype=np.int32), 'rgt': self.end - 1})
+
+    def closure(self) -> pd.DataFrame:
+        """Every (ancestor, descendant, distance), each code is its own ancestor at distance 0"""
+        descendants = np.arange(len(self), dtype=np.int32)
+        ancestors, distance, parts = descendants.copy(), 0, []
+        while len(descendants):
+            parts.append(pd.DataFrame({'ancestor': self.ids[ancestors], 'descendant': self.ids[descendants],
+                                       'distance': np.int16(distance)}))
+            ancestors = self.parent[ancestors]
+            descendants, ancestors = descendants[ancestors >= 0], ancestors[ancestors >= 0]
+            distance += 1
+        return pd.concat(parts, ignore_index=True)
+
+
+def ensure_tables(cursor: psycopg2.extensions.cursor) -> None:
+    cursor.execute(sql.SQL("""
+        CREATE TABLE IF NOT EXISTS {closure} (
+            ancestor VARCHAR(50) NOT NULL,
+            descendant VARCHAR(50) NOT NULL,
+            distance SMALLINT NOT NULL,
+            PRIMARY KEY (ancestor, descendant)
+        )
+    """).format(closure=sql.Identifier(CLOSURE_TABLE)))
+    cursor.execute(sql.SQL("CREATE INDEX IF NOT EXISTS {} ON {} (descendant, distance)").format(
+        sql.Identifier(f"{CLOSURE_TABLE}_descendant"), sql.Identifier(CLOSURE_TABLE)))
+    cursor.execute(sql.SQL("""
+        CREATE TABLE IF NOT EXISTS {nested} (
+            id VARCHAR(50) PRIMARY KEY,
+            "parent_ID" VARCHAR(50),
+            depth SMALLINT NOT NULL,
+            lft INTEGER NOT NULL,
+            rgt INTEGER NOT NULL
+        )
+    """).format(nested=sql.Identifier(NESTED_TABLE)))
+    cursor.execute(sql.SQL("CREATE UNIQUE INDEX IF NOT EXISTS {} ON {} (lft) INCLUDE (id)").format(
+        sql.Identifier(f"{NESTED_TABLE}_lft"), sql.Identifier(NESTED_TABLE)))
+
+def load_hierarchy(conn: psycopg2.extensions.connection = None, source: str = SOURCE_TABLE) -> LocationHierarchy:
+    """Hierarchy of the codes of a codelist table"""
+    df = read_query(sql.SQL("SELECT id, nome FROM {}").format(sql.Identifier(source)), conn=conn)
+    return LocationHierarchy.from_frame(assign_parents(df))
+
+def save_hierarchy(conn: psycopg2.extensions.connection, hierarchy: LocationHierarchy) -> int:
+    """Replace the closure and nested-set tables in one transaction, readers see the old rows until the commit"""
+    start = time.time()
+    closure = hierarchy.closure()
+    with conn.cursor() as cursor:
+        ensure_tables(cursor)
+        for table_name, df in ((CLOSURE_TABLE, closure), (NESTED_TABLE, hierarchy.to_frame())):
+            cursor.execute(sql.SQL("DELETE FROM {}").format(sql.Identifier(table_name)))
+            copy_frame(cursor, df, table_name)
+            cursor.execute(sql.SQL("ANALYZE {}").format(sql.Identifier(table_name)))
+    conn.commit()
+    print(f"Saved {len(hierarchy)} codes and {len(closure)} ancestor pairs into {NESTED_TABLE} and {CLOSURE_TABLE} "
+          f"in {time.time() - start:.1f}s")
+    return len(closure)
+
+def build_closure(source: str = SOURCE_TABLE) -> int:
+    """Build the hierarchy of a codelist table and save it, returns the ancestor pairs"""
+    conn = get_db_connection()
+    try:
+        return save_hierarchy(conn, load_hierarchy(conn, source))
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the closure and nested-set tables of the location hierarchy")
+    parser.add_argument('--source', default=SOURCE_TABLE, help="codelist table with the codes (id) and names (nome)")
+    parser.add_argument('--show', metavar='CODE', help="print the ancestors and descendants of a code instead of saving")
+    args = parser.parse_args()
+
+    if args.show:
+        conn = get_db_connection()
+        try:
+            hierarchy = load_hierarchy(conn, args.source)
+        finally:
+            conn.close()
+        print(f"{args.show}: ancestors {' > '.join(reversed(hierarchy.ancestors(args.show))) or '-'}, "
+              f"{len(hierarchy.descendants(args.show))} descendants")
+    else:
+        build_closure(args.source)
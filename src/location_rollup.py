@@ -0,0 +1,214 @@
+import argparse
+import time
+import psycopg2
+from psycopg2 import sql
+from psycopg2.extras import execute_values
+from db import get_db_connection
+from reporting_layer import FACT_TABLES, relation_exists
+
+# Rollup cube over the location hierarchy: the OBS_VALUE of the communes summed up to their province, region and
+# macro-area (following gerarchia_luogo.parent_ID) for every TIME_PERIOD and cube dimension, so the dashboard tiles
+# above the commune level read a small summary table instead of aggregating the whole fact table.
+# After a load only the (area, TIME_PERIOD) cells above the changed communes are computed again
+
+HIERARCHY_TABLE = 'gerarchia_luogo'
+HIERARCHY_COLUMNS = ['id', 'nome', 'parent_ID']    # Schema of the hierarchy table, every writer uses it
+COMMUNE_PATTERN = '^[0-9]{6}$'          # ITTER107 commune codes, the leaves that are summed up
+REGION_PATTERN = '^IT[A-Z][0-9A-Z]$'    # Regions have no parent_ID, their macro-area is the NUTS1 prefix
+
+# Total code of the breakdown dimensions of the tourism dataflows (CL_CORREZ, CL_ATECO_2007, CL_ISO, CL_TIPOITTER1,
+# CL_NUMEROSITA codelists)
+TOTAL_CODES = {
+    'ADJUSTMENT': 'N',
+    'ECON_ACTIVITY_NACE_2007': '0010',
+    'COUNTRY_RES_GUESTS': 'WORLD',
+    'LOCALITY_TYPE': 'ALL',
+    'URBANIZ_DEGREE': 'ALL',
+    'COASTAL_AREA': 'ALL',
+    'SIZE_BY_NUMBER_ROOMS': 'TOT',
+}
+
+# Cube table -> fact table, dimensions kept in the cube (the other ones are summed) and filter of the fact rows.
+# The filter fixes the dimensions left out to their total code, otherwise totals and details are added together
+CUBES = {
+    'rollup_turismo': {'fact': FACT_TABLES['122_54'], 'dimensions': ['FREQ', 'DATA_TYPE', 'TYPE_ACCOMMODATION'],
+                       'filter': TOTAL_CODES},
+}
+
+
+def level_expression(column: sql.Composable) -> sql.Composed:
+    """Hierarchy level of an ITTER107 code"""
+    return sql.SQL("""CASE WHEN {col} ~ {commune} THEN 'comune' WHEN length({col}) = 5 THEN 'provincia'
+                      WHEN length({col}) = 4 THEN 'regione' WHEN length({col}) = 3 THEN 'macroarea' ELSE 'altro' END""").format(
+        col=column, commune=sql.Literal(COMMUNE_PATTERN))
+
+def build_ancestors(cursor: psycopg2.extensions.cursor) -> int:
+    """Temporary table (commune, ancestor) with every province, region and macro-area above each commune"""
+    cursor.execute("DROP TABLE IF EXISTS rollup_ancestors")
+    cursor.execute(sql.SQL("""
+        CREATE TEMP TABLE rollup_ancestors ON COMMIT DROP AS
+        WITH RECURSIVE tree AS (
+            SELECT id, COALESCE("parent_ID", CASE WHEN id ~ {region} THEN left(id, 3) END) AS parent FROM {hierarchy}
+        ), ancestors AS (
+            SELECT id AS commune, parent AS ancestor FROM tree WHERE id ~ {commune} AND parent IS NOT NULL
+            UNION
+            SELECT a.commune, t.parent FROM ancestors a JOIN tree t ON t.id = a.ancestor WHERE t.parent IS NOT NULL
+        )
+        SELECT commune, ancestor FROM ancestors
+    """).format(region=sql.Literal(REGION_PATTERN), hierarchy=sql.Identifier(HIERARCHY_TABLE),
+                commune=sql.Literal(COMMUNE_PATTERN)))
+    cursor.execute("CREATE INDEX ON rollup_ancestors (commune)")
+    cursor.execute("ANALYZE rollup_ancestors")
+    cursor.execute("SELECT COUNT(*) FROM rollup_ancestors")
+    return cursor.fetchone()[0]
+
+def lock_cube(cursor: psycopg2.extensions.cursor, cube: str) -> None:
+    """Wait for the other writers of the cube (daemon jobs of different tables, pipeline) until the commit"""
+    cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (cube,))
+
+def ensure_cube_table(cursor: psycopg2.extensions.cursor, cube: str) -> None:
+    """Create the cube table, one row per (level, area, dimensions, TIME_PERIOD)"""
+    dimensions = [sql.Identifier(dim) for dim in CUBES[cube]['dimensions']]
+    cursor.execute(sql.SQL("""
+        CREATE TABLE IF NOT EXISTS {cube} (
+            level VARCHAR(20) NOT NULL,
+            area_id VARCHAR(50) NOT NULL,
+            {dimensions},
+            "TIME_PERIOD" VARCHAR(10),
+            "OBS_VALUE" DOUBLE PRECISION,
+            n_comuni INTEGER NOT NULL,
+            n_obs INTEGER NOT NULL
+        )
+    """).format(cube=sql.Identifier(cube), dimensions=sql.SQL(', ').join(sql.SQL("{} VARCHAR(50)").format(dim) for dim in dimensions)))
+    cursor.execute(sql.SQL('CREATE UNIQUE INDEX IF NOT EXISTS {} ON {} (area_id, "TIME_PERIOD", {}) NULLS NOT DISTINCT').format(
+        sql.Identifier(f"{cube}_key"), sql.Identifier(cube), sql.SQL(', ').join(dimensions)))
+    cursor.execute(sql.SQL('CREATE INDEX IF NOT EXISTS {} ON {} (level, "TIME_PERIOD")').format(
+        sql.Identifier(f"{cube}_level_period"), sql.Identifier(cube)))
+
+def aggregate_query(cube: str, filter: dict, cells: str = None) -> sql.Composed:
+    """
+    INSERT of the aggregates of every ancestor, or only of the (ancestor, TIME_PERIOD) cells of a table
+    filter = column -> code of the fact rows summed, the filter of the cube restricted to the columns of the fact table
+    """
+    spec = CUBES[cube]
+    dimensions = sql.SQL(', ').join(sql.SQL("f.{}").format(sql.Identifier(dim)) for dim in spec['dimensions'])
+    conditions = [sql.SQL("f.{} = {}").format(sql.Identifier(col), sql.Literal(value)) for col, value in filter.items()]
+    join_cells = sql.SQL("")
+    if cells:
+        join_cells = sql.SQL('JOIN {} c ON c.ancestor = a.ancestor AND c.period = f."TIME_PERIOD"').format(sql.Identifier(cells))
+    return sql.SQL("""
+        INSERT INTO {cube}
+        SELECT {level}, a.ancestor, {dimensions}, f."TIME_PERIOD", SUM(f."OBS_VALUE"), COUNT(DISTINCT f."REF_AREA"), COUNT(*)
+        FROM {fact} f
+        JOIN rollup_ancestors a ON a.commune = f."REF_AREA"
+        {join_cells}
+        {where}
+        GROUP BY a.ancestor, {dimensions}, f."TIME_PERIOD"
+    """).format(cube=sql.Identifier(cube), level=level_expression(sql.SQL("a.ancestor")), dimensions=dimensions,
+                fact=sql.Identifier(spec['fact']), join_cells=join_cells,
+                where=sql.SQL("WHERE ") + sql.SQL(" AND ").join(conditions) if conditions else sql.SQL(""))
+
+def fact_columns(cursor: psycopg2.extensions.cursor, fact: str) -> list[str]:
+    """Columns of a fact table"""
+    cursor.execute("SELECT column_name FROM information_schema.columns WHERE table_schema = current_schema() AND table_name = %s",
+                   (fact,))
+    return [row[0] for row in cursor.fetchall()]
+
+def cube_filter(cursor: psycopg2.extensions.cursor, cube: str, columns: list[str] = None) -> dict:
+    """Filter of the cube on the columns the fact table has (a dataflow without a breakdown has no column for it)"""
+    spec = CUBES[cube]
+    columns = columns if columns is not None else fact_columns(cursor, spec['fact'])
+    return {col: value for col, value in spec['filter'].items() if col in columns}
+
+def check_summed_dimensions(cursor: psycopg2.extensions.cursor, cube: str) -> dict:
+    """
+    Fail when a dimension left out of the cube has several values at commune level (they would be added up) or when a
+    code of the filter is missing from the communes (the cube would be empty), returns the filter to apply
+    """
+    spec = CUBES[cube]
+    columns = fact_columns(cursor, spec['fact'])
+    filter = cube_filter(cursor, cube, columns)
+    others = [col for col in columns
+              if col not in spec['dimensions'] + list(filter) + ['REF_AREA', 'TIME_PERIOD', 'OBS_VALUE']]
+    checks = [sql.SQL("COUNT(DISTINCT {})").format(sql.Identifier(col)) for col in others]
+    checks += [sql.SQL("COUNT(*) FILTER (WHERE {} = {})").format(sql.Identifier(col), sql.Literal(value))
+               for col, value in filter.items()]
+    if not checks:
+        return filter
+    cursor.execute(sql.SQL('SELECT COUNT(*), {} FROM {} WHERE "REF_AREA" ~ {}').format(
+        sql.SQL(', ').join(checks), sql.Identifier(spec['fact']), sql.Literal(COMMUNE_PATTERN)))
+    rows, *counts = cursor.fetchone()
+    summed = {col: values for col, values in zip(others, counts) if values > 1}
+    missing = {col: value for (col, value), matches in zip(filter.items(), counts[len(others):]) if rows and not matches}
+    if summed or missing:
+        raise ValueError(f"Cannot build {cube} from {spec['fact']}: "
+                         + "; ".join([f"{col} has {values} values in the communes, add it to the dimensions or to the filter"
+                                      for col, values in summed.items()]
+                                     + [f"no commune row has {col} = {value}, fix the total code in the filter"
+                                        for col, value in missing.items()]))
+    return filter
+
+def build_rollup(conn: psycopg2.extensions.connection, cube: str) -> int:
+    """Compute the whole cube again, readers see the old rows until the commit"""
+    start = time.time()
+    with conn.cursor() as cursor:
+        lock_cube(cursor, cube)
+        ensure_cube_table(cursor, cube)
+        filter = check_summed_dimensions(cursor, cube)
+        build_ancestors(cursor)
+        cursor.execute(sql.SQL("DELETE FROM {}").format(sql.Identifier(cube)))
+        cursor.execute(aggregate_query(cube, filter))
+        rows = cursor.rowcount
+    conn.commit()
+    print(f"Built {cube}: {rows} rows in {time.time() - start:.1f}s")
+    return rows
+
+def update_rollup(conn: psycopg2.extensions.connection, cube: str, changes) -> int:
+    """Compute again only the cells above the changed (REF_AREA, TIME_PERIOD) pairs of the fact table"""
+    start = time.time()
+    with conn.cursor() as cursor:
+        lock_cube(cursor, cube)
+        ensure_cube_table(cursor, cube)
+        filter = cube_filter(cursor, cube)
+        build_ancestors(cursor)
+        cursor.execute("CREATE TEMP TABLE rollup_changes (area TEXT, period TEXT) ON COMMIT DROP")
+        execute_values(cursor, "INSERT INTO rollup_changes VALUES %s", list(changes), page_size=10000)
+        cursor.execute("""
+            CREATE TEMP TABLE rollup_cells ON COMMIT DROP AS
+            SELECT DISTINCT a.ancestor, c.period FROM rollup_changes c JOIN rollup_ancestors a ON a.commune = c.area
+        """)
+        cursor.execute(sql.SQL('DELETE FROM {} r USING rollup_cells c WHERE r.area_id = c.ancestor AND r."TIME_PERIOD" = c.period').format(
+            sql.Identifier(cube)))
+        cursor.execute(aggregate_query(cube, filter, 'rollup_cells'))
+        rows = cursor.rowcount
+    conn.commit()
+    print(f"Updated {cube}: {rows} rows in {time.time() - start:.1f}s")
+    return rows
+
+def update_rollups(conn: psycopg2.extensions.connection, fact: str, changes=None) -> None:
+    """Bring the cubes of a fact table up to date after a load, all of it when the changed pairs are unknown"""
+    with conn.cursor() as cursor:
+        ready = relation_exists(cursor, HIERARCHY_TABLE)
+    conn.commit()
+    if not ready:
+        return
+    for cube, spec in CUBES.items():
+        if spec['fact'] != fact:
+            continue
+        if changes is None:
+            build_rollup(conn, cube)
+        elif changes:
+            update_rollup(conn, cube, changes)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the rollup cubes over the location hierarchy")
+    parser.add_argument('cubes', nargs='*', default=list(CUBES), help="cubes to build, all of them by default")
+    args = parser.parse_args()
+
+    conn = get_db_connection()
+    try:
+        for cube in args.cubes:
+            build_rollup(conn, cube)
+    finally:
+        conn.close()
@@ -0,0 +1,184 @@
+import argparse
+import json
+import os
+import shutil
+import time
+from datetime import datetime, timezone
+from os import getenv
+from dotenv import load_dotenv
+import pandas as pd
+import psycopg2
+import pyarrow as pa
+import pyarrow.parquet as pq
+from psycopg2 import sql
+from db import get_db_connection, read_query
+from location_rollup import HIERARCHY_TABLE
+
+load_dotenv()
+
+# Columnar snapshot of the database: the facts_* tables are written to Parquet partitioned by FREQ and year
+# (hive layout, facts_x/FREQ=M/year=2023/part-0.parquet), the dim_cl_* tables and the location hierarchy to a file
+# each. Code columns are dictionary-encoded, so the files stay small and pandas/pyarrow read them back as categoricals.
+# A fingerprint (rows + hash of the rows) of every partition is kept in manifest.json and only the partitions whose
+# fingerprint changed since the last snapshot are written again
+
+EXPORT_DIR = getenv('parquet_export_dir', os.path.join('csv', 'parquet'))
+MANIFEST = 'manifest.json'
+COMPRESSION = 'zstd'
+NO_YEAR = 'none'    # Partition of the rows without TIME_PERIOD
+
+
+def list_tables(cursor: psycopg2.extensions.cursor) -> list[str]:
+    """Fact and dimension tables of the schema, plus the location hierarchy"""
+    cursor.execute("""SELECT table_name FROM information_schema.tables WHERE table_schema = current_schema()
+                      AND table_type = 'BASE TABLE' AND (table_name LIKE 'facts\\_%%' OR table_name LIKE 'dim\\_cl\\_%%'
+                      OR table_name = %s) ORDER BY table_name""", (HIERARCHY_TABLE,))
+    return [row[0] for row in cursor.fetchall()]
+
+def table_columns(cursor: psycopg2.extensions.cursor, table_name: str) -> dict[str, str]:
+    """{column: Postgres type} in table order"""
+    cursor.execute("SELECT column_name, data_type FROM information_schema.columns WHERE table_schema = current_schema() "
+                   "AND table_name = %s ORDER BY ordinal_position", (table_name,))
+    return dict(cursor.fetchall())
+
+def is_partitioned(columns: dict[str, str]) -> bool:
+    return 'FREQ' in columns and 'TIME_PERIOD' in columns
+
+def year_expression() -> sql.Composed:
+    return sql.SQL("""COALESCE(left("TIME_PERIOD", 4), {})""").format(sql.Literal(NO_YEAR))
+
+def partition_fingerprints(cursor: psycopg2.extensions.cursor, table_name: str, columns: dict[str, str]) -> dict[str, dict]:
+    """
+    Rows and hash of every partition in one scan, {partition path: {'rows', 'hash', 'freq', 'year'}}
+    The hash is the sum of the hashes of the rows, so it doesn't depend on their physical order
+    """
+    row_hash = sql.SQL("SUM(hashtextextended(t::text, 0)::numeric)::text")
+    if is_partitioned(columns):
+        cursor.execute(sql.SQL('SELECT "FREQ", {year}, COUNT(*), {hash} FROM {table} t GROUP BY 1, 2').format(
+            year=year_expression(), hash=row_hash, table=sql.Identifier(table_name)))
+        return {f"FREQ={freq}/year={year}": {'rows': rows, 'hash': digest, 'freq': freq, 'year': year}
+                for freq, year, rows, digest in cursor.fetchall()}
+    cursor.execute(sql.SQL("SELECT COUNT(*), {hash} FROM {table} t").format(hash=row_hash, table=sql.Identifier(table_name)))
+    rows, digest = cursor.fetchone()
+    return {'': {'rows': rows, 'hash': digest, 'freq': None, 'year': None}}
+
+def read_partition(conn: psycopg2.extensions.connection, table_name: str, partition: dict) -> pd.DataFrame:
+    """Rows of a partition, the whole table when it isn't partitioned"""
+    query = sql.SQL("SELECT * FROM {}").format(sql.Identifier(table_name))
+    params = None
+    if partition['freq'] is not None or partition['year'] is not None:
+        query += sql.SQL(' WHERE "FREQ" IS NOT DISTINCT FROM %s AND {} = %s').format(year_expression())
+        params = (partition['freq'], partition['year'])
+    df = read_query(query, params, conn)   # Streamed in chunks through a named cursor
+    conn.commit()
+    return df
+
+def to_arrow(df: pd.DataFrame, columns: dict[str, str], partitioned: bool = False) -> pa.Table:
+    """
+    Arrow table with the code columns dictionary-encoded and OBS_VALUE as float64, with the same schema in every
+    partition. FREQ is left out of the partitioned files, it's in their path
+    """
+    fields = []
+    for col, data_type in columns.items():
+        if partitioned and col == 'FREQ':
+            continue
+        if data_type in ('character varying', 'text', 'character'):
+            fields.append(pa.field(col, pa.string() if col == 'nome' else pa.dictionary(pa.int32(), pa.string())))
+        elif data_type in ('double precision', 'real', 'numeric'):
+            df[col] = pd.to_numeric(df[col], errors='coerce').astype('float64')
+            fields.append(pa.field(col, pa.float64()))
+        else:
+            fields.append(pa.field(col, pa.array(df[col]).type if len(df) else pa.null()))
+    return pa.Table.from_pandas(df[[field.name for field in fields]], schema=pa.schema(fields), preserve_index=False)
+
+def write_file(table: pa.Table, path: str) -> None:
+    """Write next to the destination and rename, readers never see a half-written file"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    pq.write_table(table, tmp_path, compression=COMPRESSION, use_dictionary=True)
+    os.replace(tmp_path, path)
+
+def partition_path(output_dir: str, table_name: str, partition: str) -> str:
+    if partition:
+        return os.path.join(output_dir, table_name, *partition.split('/'), 'part-0.parquet')
+    return os.path.join(output_dir, f"{table_name}.parquet")
+
+def load_manifest(output_dir: str) -> dict:
+    path = os.path.join(output_dir, MANIFEST)
+    if not os.path.exists(path):
+        return {'tables': {}}
+    with open(path, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+def save_manifest(output_dir: str, manifest: dict) -> None:
+    path = os.path.join(output_dir, MANIFEST)
+    with open(f"{path}.tmp", 'w', encoding='utf-8') as file:
+        json.dump(manifest, file, indent=1)
+    os.replace(f"{path}.tmp", path)
+
+def export_table(conn: psycopg2.extensions.connection, table_name: str, output_dir: str, previous: dict,
+                 force: bool = False) -> dict:
+    """Write the changed partitions of a table and delete the ones that no longer exist, returns its manifest entry"""
+    with conn.cursor() as cursor:
+        columns = table_columns(cursor, table_name)
+        fingerprints = partition_fingerprints(cursor, table_name, columns)
+    conn.commit()
+
+    old_partitions = previous.get('partitions', {})
+    partitions, written = {}, 0
+    for partition, fingerprint in sorted(fingerprints.items()):
+        path = partition_path(output_dir, table_name, partition)
+        entry = {'rows': fingerprint['rows'], 'hash': fingerprint['hash'], 'file': os.path.relpath(path, output_dir)}
+        old = old_partitions.get(partition)
+        if force or not old or old['hash'] != entry['hash'] or old['rows'] != entry['rows'] or not os.path.exists(path):
+            write_file(to_arrow(read_partition(conn, table_name, fingerprint), columns, bool(partition)), path)
+            written += 1
+        partitions[partition] = entry
+
+    for partition in set(old_partitions) - set(partitions):
+        path = partition_path(output_dir, table_name, partition)
+        if os.path.exists(path):
+            os.remove(path)
+        if partition:   # The FREQ=x/year=y folder
+            shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+    if written or len(partitions) != len(old_partitions):
+        print(f"Exported {table_name}: {written} of {len(partitions)} partitions written, "
+              f"{len(set(old_partitions) - set(partitions))} removed")
+    return {'columns': columns, 'rows': sum(entry['rows'] for entry in partitions.values()),
+            'partitioning': ['FREQ', 'year'] if is_partitioned(columns) else [], 'partitions': partitions}
+
+def export_snapshot(output_dir: str = EXPORT_DIR, tables: list[str] = None, force: bool = False,
+                    conn: psycopg2.extensions.connection = None) -> dict:
+    """
+    Bring the Parquet snapshot in output_dir up to date and return its manifest
+    tables = tables to export, every facts_*, dim_cl_* and the hierarchy by default
+    force = write every partition again, also the unchanged ones
+    """
+    start = time.time()
+    own_conn = conn is None
+    conn = conn or get_db_connection()
+    manifest = load_manifest(output_dir)
+    try:
+        if tables is None:
+            with conn.cursor() as cursor:
+                tables = list_tables(cursor)
+            conn.commit()
+        for table_name in tables:
+            manifest['tables'][table_name] = export_table(conn, table_name, output_dir,
+                                                          manifest['tables'].get(table_name, {}), force)
+            manifest['exported_at'] = datetime.now(timezone.utc).isoformat(timespec='seconds')
+            save_manifest(output_dir, manifest)     # After every table, an interrupted export keeps what it wrote
+    finally:
+        if own_conn:
+            conn.close()
+    print(f"Snapshot of {len(tables)} tables in {output_dir} up to date in {time.time() - start:.1f}s")
+    return manifest
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the fact and dimension tables to partitioned Parquet")
+    parser.add_argument('tables', nargs='*', help="tables to export, all the facts_*, dim_cl_* and the hierarchy by default")
+    parser.add_argument('--dir', default=EXPORT_DIR, help="folder of the snapshot")
+    parser.add_argument('--force', action='store_true', help="write again also the unchanged partitions")
+    args = parser.parse_args()
+    export_snapshot(args.dir, args.tables or None, args.force)
@@ -0,0 +1,329 @@
+import argparse
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+from os import getenv
+from dotenv import load_dotenv
+import pandas as pd
+from bulk_loader import bulk_upsert
+from db import close_pool, connection, fetch_data_from_db
+from dimension_loader import content_hash, discover_dimensions, load_dimensions
+from geocoding_cache import GeocodingCache
+from heriarcy_location import process_geographic_hierarchy as assign_parents
+from hierarcy_location_handler import NUTS_MACRO_AREAS, add_coordinates, fill_missing_coordinates, process_geographic_hierarchy
+from http_cache import MODES as CACHE_MODES, HttpCache
+from indicators import FACTS as INDICATOR_FACTS, INDICATORS, INPUTS, build_indicators
+from instrumentation import RunReport
+from location_index import SOURCE_TABLE, build_closure
+from location_rollup import CUBES, HIERARCHY_COLUMNS, HIERARCHY_TABLE, build_rollup
+from reporting_layer import REPORTS, create_reports, refresh_reports
+from sdmx_importer import HEADERS, build_url, get_table_name, import_dataflow, metadata_dir
+from sdmx_structure import STRUCTURE_HEADERS, create_fact_table, extract_dataflow, structure_url
+from spatial_index import DEFAULT_K, DEFAULT_RADIUS_KM, build_neighbours
+
+load_dotenv()
+
+# Command line pipeline replacing the notebooks: the stages (metadata of every dataflow, dimension tables, facts,
+# location hierarchy and its closure table, geocoding and the neighbours of the communes, materialized reports,
+# indicators and rollup cubes) run as a DAG, the independent ones in parallel.
+# Every stage has a key, the hash of its inputs (HTTP response digests, codelist files, SQL, settings) and of the keys
+# of the stages it depends on. The keys of the last successful run are kept in pipeline_state.json, a stage whose key
+# didn't change (and whose artifact is still on disk) is skipped, so a run interrupted by an error resumes from the
+# stages that failed
+
+PIPELINE_DIR = getenv('pipeline_dir', os.path.join('csv', 'pipeline'))
+STATE_FILE = 'pipeline_state.json'
+HIERARCHY_SQL = os.path.join('script_sql', 'select_location_hierarchy.sql')
+FILL_STRATEGY = 'mean'  # Coordinates of the regions and provinces, from their communes
+DEFAULT_WORKERS = 4
+
+
+def stage_key(name: str, inputs: list, dep_keys: list[str]) -> str:
+    """sha256 of the stage name, its inputs and the keys of its dependencies"""
+    payload = json.dumps([name, inputs, dep_keys], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def read_text(path: str) -> str:
+    with open(path, 'r', encoding='utf-8') as file:
+        return file.read()
+
+def load_state(output_dir: str) -> dict:
+    path = os.path.join(output_dir, STATE_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+def save_state(output_dir: str, state: dict) -> None:
+    os.makedirs(output_dir, exist_ok=True)
+    path = os.path.join(output_dir, STATE_FILE)
+    with open(f"{path}.tmp", 'w', encoding='utf-8') as file:
+        json.dump(state, file, indent=1)
+    os.replace(f"{path}.tmp", path)
+
+
+def fetch_metadata(dataflow: str, table_name: str, cache: HttpCache) -> int:
+    """Extract the codelists and the DDL of the fact table of a dataflow (table_name None: FACT_TABLES or its title),
+    returns its dimensions"""
+    return len(extract_dataflow(dataflow, cache, table_name=table_name)['dimensions'])
+
+def import_facts(dataflow: str, table_name: str, filter: str, timeframe: str, datatype: str, cache: HttpCache) -> int:
+    """Create the fact table if missing and load the dataflow, the reports and cubes are left to their stages"""
+    create_fact_table(dataflow)
+    return import_dataflow(dataflow, filter, timeframe, datatype, table_name=table_name, cache=cache, refresh=False)
+
+def build_hierarchy(artifact: str) -> int:
+    """Assign the parent_ID of every area of the facts and replace the hierarchy table with it"""
+    df = fetch_data_from_db(HIERARCHY_SQL)
+    df = assign_parents(process_geographic_hierarchy(df))   # Names and codes of the levels, then the parent_ID
+    os.makedirs(os.path.dirname(artifact), exist_ok=True)
+    df.to_pickle(artifact)
+    with connection() as conn:
+        bulk_upsert(conn, df[HIERARCHY_COLUMNS], HIERARCHY_TABLE, ['id'], mode='sync')
+    return len(df)
+
+def geocode_hierarchy(hierarchy: str, artifact: str) -> int:
+    """Coordinates of the communes (the regions and provinces take the mean of theirs) added to the hierarchy table"""
+    df = pd.read_pickle(hierarchy)
+    with GeocodingCache() as cache:
+        df = add_coordinates(df, cache)
+    df = fill_missing_coordinates(df, FILL_STRATEGY)
+    df['Latitudine'] = pd.to_numeric(df['Latitudine'], errors='coerce')
+    df['Longitudine'] = pd.to_numeric(df['Longitudine'], errors='coerce')
+    df.to_pickle(artifact)
+    with connection() as conn:
+        bulk_upsert(conn, df[HIERARCHY_COLUMNS + ['Latitudine', 'Longitudine']], HIERARCHY_TABLE, ['id'])
+    return int(df['Latitudine'].notna().sum())
+
+def refresh_views() -> int:
+    """Create the missing materialized reports and refresh all of them"""
+    with connection() as conn:
+        create_reports(conn)
+        return len(refresh_reports(conn))
+
+def refresh_indicators() -> int:
+    with connection() as conn:
+        return build_indicators(conn)
+
+def build_cubes() -> int:
+    with connection() as conn:
+        return sum(build_rollup(conn, cube) for cube in CUBES)
+
+
+def build_stages(dataflows: list[str], filter: str, timeframe: str, datatype: str, cache: HttpCache,
+                 output_dir: str = PIPELINE_DIR, tables: dict[str, str] = None) -> dict[str, dict]:
+    """
+    {stage: {'deps', 'inputs', 'run', 'artifact'}} of the pipeline
+    tables = fact table of a dataflow, FACT_TABLES (the tables the reports, cubes and hierarchy read) or its title
+             for the ones missing: the title is read when the stages run, after metadata wrote dataflows.json
+    deps = stages that have to succeed first
+    inputs = function returning what the stage reads, hashed into its key
+    run = function doing the work, returns the rows (or items) it produced
+    artifact = file the stage writes, the stage runs again when it's missing
+    """
+    hierarchy_file = os.path.join(output_dir, 'hierarchy.pkl')
+    geocoded_file = os.path.join(output_dir, 'hierarchy_geocoded.pkl')
+    facts = [f"facts:{dataflow}" for dataflow in dataflows]
+    stages = {}
+    for dataflow in dataflows:
+        table = (tables or {}).get(dataflow)    # None: resolved by the stages
+        stages[f"metadata:{dataflow}"] = {
+            'deps': [],
+            'inputs': lambda dataflow=dataflow, table=table: [table,
+                                                              cache.fetch(structure_url(dataflow), STRUCTURE_HEADERS)],
+            'run': lambda dataflow=dataflow, table=table: fetch_metadata(dataflow, table, cache),
+            'artifact': os.path.join(metadata_dir(dataflow), 'dimensions.json'),
+        }
+        stages[f"facts:{dataflow}"] = {
+            'deps': ['dimensions', f"metadata:{dataflow}"],
+            'inputs': lambda dataflow=dataflow, table=table: [
+                table or get_table_name(dataflow), filter, timeframe, datatype,
+                cache.fetch(build_url(dataflow, filter, timeframe), HEADERS[datatype])],
+            'run': lambda dataflow=dataflow, table=table: import_facts(dataflow, table or get_table_name(dataflow), filter,
+                                                                       timeframe, datatype, cache),
+        }
+    stages['dimensions'] = {
+        'deps': [f"metadata:{dataflow}" for dataflow in dataflows],
+        'inputs': lambda: [(table_name, content_hash(paths)) for table_name, paths in sorted(discover_dimensions().items())],
+        'run': lambda: len(load_dimensions()),
+    }
+    stages['closure'] = {
+        'deps': ['dimensions'],   # The codes come from the dimension tables, their key covers the codelist files
+        'inputs': lambda: [SOURCE_TABLE],
+        'run': build_closure,
+    }
+    stages['hierarchy'] = {
+        'deps': facts,
+        'inputs': lambda: [read_text(HIERARCHY_SQL), NUTS_MACRO_AREAS],
+        'run': lambda: build_hierarchy(hierarchy_file),
+        'artifact': hierarchy_file,
+    }
+    stages['geocode'] = {
+        'deps': ['hierarchy'],
+        'inputs': lambda: [getenv('geocoding_backend', 'nominatim'), FILL_STRATEGY],
+        'run': lambda: geocode_hierarchy(hierarchy_file, geocoded_file),
+        'artifact': geocoded_file,
+    }
+    stages['neighbours'] = {
+        'deps': ['geocode'],
+        'inputs': lambda: [DEFAULT_RADIUS_KM, DEFAULT_K],
+        'run': build_neighbours,
+    }
+    stages['reports'] = {
+        'deps': facts,
+        'inputs': lambda: sorted(REPORTS),
+        'run': refresh_views,
+    }
+    stages['indicators'] = {
+        'deps': facts,
+        'inputs': lambda: [INDICATOR_FACTS, INPUTS, INDICATORS],
+        'run': refresh_indicators,
+    }
+    stages['rollups'] = {
+        'deps': ['hierarchy'] + facts,
+        'inputs': lambda: CUBES,
+        'run': build_cubes,
+    }
+    return stages
+
+
+class Pipeline:
+    """Runs the stages in dependency order on a thread pool, skipping the ones whose key didn't change"""
+
+    def __init__(self, stages: dict[str, dict], output_dir: str = PIPELINE_DIR, workers: int = DEFAULT_WORKERS,
+                 force: bool = False, report: RunReport = None):
+        """force = run the selected stages even when their key didn't change"""
+        self.stages = stages
+        self.output_dir = output_dir
+        self.workers = workers
+        self.force = force
+        self.report = report or RunReport('pipeline', report_dir=None, profile_dir=None)
+        self.state = load_state(output_dir)
+        self.keys = {}
+        self.lock = threading.Lock()
+
+    def select(self, targets: list[str] = None) -> list[str]:
+        """Stages of the targets (a name or its prefix, e.g. facts) and their dependencies, in dependency order"""
+        names = list(self.stages)
+        if targets:
+            names = [name for name in self.stages if any(name == t or name.startswith(f"{t}:") for t in targets)]
+            unknown = [t for t in targets if not any(name == t or name.startswith(f"{t}:") for name in self.stages)]
+            if unknown:
+                raise ValueError(f"Unknown stages {', '.join(unknown)}, expected one of {', '.join(self.stages)}")
+        order = []
+
+        def visit(name: str) -> None:
+            if name not in order:
+                for dep in self.stages[name]['deps']:
+                    visit(dep)
+                order.append(name)
+
+        for name in names:
+            visit(name)
+        return order
+
+    def run_stage(self, name: str) -> str:
+        """Run a stage, or skip it when it's up to date, returns 'ran' or 'skipped'"""
+        spec = self.stages[name]
+        key = stage_key(name, spec['inputs'](), [self.keys[dep] for dep in spec['deps']])
+        artifact = spec.get('artifact')
+        previous = self.state.get(name, {})
+        if not self.force and previous.get('key') == key and (artifact is None or os.path.exists(artifact)):
+            self.keys[name] = key
+            print(f"[pipeline] {name} up to date, last run {previous['finished_at']}")
+            return 'skipped'
+
+        start = time.perf_counter()
+        with self.report.stage(name) as stage:
+            stage.rows_out = spec['run']()
+        with self.lock:     # Saved after every stage, an interrupted run resumes from here
+            self.keys[name] = key
+            self.state[name] = {'key': key, 'finished_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+                                'seconds': round(time.perf_counter() - start, 3), 'artifact': artifact}
+            save_state(self.output_dir, self.state)
+        return 'ran'
+
+    def run(self, targets: list[str] = None) -> dict[str, str]:
+        """
+        Run the targets and their dependencies, returns {stage: 'ran', 'skipped', 'failed' or 'blocked'}
+        A failed stage blocks the ones depending on it, the independent stages go on
+        """
+        order = self.select(targets)
+        status, running = {}, {}
+        pending = list(order)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while pending or running:
+                for name in list(pending):  # In dependency order, so a block reaches the whole subtree in one pass
+                    deps = [status.get(dep) for dep in self.stages[name]['deps']]
+                    if any(dep in ('failed', 'blocked') for dep in deps):
+                        status[name] = 'blocked'
+                        pending.remove(name)
+                    elif all(dep in ('ran', 'skipped') for dep in deps):
+                        running[executor.submit(self.run_stage, name)] = name
+                        pending.remove(name)
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        status[name] = future.result()
+                    except Exception as e:
+                        status[name] = 'failed'
+                        print(f"[pipeline] {name} failed: {e}")
+
+        summary = {outcome: [name for name in order if status[name] == outcome]
+                   for outcome in ('ran', 'skipped', 'failed', 'blocked')}
+        print("[pipeline] " + ", ".join(f"{len(names)} {outcome}" for outcome, names in summary.items()) +
+              "".join(f"\n  {outcome}: {', '.join(names)}" for outcome, names in summary.items()
+                      if outcome in ('failed', 'blocked') and names))
+        return status
+
+
+def parse_args() -> argparse.Namespace:
+    """Command line options, the defaults come from .env like in the notebooks"""
+    parser = argparse.ArgumentParser(description="Run the ISTAT import pipeline, skipping the stages that are up to date")
+    parser.add_argument('targets', nargs='*', help="stages to run with their dependencies (metadata, dimensions, facts, "
+                                                   "closure, hierarchy, geocode, neighbours, reports, indicators, "
+                                                   "rollups), all of them by default")
+    parser.add_argument('--dataflow', action='append', help="dataflow id, can be repeated (dataflow of .env by default)")
+    parser.add_argument('--table', action='append', metavar='DATAFLOW=TABLE',
+                        help="fact table of a dataflow, can be repeated (FACT_TABLES or its title by default)")
+    parser.add_argument('--filter', default=getenv('filter'), help="SDMX key filter, e.g. ...ITC3+ITC31.......")
+    parser.add_argument('--timeframe', default=getenv('timeframe'), help="query string, e.g. startPeriod=2016-01-01")
+    parser.add_argument('--format', choices=('csv', 'json'), default='json' if getenv('datatype') == '1' else 'csv')
+    parser.add_argument('--cache', choices=CACHE_MODES, default=getenv('http_cache_mode', 'use'),
+                        help="HTTP cache mode: use, offline (only cached responses), refresh or off")
+    parser.add_argument('--dir', default=PIPELINE_DIR, help="folder of the artifacts and of the pipeline state")
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help="stages run at the same time")
+    parser.add_argument('--force', action='store_true', help="run the selected stages even when they are up to date")
+    parser.add_argument('--list', action='store_true', help="show the stages and their last run, without running them")
+    args = parser.parse_args()
+    if any('=' not in option for option in args.table or []):
+        parser.error("--table expects DATAFLOW=TABLE, e.g. 122_54=facts_turismo")
+    args.tables = dict(option.split('=', 1) for option in args.table or [])
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    report = RunReport('pipeline', profile_dir=None)    # cProfile can't profile stages running on several threads
+    with HttpCache(mode=args.cache) as cache:
+        stages = build_stages(args.dataflow or [getenv('dataflow')], args.filter, args.timeframe, args.format,
+                              cache, args.dir, args.tables)
+        pipeline = Pipeline(stages, args.dir, args.workers, args.force, report)
+        if args.list:
+            for name in pipeline.select(args.targets):
+                last = pipeline.state.get(name, {})
+                print(f"{name:<24} after {', '.join(stages[name]['deps']) or '-':<40} "
+                      f"last run {last.get('finished_at', 'never')}")
+        else:
+            try:
+                status = pipeline.run(args.targets)
+            finally:
+                close_pool()
+            report.save()
+            if any(outcome in ('failed', 'blocked') for outcome in status.values()):
+                raise SystemExit(1)
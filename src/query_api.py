@@ -0,0 +1,410 @@
+import argparse
+import io
+import itertools
+import json
+import re
+import select
+import signal
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import getenv
+from typing import Iterator
+from urllib.parse import parse_qs, urlsplit
+from dotenv import load_dotenv
+import pandas as pd
+import psycopg2
+from psycopg2 import sql
+from db import POOL_MAX, close_pool, connection, get_db_connection, iter_query
+from location_index import CLOSURE_TABLE
+from location_rollup import HIERARCHY_TABLE
+from refresh_daemon import CHANNEL, RECONNECT_SECONDS, RESCAN_SECONDS
+from reporting_layer import REPORTS, has_column, key_names, mat_name, relation_exists, report_query
+
+try:    # Optional, Arrow IPC stream responses
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+load_dotenv()
+
+# Read-only HTTP query service for the dashboards and notebooks: the tourism reports and gerarchia_luogo filtered by
+# area subtree (through the closure table), period range, data type and accommodation type, read from the materialized
+# copies of the reports when they exist (the live joins otherwise) on pooled connections in read-only transactions and
+# streamed chunk by chunk as CSV, JSON or Arrow. The encoded responses are kept in an LRU cache in memory; every entry
+# remembers the load generation of the tables it was read from, which the triggers of refresh_daemon.py (and the daemon
+# after refreshing a copy) bump with a NOTIFY at each committed load, so a repeated request is served from memory until
+# one of its tables changes:
+#   GET /vista_turismo_mensile?area=ITC3&from=2019-01&to=2023&data_type=NI,AR&format=csv
+
+API_HOST = '127.0.0.1'
+API_PORT = int(getenv('query_api_port', 8050))
+CACHE_MB = float(getenv('query_cache_mb', 256))
+ENTRY_FRACTION = 4      # A response larger than 1/4 of the cache is streamed without being cached
+MB = 1024 * 1024
+QUERY_REPORTS = [report for report in REPORTS if report.startswith('vista_turismo_')]
+FACT_FILTERS = {'data_type': 'DATA_TYPE', 'accommodation': 'TYPE_ACCOMMODATION'}   # Parameter -> fact column (codes)
+LIST_FILTERS = ('area', *FACT_FILTERS)      # Repeated or comma separated codes
+PERIOD_FILTERS = ('from', 'to')
+PERIOD_PATTERN = r'^\d{4}(-[A-Z]?\d{1,2})?$'
+
+
+def parse_filters(params: dict[str, list[str]]) -> dict:
+    """Filters of a query string parsed by parse_qs, normalized so the same filters give the same cache key"""
+    filters = {}
+    for name, values in params.items():
+        values = [value.strip() for value in ','.join(values).split(',') if value.strip()]
+        if name in LIST_FILTERS:
+            if values:
+                filters[name] = tuple(sorted(set(values)))
+        elif name in PERIOD_FILTERS:
+            if len(values) != 1 or not re.match(PERIOD_PATTERN, values[0]):
+                raise ValueError(f"{name} takes one period, e.g. 2023, 2023-05 or 2023-Q2")
+            filters[name] = values[0]
+        else:
+            raise ValueError(f"Unknown parameter {name}, the filters are {', '.join(LIST_FILTERS + PERIOD_FILTERS)}")
+    return filters
+
+def area_condition(column: sql.Composable, areas: tuple) -> sql.Composed:
+    """Codes in the subtree of any of the areas (themselves included), an index range scan of the closure table"""
+    return sql.SQL("{} IN (SELECT descendant FROM {} WHERE ancestor = ANY({}))").format(
+        column, sql.Identifier(CLOSURE_TABLE), sql.Literal(list(areas)))
+
+def report_conditions(name: str, filters: dict, column) -> list[sql.Composed]:
+    """WHERE conditions of the filters of a report, column(fact column) = the column of the query they apply to"""
+    spec, conditions = REPORTS[name], []
+    if 'area' in filters:   # First column, as in the indexes
+        conditions.append(area_condition(column(spec['columns'][0][0]), filters['area']))
+    if 'from' in filters:
+        conditions.append(sql.SQL("{} >= {}").format(column('TIME_PERIOD'), sql.Literal(filters['from'])))
+    if 'to' in filters:     # '~' sorts after the digits and '-', so to=2023 keeps 2023-12 and 2023-Q4
+        conditions.append(sql.SQL("{} <= {}").format(column('TIME_PERIOD'), sql.Literal(filters['to'] + '~')))
+    for parameter, fact_col in FACT_FILTERS.items():
+        if parameter in filters:
+            conditions.append(sql.SQL("{} = ANY({})").format(column(fact_col), sql.Literal(list(filters[parameter]))))
+    return conditions
+
+def dataset_query(name: str, filters: dict) -> tuple[sql.Composed, set[str]]:
+    """
+    SELECT of a dataset with its filters (the live joins of a report) and the tables its rows come from, KeyError for
+    an unknown dataset
+    """
+    if name == HIERARCHY_TABLE:
+        if set(filters) - {'area'}:
+            raise ValueError(f"{HIERARCHY_TABLE} can only be filtered by area")
+        query, tables = sql.SQL("SELECT * FROM {} g").format(sql.Identifier(HIERARCHY_TABLE)), {HIERARCHY_TABLE}
+        if 'area' in filters:
+            query += sql.SQL(" WHERE ") + area_condition(sql.SQL("g.id"), filters['area'])
+            tables.add(CLOSURE_TABLE)
+        return query, tables
+    if name not in QUERY_REPORTS:
+        raise KeyError(name)
+
+    # The materialized copy is refreshed after the facts, refresh_daemon.py notifies its name too
+    spec = REPORTS[name]
+    tables = {spec['fact'], mat_name(name)} | {dim for _, dim, _ in spec['columns'] if dim}
+    if 'area' in filters:
+        tables.add(CLOSURE_TABLE)
+    conditions = report_conditions(name, filters, lambda col: sql.SQL("ft.{}").format(sql.Identifier(col)))
+    return report_query(name, conditions), tables
+
+def materialized_query(cursor: psycopg2.extensions.cursor, name: str, filters: dict) -> sql.Composed | None:
+    """
+    SELECT of a report from its materialized copy, without the joins of the live query, None when the copy doesn't
+    exist or lacks a filtered code (the copies keep only the codes of the fact key)
+    """
+    if name not in QUERY_REPORTS or not relation_exists(cursor, mat_name(name)):
+        return None
+    spec, mat = REPORTS[name], mat_name(name)
+    filtered = ([spec['columns'][0][0]] if 'area' in filters else []) + \
+               [fact_col for parameter, fact_col in FACT_FILTERS.items() if parameter in filters]
+    if not all(has_column(cursor, mat, col) for col in key_names(name, filtered)):
+        return None
+
+    # Same columns of the live query: the codes kept as they are and the names of the others
+    columns = [sql.Identifier(fact_col if dim_table is None else out_col)
+               for fact_col, dim_table, out_col in spec['columns']]
+    columns += [sql.Identifier('TIME_PERIOD'), sql.Identifier('OBS_VALUE')]
+    query = sql.SQL("SELECT {} FROM {} m").format(sql.SQL(', ').join(columns), sql.Identifier(mat))
+    conditions = report_conditions(name, filters, lambda col: sql.SQL("m.{}").format(
+        sql.Identifier(key_names(name, [col])[0])))
+    if conditions:
+        query += sql.SQL(' WHERE ') + sql.SQL(' AND ').join(conditions)
+    return query
+
+
+def count_triggers(conn: psycopg2.extensions.connection) -> int:
+    """Tables with the notify trigger of refresh_daemon.py"""
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT COUNT(DISTINCT event_object_table) FROM information_schema.triggers "
+                       "WHERE trigger_schema = current_schema() AND trigger_name = 'etl_notify_change'")
+        return cursor.fetchone()[0]
+
+
+def encode_csv(chunks: Iterator[pd.DataFrame]) -> Iterator[bytes]:
+    header = True
+    for chunk in chunks:
+        yield chunk.to_csv(index=False, header=header).encode()
+        header = False
+
+def encode_json(chunks: Iterator[pd.DataFrame]) -> Iterator[bytes]:
+    """One array of records, written a chunk at a time"""
+    separator = b'['
+    for chunk in chunks:
+        if len(chunk):
+            yield separator + chunk.to_json(orient='records', force_ascii=False)[1:-1].encode()
+            separator = b','
+    yield b'[]' if separator == b'[' else b']'
+
+def encode_arrow(chunks: Iterator[pd.DataFrame]) -> Iterator[bytes]:
+    """Arrow IPC stream, a record batch per chunk with the schema of the first one"""
+    sink, writer = io.BytesIO(), None
+    for chunk in chunks:
+        if writer is None:  # Columns that are all NULL in the first chunk are text, like every name column
+            schema = pa.Schema.from_pandas(chunk, preserve_index=False)
+            schema = pa.schema([field.with_type(pa.string()) if pa.types.is_null(field.type) else field
+                                for field in schema], metadata=schema.metadata)
+            writer = pa.ipc.new_stream(sink, schema)
+        writer.write_batch(pa.RecordBatch.from_pandas(chunk, schema=schema, preserve_index=False))
+        yield sink.getvalue()
+        sink.seek(0)
+        sink.truncate()
+    writer.close()
+    yield sink.getvalue()
+
+# format parameter -> (content type, encoder)
+FORMATS = {
+    'csv': ('text/csv; charset=utf-8', encode_csv),
+    'json': ('application/json', encode_json),
+    'arrow': ('application/vnd.apache.arrow.stream', encode_arrow),
+}
+
+
+class ResultCache:
+    """
+    LRU of encoded responses up to max_mb, an entry is valid while the load generations of its tables are unchanged
+    The generations are bumped by the NOTIFY of the triggers, nothing is cached or served while nobody is listening
+    """
+
+    def __init__(self, max_mb: float = CACHE_MB):
+        self.max_bytes = int(max_mb * MB)
+        self.max_entry = self.max_bytes // ENTRY_FRACTION
+        self.entries = OrderedDict()    # key -> (generation, body), least recently used first
+        self.size = 0
+        self.generations = {}           # table -> loads seen since the listener connected
+        self.epoch = 0                  # Bumped at every (re)connection, the notifications in between are lost
+        self.listening = False
+        self.hits = self.misses = 0
+        self.lock = threading.Lock()
+
+    def generation(self, tables: set[str]) -> tuple:
+        """Current generation of a set of tables, taken before the query so a load during it makes the entry stale"""
+        with self.lock:
+            return (self.epoch,) + tuple(self.generations.get(table, 0) for table in sorted(tables))
+
+    def bump(self, table: str) -> None:
+        with self.lock:
+            self.generations[table] = self.generations.get(table, 0) + 1
+
+    def get(self, key: tuple, tables: set[str]) -> bytes | None:
+        generation = self.generation(tables)
+        with self.lock:
+            entry = self.entries.get(key) if self.listening else None
+            if entry is not None and entry[0] != generation:
+                self.drop(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: tuple, generation: tuple, body: bytes) -> None:
+        with self.lock:
+            if not self.listening or generation[0] != self.epoch or len(body) > self.max_entry:
+                return
+            self.drop(key)
+            self.entries[key] = (generation, body)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                self.drop(next(iter(self.entries)))
+
+    def drop(self, key: tuple) -> None:
+        """Remove an entry, the caller holds the lock"""
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+
+    def set_listening(self, listening: bool) -> None:
+        """Start or stop caching, the entries and the generations seen so far can't be trusted anymore either way"""
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+            self.epoch += 1
+            self.listening = listening
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'listening': self.listening, 'entries': len(self.entries), 'size_mb': round(self.size / MB, 1),
+                    'hits': self.hits, 'misses': self.misses, 'generations': dict(self.generations)}
+
+    def listen(self, stopping: threading.Event) -> None:
+        """LISTEN to the load notifications until stopping is set, reconnecting when the connection drops"""
+        while not stopping.is_set():
+            try:
+                conn = get_db_connection()
+            except psycopg2.OperationalError as e:
+                print(f"Cannot connect the listener, retrying in {RECONNECT_SECONDS}s: {e}")
+                stopping.wait(RECONNECT_SECONDS)
+                continue
+            try:
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                with conn.cursor() as cursor:
+                    cursor.execute(sql.SQL("LISTEN {}").format(sql.Identifier(CHANNEL)))
+                check_at, reported = 0, None
+                while not stopping.is_set():
+                    if time.monotonic() > check_at:    # Without the triggers nothing would invalidate the entries
+                        triggers = count_triggers(conn)
+                        if bool(triggers) != reported:
+                            print(f"Listening on {CHANNEL} for the loads of {triggers} tables, caching is on"
+                                  if triggers else "No load triggers, caching is off until refresh_daemon.py --install")
+                            reported = bool(triggers)
+                        if reported != self.listening:
+                            self.set_listening(reported)
+                        check_at = time.monotonic() + RESCAN_SECONDS
+                    if select.select([conn], [], [], 1.0)[0]:
+                        conn.poll()
+                        while conn.notifies:
+                            self.bump(conn.notifies.pop(0).payload)
+            except psycopg2.OperationalError as e:
+                print(f"Listener connection lost, reconnecting in {RECONNECT_SECONDS}s: {e}")
+                stopping.wait(RECONNECT_SECONDS)
+            finally:
+                self.set_listening(False)   # The notifications are lost until the next connection
+                conn.close()
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """GET / lists the datasets, /stats the cache counters, /<dataset>?<filters>&format= runs a query"""
+
+    server_version = 'TurismoQueryAPI/1.0'
+
+    def do_GET(self) -> None:
+        url = urlsplit(self.path)
+        name, params = url.path.strip('/'), parse_qs(url.query, keep_blank_values=True)
+        if name == '':
+            return self.send_json({'datasets': {report: list(LIST_FILTERS + PERIOD_FILTERS) for report in QUERY_REPORTS}
+                                   | {HIERARCHY_TABLE: ['area']}, 'formats': list(FORMATS)})
+        if name == 'stats':
+            return self.send_json(self.server.cache.stats())
+        try:
+            fmt = params.pop('format', ['json'])[-1]
+            if fmt not in FORMATS:
+                raise ValueError(f"Unknown format {fmt}, the formats are {', '.join(FORMATS)}")
+            if fmt == 'arrow' and pa is None:
+                raise ValueError("The arrow format needs pyarrow (pip install pyarrow)")
+            filters = parse_filters(params)
+            query, tables = dataset_query(name, filters)
+        except KeyError:
+            return self.send_json({'error': f"Unknown dataset {name}"}, 404)
+        except ValueError as e:
+            return self.send_json({'error': str(e)}, 400)
+        self.run_query((name, tuple(sorted(filters.items())), fmt), query, tables, fmt)
+
+    def run_query(self, key: tuple, query: sql.Composed, tables: set[str], fmt: str) -> None:
+        """Send the cached response, or stream the query and cache it when it fits"""
+        start, cache = time.time(), self.server.cache
+        content_type, encoder = FORMATS[fmt]
+        body = cache.get(key, tables)
+        if body is not None:
+            self.send_body(body, content_type, {'X-Cache': 'hit'})
+            print(f"{datetime.now():%H:%M:%S} {self.path}: {len(body)} bytes from the cache in "
+                  f"{(time.time() - start) * 1000:.1f}ms")
+            return
+
+        generation, parts, size = cache.generation(tables), [], 0
+        with self.server.slots, connection() as conn:     # One pooled connection per running query
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute("SET TRANSACTION READ ONLY")
+                    # key = (dataset, filters, format): the materialized copy of a report when it exists
+                    query = materialized_query(cursor, key[0], dict(key[1])) or query
+                chunks = iter_query(query, conn=conn)
+                first = next(chunks)    # Errors of the query still get a status, before the headers are sent
+            except psycopg2.errors.UndefinedTable as e:
+                return self.send_json({'error': f"Missing table, build it first: {e.diag.message_primary}"}, 503)
+            except psycopg2.Error as e:
+                return self.send_json({'error': e.diag.message_primary or str(e)}, 500)
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('X-Cache', 'miss')
+            self.end_headers()
+            try:
+                for piece in encoder(itertools.chain([first], chunks)):
+                    self.wfile.write(piece)
+                    size += len(piece)
+                    if parts is not None:
+                        parts.append(piece)
+                        parts = parts if size <= cache.max_entry else None
+            except (BrokenPipeError, ConnectionResetError):
+                print(f"{datetime.now():%H:%M:%S} {self.path}: client gone after {size} bytes")
+                return
+            finally:
+                chunks.close()  # Before the transaction ends, with the named cursor still open
+        if parts is not None:
+            cache.put(key, generation, b''.join(parts))
+        print(f"{datetime.now():%H:%M:%S} {self.path}: {size} bytes from the database in {time.time() - start:.2f}s"
+              f"{'' if parts is not None else ' (not cached)'}")
+
+    def send_body(self, body: bytes, content_type: str, headers: dict = None, status: int = 200) -> None:
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, data, status: int = 200) -> None:
+        self.send_body(json.dumps(data).encode(), 'application/json', status=status)
+
+    def log_request(self, code='-', size='-') -> None:
+        pass    # The queries print their own line with size and time
+
+    def log_message(self, format: str, *args) -> None:
+        print(f"{datetime.now():%H:%M:%S} {self.address_string()} {format % args}")
+
+
+def create_server(host: str = API_HOST, port: int = API_PORT, cache_mb: float = CACHE_MB) -> ThreadingHTTPServer:
+    """Server with its result cache, the queries running at once are bounded by the connections of the pool"""
+    server = ThreadingHTTPServer((host, port), QueryHandler)
+    server.cache = ResultCache(cache_mb)
+    server.slots = threading.BoundedSemaphore(POOL_MAX)
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Read-only HTTP query service over the tourism reports")
+    parser.add_argument('--host', default=API_HOST, help="address to listen on, 0.0.0.0 to serve the network")
+    parser.add_argument('--port', type=int, default=API_PORT)
+    parser.add_argument('--cache-mb', type=float, default=CACHE_MB, help="memory for the cached responses")
+    args = parser.parse_args()
+
+    server = create_server(args.host, args.port, args.cache_mb)
+    stopping = threading.Event()
+    listener = threading.Thread(target=server.cache.listen, args=(stopping,), name='listener', daemon=True)
+    listener.start()
+    signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown).start())
+    print(f"Serving on http://{args.host}:{args.port}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stopping.set()
+        server.server_close()
+        listener.join()
+        close_pool()
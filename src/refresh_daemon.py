@@ -0,0 +1,263 @@
+import argparse
+import os
+import re
+import select
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import psycopg2
+from psycopg2 import sql
+from db import connection, get_db_connection
+from indicators import update_indicators
+from location_index import SOURCE_TABLE, build_closure
+from location_rollup import CUBES, HIERARCHY_TABLE, build_rollup, update_rollups
+from pipeline import PIPELINE_DIR, build_hierarchy, geocode_hierarchy
+from reporting_layer import FACT_TABLES, REPORTS, mat_name, refresh_reports
+from spatial_index import build_neighbours
+
+# Daemon keeping the derived data up to date: statement-level triggers on the facts_*, dim_cl_* tables and on
+# gerarchia_luogo send the table name on a NOTIFY channel, the daemon LISTENs and runs only the work downstream of the
+# changed table (materialized reports, rollup cubes, indicators, hierarchy and geocoding of new areas, closure and
+# neighbour tables) on a small thread pool. The notifications of a load are debounced: a job starts when its table has
+# been quiet for the debounce interval, or at the latest max delay after the first notification
+
+CHANNEL = 'etl_table_changed'
+WATCHED = r'^(facts_.*|dim_cl_.*|gerarchia_luogo|gerarchia_luogo_closure)$'   # The closure only for the query API
+HIERARCHY_FACT = FACT_TABLES['122_54']   # Fact table of select_location_hierarchy.sql, its new areas go into the hierarchy
+DEFAULT_DEBOUNCE = 5.0      # Seconds of quiet before a job starts
+DEFAULT_MAX_DELAY = 60.0    # Seconds after the first notification a job starts anyway, during long loads
+DEFAULT_WORKERS = 2
+RESCAN_SECONDS = 300        # Triggers are added to the tables created since the last scan
+RECONNECT_SECONDS = 10
+
+
+def notify_refreshed(conn: psycopg2.extensions.connection, reports: list[str]) -> int:
+    """Send the names of the refreshed copies on the channel (a refresh fires no trigger), the query API reads them"""
+    with conn.cursor() as cursor:
+        for report in reports:
+            cursor.execute("SELECT pg_notify(%s, %s)", (CHANNEL, mat_name(report)))
+    conn.commit()
+    return len(reports)
+
+def refresh_fact_reports(table: str) -> int:
+    with connection() as conn:
+        return notify_refreshed(conn, refresh_reports(conn, table))
+
+def refresh_dimension_reports(table: str) -> int:
+    """Refresh the reports that show the names of a dimension table"""
+    facts = sorted({spec['fact'] for spec in REPORTS.values() if any(dim == table for _, dim, _ in spec['columns'])})
+    with connection() as conn:
+        return sum(notify_refreshed(conn, refresh_reports(conn, fact)) for fact in facts)
+
+def refresh_rollups(table: str) -> int:
+    """Cubes of a fact table, or all of them when the hierarchy changed (a cube is written by one job at a time)"""
+    with connection() as conn:
+        if table == HIERARCHY_TABLE:
+            return sum(build_rollup(conn, cube) for cube in CUBES)
+        update_rollups(conn, table)
+    return 0
+
+def refresh_indicators(table: str) -> int:
+    with connection() as conn:
+        update_indicators(conn, table)
+    return 0
+
+def add_new_areas(table: str) -> int:
+    """Build the hierarchy again and geocode it when the facts have areas missing from it, returns the new areas"""
+    with connection() as conn, conn.cursor() as cursor:
+        # Like select_location_hierarchy.sql, only the codes of the codelist have a name and can be placed
+        cursor.execute(sql.SQL('SELECT COUNT(DISTINCT f."REF_AREA") FROM {} f JOIN {} d ON d.id = f."REF_AREA" '
+                               'WHERE NOT EXISTS (SELECT 1 FROM {} g WHERE g.id = f."REF_AREA")').format(
+            sql.Identifier(table), sql.Identifier(SOURCE_TABLE), sql.Identifier(HIERARCHY_TABLE)))
+        new_areas = cursor.fetchone()[0]
+    if new_areas:   # Only the new names go to the network, the others come from the geocoding cache
+        hierarchy_file = os.path.join(PIPELINE_DIR, 'hierarchy.pkl')
+        build_hierarchy(hierarchy_file)
+        geocode_hierarchy(hierarchy_file, os.path.join(PIPELINE_DIR, 'hierarchy_geocoded.pkl'))
+    return new_areas
+
+def rebuild_closure(table: str) -> int:
+    return build_closure()
+
+def rebuild_neighbours(table: str) -> int:
+    return build_neighbours()
+
+# Work downstream of a table: (table pattern, jobs), every job gets the name of the changed table
+ROUTES = [
+    (r'^facts_', [refresh_fact_reports, refresh_rollups, refresh_indicators]),
+    (f"^{HIERARCHY_FACT}$", [add_new_areas]),
+    (r'^dim_cl_', [refresh_dimension_reports]),
+    (f"^{SOURCE_TABLE}$", [rebuild_closure]),
+    (f"^{HIERARCHY_TABLE}$", [refresh_rollups, rebuild_neighbours]),
+]
+
+
+def jobs_for(table: str) -> list:
+    return [job for pattern, jobs in ROUTES if re.match(pattern, table) for job in jobs]
+
+def install_function(conn: psycopg2.extensions.connection) -> None:
+    """Create the notify function the triggers run, once at startup"""
+    with conn.cursor() as cursor:
+        cursor.execute(sql.SQL("""
+            CREATE OR REPLACE FUNCTION etl_notify_change() RETURNS trigger LANGUAGE plpgsql AS $$
+            BEGIN
+                PERFORM pg_notify({channel}, TG_TABLE_NAME);    -- Sent at commit, once per table and transaction
+                RETURN NULL;
+            END $$
+        """).format(channel=sql.Literal(CHANNEL)))
+    conn.commit()
+
+def install_triggers(conn: psycopg2.extensions.connection) -> list[str]:
+    """Create a statement-level trigger on the watched tables that have none yet, returns the tables"""
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT table_name FROM information_schema.tables WHERE table_schema = current_schema() "
+                       "AND table_type = 'BASE TABLE' AND table_name ~ %s AND table_name NOT IN ("
+                       "SELECT event_object_table FROM information_schema.triggers "
+                       "WHERE trigger_schema = current_schema() AND trigger_name = 'etl_notify_change') "
+                       "ORDER BY table_name", (WATCHED,))
+        tables = [row[0] for row in cursor.fetchall()]
+        for table in tables:
+            cursor.execute(sql.SQL("CREATE TRIGGER etl_notify_change AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE "
+                                   "ON {} FOR EACH STATEMENT EXECUTE FUNCTION etl_notify_change()").format(sql.Identifier(table)))
+    conn.commit()
+    return tables
+
+def uninstall_triggers(conn: psycopg2.extensions.connection) -> None:
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT event_object_table FROM information_schema.triggers WHERE trigger_schema = current_schema() "
+                       "AND trigger_name = 'etl_notify_change' GROUP BY 1")
+        for (table,) in cursor.fetchall():
+            cursor.execute(sql.SQL("DROP TRIGGER etl_notify_change ON {}").format(sql.Identifier(table)))
+        cursor.execute("DROP FUNCTION IF EXISTS etl_notify_change()")
+    conn.commit()
+
+
+class RefreshDaemon:
+    """Debounces the notifications into jobs and runs them on a bounded pool, the same job never runs twice at once"""
+
+    def __init__(self, debounce: float = DEFAULT_DEBOUNCE, max_delay: float = DEFAULT_MAX_DELAY,
+                 workers: int = DEFAULT_WORKERS):
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='refresh')
+        self.pending = {}   # (job, table) -> [first notification, last notification]
+        self.running = set()
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+
+    def notify(self, table: str, now: float = None) -> None:
+        """Schedule the jobs downstream of a changed table"""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            for job in jobs_for(table):
+                times = self.pending.setdefault((job, table), [now, now])
+                times[1] = now
+
+    def due(self, now: float) -> float | None:
+        """Start the jobs that are due, returns the seconds until the next one (None when nothing is pending)"""
+        next_due = None
+        with self.lock:
+            for key, (first, last) in list(self.pending.items()):
+                deadline = min(last + self.debounce, first + self.max_delay)
+                if key in self.running:     # Waits for the running one, the new changes need another pass
+                    continue
+                if deadline <= now:
+                    del self.pending[key]
+                    self.running.add(key)
+                    self.executor.submit(self.run_job, key, first)
+                else:
+                    next_due = deadline - now if next_due is None else min(next_due, deadline - now)
+        return next_due
+
+    def run_job(self, key: tuple, first: float) -> None:
+        job, table = key
+        start = time.monotonic()
+        try:
+            result = job(table)
+            print(f"{datetime.now():%H:%M:%S} {job.__name__}({table}): {result} in {time.monotonic() - start:.1f}s, "
+                  f"{time.monotonic() - first:.1f}s after the change")
+        except Exception as e:
+            print(f"{datetime.now():%H:%M:%S} {job.__name__}({table}) failed: {e}")
+        finally:
+            with self.lock:
+                self.running.discard(key)
+
+    def listen(self) -> None:
+        """LISTEN on the channel until stop(), reconnecting when the connection drops"""
+        while not self.stopping.is_set():
+            try:
+                conn = get_db_connection()
+            except psycopg2.OperationalError as e:
+                print(f"Cannot connect, retrying in {RECONNECT_SECONDS}s: {e}")
+                self.stopping.wait(RECONNECT_SECONDS)
+                continue
+            try:
+                install_function(conn)
+                tables = install_triggers(conn)
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                with conn.cursor() as cursor:
+                    cursor.execute(sql.SQL("LISTEN {}").format(sql.Identifier(CHANNEL)))
+                print(f"Listening on {CHANNEL}, triggers added on {len(tables)} tables")
+                rescan_at = time.monotonic() + RESCAN_SECONDS
+                while not self.stopping.is_set():
+                    timeout = self.due(time.monotonic())
+                    timeout = 1.0 if timeout is None else min(timeout, 1.0)     # Wakes up to check stopping
+                    if select.select([conn], [], [], timeout)[0]:
+                        conn.poll()
+                        while conn.notifies:
+                            self.notify(conn.notifies.pop(0).payload)
+                    if time.monotonic() > rescan_at:
+                        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED)
+                        tables = install_triggers(conn)     # Only the tables created since the last scan
+                        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                        if tables:
+                            print(f"Triggers added on {', '.join(tables)}")
+                        rescan_at = time.monotonic() + RESCAN_SECONDS
+            except psycopg2.OperationalError as e:
+                print(f"Connection lost, reconnecting in {RECONNECT_SECONDS}s: {e}")
+                self.stopping.wait(RECONNECT_SECONDS)
+            finally:
+                conn.close()
+
+    def stop(self, *_) -> None:
+        self.stopping.set()
+
+    def close(self) -> None:
+        """Wait for the running jobs, the pending ones are left to the next start"""
+        self.executor.shutdown(wait=True)
+        if self.pending:
+            print(f"Stopped with {len(self.pending)} jobs pending: "
+                  + ", ".join(f"{job.__name__}({table})" for job, table in self.pending))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Refresh the reports, cubes and derived tables when the data changes")
+    parser.add_argument('--debounce', type=float, default=DEFAULT_DEBOUNCE, help="seconds of quiet before a job starts")
+    parser.add_argument('--max-delay', type=float, default=DEFAULT_MAX_DELAY,
+                        help="seconds after the first change a job starts even if the changes go on")
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help="jobs running at the same time")
+    parser.add_argument('--install', action='store_true', help="only create the triggers")
+    parser.add_argument('--uninstall', action='store_true', help="drop the triggers and the notify function")
+    args = parser.parse_args()
+
+    if args.install or args.uninstall:
+        conn = get_db_connection()
+        try:
+            if args.uninstall:
+                uninstall_triggers(conn)
+                print("Triggers dropped")
+            else:
+                install_function(conn)
+                print(f"Triggers added on {len(install_triggers(conn))} tables")
+        finally:
+            conn.close()
+    else:
+        daemon = RefreshDaemon(args.debounce, args.max_delay, args.workers)
+        signal.signal(signal.SIGINT, daemon.stop)
+        signal.signal(signal.SIGTERM, daemon.stop)
+        try:
+            daemon.listen()
+        finally:
+            daemon.close()
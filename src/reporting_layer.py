@@ -0,0 +1,233 @@
+import argparse
+import time
+import psycopg2
+from psycopg2 import sql
+from bulk_loader import index_columns, unique_key_name
+from db import get_db_connection
+
+# Materialized reporting layer: every view of script_sql/ gets a materialized copy ({view}_mat) with the dimension
+# names already joined and indexed on REF_AREA/TIME_PERIOD, so the Power BI refresh reads a table instead of running
+# the eight left joins every time. The copies are refreshed concurrently (readers are never blocked) after each load
+# and checked with the same COUNT(*) parity of the view scripts. REFRESH ... CONCURRENTLY needs a unique index: it is
+# built on the natural key of the fact (the dimension codes + TIME_PERIOD of the upserts), so a refresh only rewrites
+# the rows whose values changed
+
+MAT_SUFFIX = '_mat'
+CODE_SUFFIX = '_code'       # Key codes of the copy that the report shows only by name, e.g. data_type_code
+LEGACY_ROW_ID = 'fact_row'  # ctid key of the copies created before the natural key, they are rebuilt
+
+# Fact table of the dataflows read by the reports, the rollup cubes, the indicators and the location hierarchy, the
+# importers load these dataflows into it (the other ones go into a table named after their title)
+FACT_TABLES = {'122_54': 'facts_turismo'}
+
+# (fact column, dimension table, output column), the dimension is None when the code is kept as it is
+TURISMO_COLUMNS = [
+    ('REF_AREA', None, 'REF_AREA'),
+    ('DATA_TYPE', 'dim_cl_tipo_dato7', 'data_type'),
+    ('TYPE_ACCOMMODATION', 'dim_cl_tipo_alloggio2', 'type_accomodation'),
+    ('ECON_ACTIVITY_NACE_2007', 'dim_cl_ateco_2007', 'econ_activity_nace_2007'),
+    ('COUNTRY_RES_GUESTS', 'dim_cl_iso', 'country_res_guests'),
+    ('LOCALITY_TYPE', 'dim_cl_tipoitter1', 'locality_type'),
+    ('URBANIZ_DEGREE', 'dim_cl_tipoitter1', 'urbaniz_degree'),
+    ('COASTAL_AREA', 'dim_cl_tipoitter1', 'coastal_area'),
+    ('SIZE_BY_NUMBER_ROOMS', 'dim_cl_numerosita', 'size_by_number_rooms'),
+]
+PERNOTTAMENTI_COLUMNS = [
+    ('RESIDENCE_TERR', 'dim_cl_itter107', 'residence_terr'),
+    ('DATA_TYPE', 'dim_cl_tipo_dato_viaggi', 'data_type'),
+    ('MAIN_DESTINATION', None, 'MAIN_DESTINATION'),
+    ('TYPE_TRIP', 'dim_cl_tipo_viaggio2', 'type_trip'),
+    ('MAIN_TYPE_ACCOMMODATION', 'dim_cl_tipo_alloggio', 'main_type_accomodation'),
+    ('SEX', 'dim_cl_sexistat1', 'sex'),
+    ('AGE', 'dim_cl_eta1', 'age'),
+    ('LABPROF_STATUS_C', 'dim_cl_condizione_dich2', 'labprof_status_c'),
+]
+INDICATORI_COLUMNS = [
+    ('REF_AREA', 'dim_cl_itter107', 'ref_area'),
+    ('DATA_TYPE', 'dim_cl_tipo_dato29', 'data_type'),
+    ('ECON_ACTIVITY_NACE_2007', 'dim_cl_ateco_2007', 'econ_activity_nace_2007'),
+]
+
+# Same definitions of the view scripts: fact table, columns, FREQ filter and area column of the indexes
+REPORTS = {
+    'vista_turismo_tutto': {'fact': FACT_TABLES['122_54'], 'columns': TURISMO_COLUMNS, 'freq': None, 'area': 'REF_AREA'},
+    'vista_turismo_mensile': {'fact': FACT_TABLES['122_54'], 'columns': TURISMO_COLUMNS, 'freq': 'M', 'area': 'REF_AREA'},
+    'vista_turismo_annuale': {'fact': FACT_TABLES['122_54'], 'columns': TURISMO_COLUMNS, 'freq': 'A', 'area': 'REF_AREA'},
+    'vista_pernottamenti_tutto': {'fact': 'facts_pernottamenti', 'columns': PERNOTTAMENTI_COLUMNS, 'freq': None,
+                                  'area': 'residence_terr'},
+    'vista_indicatori_economici_tutto': {'fact': 'facts_indicatori_economici', 'columns': INDICATORI_COLUMNS,
+                                         'freq': None, 'area': 'ref_area'},
+}
+
+
+def mat_name(report: str) -> str:
+    """Name of the materialized copy of a view"""
+    return f"{report}{MAT_SUFFIX}"
+
+def fact_key(cursor: psycopg2.extensions.cursor, fact: str) -> list[str]:
+    """
+    Natural key of a fact table: the columns of the unique index of the upserts (dimension codes + TIME_PERIOD), every
+    column but OBS_VALUE for the tables loaded before the upserts
+    """
+    key = index_columns(cursor, unique_key_name(fact))
+    if not key:
+        cursor.execute("SELECT column_name FROM information_schema.columns WHERE table_schema = current_schema() "
+                       "AND table_name = %s AND column_name <> 'OBS_VALUE' ORDER BY ordinal_position", (fact,))
+        key = [row[0] for row in cursor.fetchall()]
+    return key
+
+def key_names(report: str, key: list[str]) -> list[str]:
+    """Columns of a report holding the fact key: the codes it shows as they are, the others with CODE_SUFFIX"""
+    shown = {fact_col for fact_col, dim_table, _ in REPORTS[report]['columns'] if dim_table is None} | {'TIME_PERIOD'}
+    return [col if col in shown else f"{col.lower()}{CODE_SUFFIX}" for col in key]
+
+def report_query(report: str, conditions: list[sql.Composable] = None, key: list[str] = None) -> sql.Composed:
+    """
+    SELECT of a report: the fact codes joined to the names of their dimensions
+    conditions = extra WHERE conditions on the fact columns (alias ft), e.g. the filters of the query API
+    key = natural key of the fact, its codes that the report shows only by name are added (see key_names)
+    """
+    spec = REPORTS[report]
+    columns = [sql.SQL("ft.{} AS {}").format(sql.Identifier(col), sql.Identifier(name))
+               for col, name in zip(key or [], key_names(report, key or [])) if col != name]
+    joins = []
+    for pos, (fact_col, dim_table, out_col) in enumerate(spec['columns']):
+        if dim_table is None:
+            columns.append(sql.SQL("ft.{}").format(sql.Identifier(fact_col)))
+            continue
+        alias = sql.Identifier(f"d{pos}")
+        columns.append(sql.SQL("{}.nome AS {}").format(alias, sql.Identifier(out_col)))
+        joins.append(sql.SQL("LEFT JOIN {} {} ON ft.{} = {}.id").format(
+            sql.Identifier(dim_table), alias, sql.Identifier(fact_col), alias))
+    columns += [sql.SQL('ft."TIME_PERIOD"'), sql.SQL('ft."OBS_VALUE"')]
+    query = sql.SQL("SELECT {} FROM {} ft {}").format(
+        sql.SQL(', ').join(columns), sql.Identifier(spec['fact']), sql.SQL(' ').join(joins))
+    conditions = list(conditions or [])
+    if spec['freq']:
+        conditions.insert(0, sql.SQL('ft."FREQ" = {}').format(sql.Literal(spec['freq'])))
+    if conditions:
+        query += sql.SQL(' WHERE ') + sql.SQL(' AND ').join(conditions)
+    return query
+
+def relation_exists(cursor: psycopg2.extensions.cursor, name: str) -> bool:
+    cursor.execute("SELECT to_regclass(%s) IS NOT NULL", (name,))
+    return cursor.fetchone()[0]
+
+def has_column(cursor: psycopg2.extensions.cursor, relation: str, column: str) -> bool:
+    """Column of a table or materialized view (information_schema doesn't list the materialized views)"""
+    cursor.execute("SELECT EXISTS (SELECT 1 FROM pg_attribute WHERE attrelid = to_regclass(%s) AND attname = %s "
+                   "AND NOT attisdropped)", (sql.Identifier(relation).as_string(cursor), column))
+    return cursor.fetchone()[0]
+
+def available_reports(cursor: psycopg2.extensions.cursor, fact: str = None) -> list[str]:
+    """Reports whose fact and dimension tables exist (a database can hold only some of the dataflows)"""
+    reports = []
+    for report, spec in REPORTS.items():
+        tables = [spec['fact']] + [dim for _, dim, _ in spec['columns'] if dim]
+        if (fact is None or spec['fact'] == fact) and all(relation_exists(cursor, table) for table in tables):
+            reports.append(report)
+    return reports
+
+def create_fact_indexes(cursor: psycopg2.extensions.cursor, fact: str, columns: list[tuple]) -> None:
+    """Index the join keys of a fact table and cover (area, TIME_PERIOD) -> OBS_VALUE"""
+    for fact_col, dim_table, _ in columns:
+        if dim_table is not None:
+            cursor.execute(sql.SQL("CREATE INDEX IF NOT EXISTS {} ON {} ({})").format(
+                sql.Identifier(f"{fact}_{fact_col.lower()}_idx"[:63]), sql.Identifier(fact), sql.Identifier(fact_col)))
+    area = columns[0][0]
+    cursor.execute(sql.SQL('CREATE INDEX IF NOT EXISTS {} ON {} ({}, "TIME_PERIOD") INCLUDE ("OBS_VALUE")').format(
+        sql.Identifier(f"{fact}_area_period_idx"[:63]), sql.Identifier(fact), sql.Identifier(area)))
+
+def create_reports(conn: psycopg2.extensions.connection, reports: list[str] = None, rebuild: bool = False) -> list[str]:
+    """Create the materialized copies (and the indexes of their fact tables) that don't exist yet"""
+    created = []
+    with conn.cursor() as cursor:
+        for report in reports or available_reports(cursor):
+            spec, mat = REPORTS[report], mat_name(report)
+            if relation_exists(cursor, mat) and not rebuild and not has_column(cursor, mat, LEGACY_ROW_ID):
+                continue
+            cursor.execute(sql.SQL("DROP MATERIALIZED VIEW IF EXISTS {}").format(sql.Identifier(mat)))
+            start = time.time()
+            create_fact_indexes(cursor, spec['fact'], spec['columns'])
+            key = fact_key(cursor, spec['fact'])
+            cursor.execute(sql.SQL("CREATE MATERIALIZED VIEW {} AS {}").format(
+                sql.Identifier(mat), report_query(report, key=key)))
+            try:
+                cursor.execute(sql.SQL("CREATE UNIQUE INDEX {} ON {} ({}) NULLS NOT DISTINCT").format(
+                    sql.Identifier(f"{mat}_key"[:63]), sql.Identifier(mat),
+                    sql.SQL(', ').join(map(sql.Identifier, key_names(report, key)))))
+            except psycopg2.errors.UniqueViolation as e:
+                conn.rollback()
+                raise ValueError(f"{spec['fact']} has more than one row per key ({', '.join(key)}), remove the "
+                                 f"duplicates (bulk_upsert(..., dedupe=True)) before creating {mat}: "
+                                 f"{e.diag.message_detail}") from e
+            cursor.execute(sql.SQL('CREATE INDEX {} ON {} ({}, "TIME_PERIOD") INCLUDE ("OBS_VALUE")').format(
+                sql.Identifier(f"{mat}_area_period"[:63]), sql.Identifier(mat), sql.Identifier(spec['area'])))
+            cursor.execute(sql.SQL('CREATE INDEX {} ON {} ("TIME_PERIOD")').format(
+                sql.Identifier(f"{mat}_period"[:63]), sql.Identifier(mat)))
+            cursor.execute(sql.SQL("ANALYZE {}").format(sql.Identifier(mat)))
+            conn.commit()
+            created.append(report)
+            print(f"Created {mat} in {time.time() - start:.1f}s")
+    conn.commit()
+    return created
+
+def refresh_reports(conn: psycopg2.extensions.connection, fact: str = None, concurrently: bool = True) -> list[str]:
+    """
+    Refresh the materialized copies (of a fact table, or all of them) that exist
+    concurrently = readers see the old rows during the refresh, slower than a plain refresh that locks them out
+    """
+    refreshed = []
+    with conn.cursor() as cursor:
+        for report in available_reports(cursor, fact):
+            mat = mat_name(report)
+            if not relation_exists(cursor, mat):
+                continue
+            start = time.time()
+            cursor.execute(sql.SQL("REFRESH MATERIALIZED VIEW {}{}").format(
+                sql.SQL("CONCURRENTLY " if concurrently else ""), sql.Identifier(mat)))
+            conn.commit()
+            refreshed.append(report)
+            print(f"Refreshed {mat} in {time.time() - start:.1f}s")
+    conn.commit()
+    return refreshed
+
+def check_parity(conn: psycopg2.extensions.connection, reports: list[str] = None) -> dict[str, tuple[int, int]]:
+    """COUNT(*) of the fact rows against the rows of each materialized copy, like the checks of the view scripts"""
+    counts = {}
+    with conn.cursor() as cursor:
+        for report in reports or available_reports(cursor):
+            spec, mat = REPORTS[report], mat_name(report)
+            if not relation_exists(cursor, mat):
+                continue
+            query = sql.SQL("SELECT COUNT(*) AS ft_count, (SELECT COUNT(*) FROM {}) AS vs_count FROM {} ft").format(
+                sql.Identifier(mat), sql.Identifier(spec['fact']))
+            if spec['freq']:
+                query += sql.SQL(' WHERE ft."FREQ" = {}').format(sql.Literal(spec['freq']))
+            cursor.execute(query)
+            counts[report] = cursor.fetchone()
+            status = "OK" if counts[report][0] == counts[report][1] else "MISMATCH"
+            print(f"{mat}: {counts[report][0]} fact rows, {counts[report][1]} report rows {status}")
+    conn.commit()
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create, refresh and check the materialized reporting views")
+    parser.add_argument('--rebuild', action='store_true', help="drop and create again the materialized views")
+    parser.add_argument('--refresh', action='store_true', help="refresh the materialized views that exist")
+    parser.add_argument('--blocking', action='store_true', help="plain refresh, faster but it locks out the readers")
+    parser.add_argument('--fact', help="only the reports of this fact table")
+    args = parser.parse_args()
+
+    conn = get_db_connection()
+    try:
+        if args.refresh:
+            refresh_reports(conn, args.fact, not args.blocking)
+        else:
+            with conn.cursor() as cursor:
+                reports = available_reports(cursor, args.fact)
+            create_reports(conn, reports, args.rebuild)
+        check_parity(conn)
+    finally:
+        conn.close()
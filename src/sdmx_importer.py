@@ -0,0 +1,249 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+from urllib.parse import parse_qsl, urlencode
+from os import getenv
+from typing import BinaryIO, Iterator
+from dotenv import load_dotenv
+import pandas as pd
+import psycopg2
+from bulk_loader import bulk_upsert
+from fact_encoding import ON_INVALID, FactEncoder, load_codelists
+from db import get_db_connection
+from http_cache import MODES as CACHE_MODES, HttpCache, get_default_cache
+from indicators import update_indicators
+from instrumentation import PROFILE_DIR, RunReport
+from load_state import DEFAULT_LOOKBACK, get_high_water, incremental_start, save_high_water, update_marks
+from location_rollup import update_rollups
+from reporting_layer import FACT_TABLES, refresh_reports
+
+try:    # Optional, only needed to stream SDMX-JSON responses
+    import ijson
+except ImportError:
+    ijson = None
+
+load_dotenv()
+
+# Streaming importer of ISTAT SDMX dataflows: the response is read in chunks and every chunk is COPYed to Postgres,
+# so the memory used doesn't depend on the size of the dataflow. Responses go through the local HTTP cache
+# (http_cache.py), so importing the same URL again only revalidates it
+
+SDMX_DATA_URL = 'https://esploradati.istat.it/SDMXWS/rest/data'
+METADATA_DIR = os.path.join('csv', 'istat_metadata_extractor', 'extracted')
+HEADERS = {'csv': {'Accept': 'text/csv'}, 'json': {'Accept': 'application/json'}}
+CHUNK_ROWS = 50000
+MAX_TABLE_NAME = 63     # Postgres identifier length
+
+
+def load_json_file(file_path: str):
+    """Load and parse a JSON file"""
+    with open(file_path, 'r') as file:
+        return json.load(file)
+
+def process_string(input_string: str) -> str | None:
+    """Substitute spaces with _ and keep only the part before the first hyphen"""
+    if input_string:
+        processed_string = input_string.replace(' ', '_').split('-')[0]
+        return processed_string[:-1] if processed_string.endswith('_') else processed_string
+    return None
+
+def truncate_string(input_string: str, max_length: int) -> str:
+    """Truncate a string to a maximum length, cutting at the last underscore"""
+    if len(input_string) > max_length:
+        last_underscore_index = input_string.rfind('_', 0, max_length)
+        if last_underscore_index != -1:
+            return input_string[:last_underscore_index]
+    return input_string
+
+def metadata_dir(dataflow: str) -> str:
+    """Folder of the extracted metadata of a dataflow"""
+    return os.path.join(METADATA_DIR, f"{dataflow}_metadata")
+
+def get_table_name(dataflow: str) -> str:
+    """Fact table of the dataflow in FACT_TABLES, or the name from its title like the datatable_importer notebook"""
+    if dataflow in FACT_TABLES:
+        return FACT_TABLES[dataflow]
+    dataflows_path = os.path.join(metadata_dir(dataflow), 'dataflows.json')
+    title = load_json_file(dataflows_path).get(dataflow) if os.path.exists(dataflows_path) else None
+    table_name = process_string(title)
+    if not table_name:
+        print(f"Nessun titolo trovato per l'id {dataflow}")
+        return dataflow
+    return table_name if len(table_name) < MAX_TABLE_NAME else truncate_string(table_name, 55)
+
+def get_dimensions(dataflow: str) -> dict[str, str]:
+    """Dimensions of the dataflow and their codelists"""
+    return load_json_file(os.path.join(metadata_dir(dataflow), 'dimensions.json'))
+
+def get_key_columns(dataflow: str) -> list[str]:
+    """Dimensions of the dataflow + TIME_PERIOD, the columns identifying an observation"""
+    return list(get_dimensions(dataflow)) + ['TIME_PERIOD']
+
+def build_url(dataflow: str, filter: str = None, timeframe: str = None) -> str:
+    """URL of the SDMX REST data request"""
+    url = f"{SDMX_DATA_URL}/{dataflow}"
+    if filter:
+        url += f"/{filter}"
+    return f"{url}?{timeframe}" if timeframe else url
+
+def with_start_period(timeframe: str, start_period: str) -> str:
+    """Replace the startPeriod of a query string (e.g. startPeriod=2016-01-01&endPeriod=2024-12-31)"""
+    params = [(key, value) for key, value in parse_qsl(timeframe or '') if key != 'startPeriod']
+    return urlencode([('startPeriod', start_period)] + params, safe=':+')
+
+def open_stream(url: str, datatype: str, cache: HttpCache = None) -> BinaryIO:
+    """Binary stream of the response body (from the HTTP cache when possible), raising on HTTP errors"""
+    return (cache or get_default_cache()).open(url, HEADERS[datatype])
+
+def prepare_chunk(chunk: pd.DataFrame, keep=()) -> pd.DataFrame:
+    """
+    Drop columns where all values are NaN and make OBS_VALUE numeric, codes stay strings (e.g. 010025)
+    keep = columns never dropped and added empty when missing (the key columns), so every chunk has the same key
+    """
+    chunk = chunk.drop(columns=[col for col in chunk.columns if col not in keep and chunk[col].isna().all()])
+    for col in keep:
+        if col not in chunk.columns:
+            chunk[col] = None
+    if 'OBS_VALUE' in chunk.columns:
+        chunk['OBS_VALUE'] = pd.to_numeric(chunk['OBS_VALUE'], errors='coerce').astype('float64')
+    return chunk
+
+def iter_csv_chunks(stream: BinaryIO, chunk_rows: int = CHUNK_ROWS, dtype=str, keep=()) -> Iterator[pd.DataFrame]:
+    """Parse an SDMX-CSV response chunk by chunk, dtype = dtypes of the columns (FactEncoder.csv_dtypes), strings by default"""
+    with pd.read_csv(stream, dtype=dtype, chunksize=chunk_rows) as reader:
+        for chunk in reader:
+            yield prepare_chunk(chunk, keep)
+
+def iter_json_chunks(stream: BinaryIO, chunk_rows: int = CHUNK_ROWS, keep=()) -> Iterator[pd.DataFrame]:
+    """
+    Parse an SDMX-JSON response chunk by chunk
+    The structure (needed to decode the keys) can come after the data, so the response is spooled to a temporary
+    file and read twice with ijson: first the structure, then the series
+    """
+    if ijson is None:
+        raise ImportError("Streaming SDMX-JSON needs the ijson package (pip install ijson), or use the CSV format")
+    with tempfile.TemporaryFile() as spool:
+        for block in iter(lambda: stream.read(1 << 20), b''):
+            spool.write(block)
+
+        # SDMX-JSON 1.0 has structure/dataSets at the top level, 2.0 under "data"
+        prefix = ''
+        spool.seek(0)
+        for path, _, _ in ijson.parse(spool):
+            if path in ('structure', 'data'):
+                prefix = '' if path == 'structure' else 'data.'
+                break
+        spool.seek(0)
+        structure = next(ijson.items(spool, f"{prefix}structure"))
+        series_dims = structure['dimensions']['series']
+        observation_dims = structure['dimensions']['observation']
+
+        columns = [dim['id'] for dim in series_dims + observation_dims] + ['OBS_VALUE']
+        rows = []
+        spool.seek(0)
+        for series_key, series in ijson.kvitems(spool, f"{prefix}dataSets.item.series"):
+            codes = [dim['values'][int(pos)]['id'] for dim, pos in zip(series_dims, series_key.split(':'))]
+            for obs_key, observation in series.get('observations', {}).items():
+                periods = [dim['values'][int(pos)]['id'] for dim, pos in zip(observation_dims, obs_key.split(':'))]
+                rows.append(codes + periods + [observation[0]])
+            if len(rows) >= chunk_rows:
+                yield prepare_chunk(pd.DataFrame(rows, columns=columns), keep)
+                rows = []
+        if rows:
+            yield prepare_chunk(pd.DataFrame(rows, columns=columns), keep)
+
+def import_dataflow(dataflow: str, filter: str = None, timeframe: str = None, datatype: str = 'csv',
+                    table_name: str = None, chunk_rows: int = CHUNK_ROWS, incremental: bool = False,
+                    lookback: int = DEFAULT_LOOKBACK, conn: psycopg2.extensions.connection = None,
+                    cache: HttpCache = None, refresh: bool = True, on_invalid: str = 'raise',
+                    report: RunReport = None) -> int:
+    """
+    Download a dataflow and load it chunk by chunk into its fact table, returning the rows loaded
+    Every chunk is upserted and committed on its own, so rerunning after a failure completes the load
+    incremental = request only the periods after the high-water mark of each FREQ, moved back by lookback periods
+                  to pick up the revisions (the first load is always a full one)
+    conn = connection to use (e.g. from a pool), a new one is opened and closed when missing
+    cache = HTTP cache of the responses, the one configured in .env when missing
+    refresh = refresh the materialized reports, the rollup cubes and the indicators of the table after the load
+    on_invalid = raise or drop the rows whose codes are not in the dim_cl_* tables (checked before each chunk is loaded)
+    report = run report the stages are measured in, they are only printed when missing
+    """
+    report = report or RunReport(f"import_{dataflow}", report_dir=None)
+    table_name = table_name or get_table_name(dataflow)
+    key_columns = get_key_columns(dataflow)
+
+    total_rows = 0
+    changes = set()     # (REF_AREA, TIME_PERIOD) pairs loaded, the cells of the rollup cubes to compute again
+    own_conn = conn is None
+    conn = conn or get_db_connection()
+    try:
+        with report.stage('prepare'):
+            marks = get_high_water(conn, dataflow, filter)
+            encoder = FactEncoder(load_codelists(conn, get_dimensions(dataflow), os.path.join(metadata_dir(dataflow), 'dim_csv')),
+                                  on_invalid)
+        start_period = incremental_start(marks, lookback) if incremental else None
+        if start_period:
+            timeframe = with_start_period(timeframe, start_period)
+        url = build_url(dataflow, filter, timeframe)
+        print(f"Importing {url} into {table_name}" + (f" (delta from {start_period})" if start_period else ""))
+
+        # Download and parse are interleaved with the load, their time is what is left of the stage
+        with report.stage('load') as stage, open_stream(url, datatype, cache) as stream:
+            if datatype == 'csv':   # Dimensions parsed straight into categoricals
+                chunks = iter_csv_chunks(stream, chunk_rows, encoder.csv_dtypes(), keep=key_columns)
+            else:
+                chunks = iter_json_chunks(stream, chunk_rows, keep=key_columns)
+            for chunk in chunks:
+                started = time.perf_counter()
+                chunk = encoder.encode(chunk)
+                stage.add('encode_s', time.perf_counter() - started)
+                started = time.perf_counter()
+                total_rows += bulk_upsert(conn, chunk, table_name, key_columns)   # The same key in every chunk
+                stage.add('upsert_s', time.perf_counter() - started)
+                if 'FREQ' in chunk.columns and 'TIME_PERIOD' in chunk.columns:
+                    update_marks(marks, chunk['FREQ'], chunk['TIME_PERIOD'])
+                if 'REF_AREA' in chunk.columns and 'TIME_PERIOD' in chunk.columns:
+                    changes.update(zip(chunk['REF_AREA'], chunk['TIME_PERIOD']))
+            save_high_water(conn, dataflow, marks, filter)
+            stage.rows_in, stage.rows_out = encoder.rows + encoder.dropped, total_rows
+        encoder.report()
+        if refresh and total_rows:
+            with report.stage('refresh', rows_in=len(changes)):
+                refresh_reports(conn, table_name)
+                update_rollups(conn, table_name, changes)
+                update_indicators(conn, table_name, changes)
+    finally:
+        if own_conn:
+            conn.close()
+    print(f"Imported {total_rows} rows of {dataflow} into {table_name}")
+    return total_rows
+
+
+def parse_args() -> argparse.Namespace:
+    """Command line options, the defaults come from .env like in the notebook"""
+    parser = argparse.ArgumentParser(description="Stream an ISTAT SDMX dataflow into Postgres")
+    parser.add_argument('--dataflow', default=getenv('dataflow'), help="dataflow id, e.g. 122_54")
+    parser.add_argument('--filter', default=getenv('filter'), help="SDMX key filter, e.g. ...ITC3+ITC31.......")
+    parser.add_argument('--timeframe', default=getenv('timeframe'), help="query string, e.g. startPeriod=2016-01-01")
+    parser.add_argument('--format', choices=('csv', 'json'), default='json' if getenv('datatype') == '1' else 'csv')
+    parser.add_argument('--table', help="target table, the one of FACT_TABLES or the dataflow title by default")
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS)
+    parser.add_argument('--incremental', action='store_true', help="load only the periods after the last load")
+    parser.add_argument('--lookback', type=int, default=DEFAULT_LOOKBACK, help="periods reloaded to pick up revisions")
+    parser.add_argument('--cache', choices=CACHE_MODES, default=getenv('http_cache_mode', 'use'),
+                        help="HTTP cache mode: use, offline (only cached responses), refresh or off")
+    parser.add_argument('--on-invalid', choices=ON_INVALID, default='raise',
+                        help="rows with codes missing from the dimension tables: stop the load or drop them")
+    parser.add_argument('--profile', default=PROFILE_DIR, help="folder of the cProfile output of every stage")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    report = RunReport(f"import_{args.dataflow}", profile_dir=args.profile)
+    with HttpCache(mode=args.cache) as cache:
+        import_dataflow(args.dataflow, args.filter, args.timeframe, args.format, args.table, args.chunk_rows,
+                        args.incremental, args.lookback, cache=cache, on_invalid=args.on_invalid, report=report)
+    report.save()
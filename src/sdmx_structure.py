@@ -0,0 +1,195 @@
+import argparse
+import csv
+import json
+import os
+import xml.etree.ElementTree as ET
+from typing import BinaryIO
+from db import connection
+from http_cache import HttpCache, get_default_cache
+from sdmx_importer import get_table_name, metadata_dir
+
+# Metadata extractor: stream-parses the SDMX 2.1 structure message of a dataflow (dataflow + DSD + codelists) with
+# iterparse, writing every code as soon as it is read, and produces the files of istat_metadata_extractor/extracted:
+# dataflows.json, dimensions.json, datastructure.txt, dim_csv/*.csv, dim_json/*.json, plus the DDL of the fact table
+# and its foreign keys to the dimension tables
+
+SDMX_STRUCTURE_URL = 'https://esploradati.istat.it/SDMXWS/rest'
+AGENCY = 'IT1'
+STRUCTURE_HEADERS = {'Accept': 'application/vnd.sdmx.structure+xml;version=2.1'}
+NS = {
+    'message': 'http://www.sdmx.org/resources/sdmxml/schemas/v2_1/message',
+    'structure': 'http://www.sdmx.org/resources/sdmxml/schemas/v2_1/structure',
+    'common': 'http://www.sdmx.org/resources/sdmxml/schemas/v2_1/common',
+}
+XML_LANG = '{http://www.w3.org/XML/1998/namespace}lang'
+MAX_IDENTIFIER = 63     # Postgres identifier length
+# Postgres type of the primary measure by SDMX textType, the dimensions are codes (VARCHAR(50) like the dim ids)
+MEASURE_TYPES = {'Double': 'DOUBLE PRECISION', 'Float': 'DOUBLE PRECISION', 'Decimal': 'NUMERIC', 'Integer': 'BIGINT',
+                 'Long': 'BIGINT', 'Short': 'INTEGER', 'Boolean': 'BOOLEAN', 'String': 'TEXT'}
+
+
+def tag(prefix: str, name: str) -> str:
+    return f"{{{NS[prefix]}}}{name}"
+
+def pick_name(element: ET.Element, lang: str) -> str | None:
+    """Name of an item in the requested language, the first one when it's missing"""
+    names = {name.get(XML_LANG): name.text for name in element.findall('common:Name', NS)}
+    return names.get(lang) or next(iter(names.values()), None)
+
+def enumeration(component: ET.Element) -> str | None:
+    """Codelist of a dimension or attribute, None when it's free text"""
+    ref = component.find('structure:LocalRepresentation/structure:Enumeration/Ref', NS)
+    return ref.get('id') if ref is not None else None
+
+def parse_structure(stream: BinaryIO, output_dir: str, lang: str = 'en') -> dict:
+    """
+    Parse a structure message, writing dim_csv/dim_{codelist}.csv and dim_json/dim_{codelist}.json while reading
+    Returns the dataflows ({id: name}), the DSD id, the dimensions (in position order), the measure type and the
+    codes written for each codelist
+    """
+    os.makedirs(os.path.join(output_dir, 'dim_csv'), exist_ok=True)
+    os.makedirs(os.path.join(output_dir, 'dim_json'), exist_ok=True)
+    result = {'dataflows': {}, 'dsd': None, 'dimensions': [], 'measure_type': 'DOUBLE PRECISION', 'codelists': {}}
+    codelist, csv_file, json_file, writer, codes = None, None, None, None, 0
+
+    for event, element in ET.iterparse(stream, events=('start', 'end')):
+        if event == 'start':
+            if element.tag == tag('structure', 'Codelist'):
+                codelist = element.get('id')
+                csv_file = open(os.path.join(output_dir, 'dim_csv', f"dim_{codelist}.csv"), 'w', newline='', encoding='utf-8')
+                json_file = open(os.path.join(output_dir, 'dim_json', f"dim_{codelist}.json"), 'w', encoding='utf-8')
+                writer = csv.writer(csv_file, lineterminator='\n')
+                writer.writerow(['ID', 'NAME'])
+                json_file.write('{')
+            continue
+
+        if element.tag == tag('structure', 'Code') and writer is not None:
+            code, name = element.get('id'), pick_name(element, lang)
+            writer.writerow([code, name])
+            json_file.write(f"{', ' if codes else ''}{json.dumps(code)}: {json.dumps(name)}")  # Same format of json.dump
+            codes += 1
+            element.clear()     # The code is written, don't keep it in the tree
+        elif element.tag == tag('structure', 'Codelist'):
+            json_file.write('}')
+            csv_file.close()
+            json_file.close()
+            result['codelists'][codelist] = codes
+            codelist, csv_file, json_file, writer, codes = None, None, None, None, 0
+            element.clear()
+        elif element.tag == tag('structure', 'Dataflow'):
+            result['dataflows'][element.get('id')] = pick_name(element, lang)
+            element.clear()
+        elif element.tag == tag('structure', 'Dimension'):
+            result['dimensions'].append((int(element.get('position') or 0), element.get('id'), enumeration(element)))
+        elif element.tag == tag('structure', 'PrimaryMeasure'):
+            text_format = element.find('structure:LocalRepresentation/structure:TextFormat', NS)
+            if element.get('id') == 'OBS_VALUE' and text_format is not None:
+                result['measure_type'] = MEASURE_TYPES.get(text_format.get('textType'), 'DOUBLE PRECISION')
+        elif element.tag == tag('structure', 'DataStructure'):
+            result['dsd'] = element.get('id')
+            element.clear()
+
+    result['dimensions'] = [(dim, cl) for _, dim, cl in sorted(result['dimensions'])]
+    return result
+
+def list_dataflows(cache: HttpCache, prefix: str, lang: str = 'en') -> dict[str, str]:
+    """Dataflows of the agency whose id is prefix or starts with prefix_ (the sub-dataflows of a domain)"""
+    dataflows = {}
+    with cache.open(f"{SDMX_STRUCTURE_URL}/dataflow/{AGENCY}", STRUCTURE_HEADERS) as stream:
+        for _, element in ET.iterparse(stream):
+            if element.tag == tag('structure', 'Dataflow'):
+                if element.get('id') == prefix or element.get('id').startswith(f"{prefix}_"):
+                    dataflows[element.get('id')] = pick_name(element, lang)
+                element.clear()
+    return dataflows
+
+def fact_table_ddl(table_name: str, dimensions: list[tuple], measure_type: str) -> str:
+    """CREATE TABLE of the fact table, with the unique key bulk_upsert merges on"""
+    columns = [f'    "{dim}" VARCHAR(50)' for dim, _ in dimensions]
+    columns += ['    "TIME_PERIOD" VARCHAR(10)', f'    "OBS_VALUE" {measure_type}']
+    key = ', '.join(f'"{dim}"' for dim, _ in dimensions)
+    return (f'CREATE TABLE IF NOT EXISTS public."{table_name}" (\n' + ',\n'.join(columns) + '\n);\n\n'
+            f'CREATE UNIQUE INDEX IF NOT EXISTS "{table_name}_upsert_key"\n'
+            f'ON public."{table_name}" ({key}, "TIME_PERIOD") NULLS NOT DISTINCT;\n')
+
+def foreign_keys_ddl(table_name: str, dimensions: list[tuple]) -> str:
+    """ALTER TABLE with a foreign key from every coded dimension to its dim_cl_* table"""
+    constraints, used = [], {}
+    for dim, codelist in dimensions:
+        if codelist is None:
+            continue
+        dim_table = f"dim_{codelist}".lower()
+        name = f"{table_name.lower()[:MAX_IDENTIFIER - len(dim_table) - 6]}_{dim_table}_fk"   # Room for _fk_N
+        used[name] = used.get(name, -1) + 1
+        if used[name]:  # The same codelist used by several dimensions, like the hand-written scripts
+            name = f"{name}_{used[name]}"
+        # Dropped first, so that the script can be run again
+        constraints.append(f'DROP CONSTRAINT IF EXISTS {name}')
+        constraints.append(f'ADD CONSTRAINT {name} FOREIGN KEY ("{dim}") REFERENCES public.{dim_table}(id) ON DELETE CASCADE')
+    if not constraints:
+        return ''
+    return f'ALTER TABLE public."{table_name}"\n' + ',\n'.join(constraints) + ';\n'
+
+def structure_url(dataflow: str) -> str:
+    """URL of the structure of a dataflow with everything it references (DSD, codelists, concepts)"""
+    return f"{SDMX_STRUCTURE_URL}/dataflow/{AGENCY}/{dataflow}/latest?references=all"
+
+def extract_dataflow(dataflow: str, cache: HttpCache = None, lang: str = 'en', table_name: str = None) -> dict:
+    """Download and parse the structure of a dataflow and write its metadata folder, returns the parse result"""
+    cache = cache or get_default_cache()
+    output_dir = metadata_dir(dataflow)
+    url = structure_url(dataflow)
+    print(f"Extracting {url} into {output_dir}")
+    with cache.open(url, STRUCTURE_HEADERS) as stream:
+        result = parse_structure(stream, output_dir, lang)
+
+    dataflows = {**list_dataflows(cache, dataflow, lang), **result['dataflows']}
+    with open(os.path.join(output_dir, 'dataflows.json'), 'w', encoding='utf-8') as file:
+        json.dump(dict(sorted(dataflows.items())), file)
+    with open(os.path.join(output_dir, 'dimensions.json'), 'w', encoding='utf-8') as file:
+        json.dump(dict(result['dimensions']), file)
+    with open(os.path.join(output_dir, 'datastructure.txt'), 'w', encoding='utf-8') as file:
+        file.write(result['dsd'] or '')
+
+    table_name = table_name or get_table_name(dataflow)
+    result['table_name'] = table_name
+    with open(os.path.join(output_dir, 'create_table.sql'), 'w', encoding='utf-8') as file:
+        file.write(fact_table_ddl(table_name, result['dimensions'], result['measure_type']))
+    with open(os.path.join(output_dir, 'foreign_keys.sql'), 'w', encoding='utf-8') as file:
+        file.write(foreign_keys_ddl(table_name, result['dimensions']))
+    print(f"Extracted {len(result['dimensions'])} dimensions and {len(result['codelists'])} codelists "
+          f"({sum(result['codelists'].values())} codes) of {dataflow}, fact table {table_name}")
+    return result
+
+def create_fact_table(dataflow: str) -> None:
+    """Run create_table.sql and foreign_keys.sql of a dataflow, the dimension tables must be loaded"""
+    with connection() as conn, conn.cursor() as cursor:
+        for script in ('create_table.sql', 'foreign_keys.sql'):
+            with open(os.path.join(metadata_dir(dataflow), script), 'r', encoding='utf-8') as file:
+                statements = file.read()
+            if statements.strip():
+                cursor.execute(statements)
+
+def apply_ddl(dataflow: str) -> None:
+    """Load the codelists and create the fact table with its foreign keys"""
+    from dimension_loader import load_dimensions     # Only needed with --apply
+
+    load_dimensions()
+    try:
+        create_fact_table(dataflow)
+        print(f"Created the fact table of {dataflow} and its foreign keys")
+    except Exception as e:
+        print(f"Error creating the fact table of {dataflow}: {e}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract the metadata (codelists, DDL, FKs) of an ISTAT SDMX dataflow")
+    parser.add_argument('dataflow', help="dataflow id, e.g. 122_54")
+    parser.add_argument('--lang', default='en', help="language of the code names")
+    parser.add_argument('--table', help="fact table name, the one of FACT_TABLES or the dataflow title by default")
+    parser.add_argument('--apply', action='store_true', help="load the codelists and create the fact table and its FKs")
+    args = parser.parse_args()
+
+    extract_dataflow(args.dataflow, lang=args.lang, table_name=args.table)
+    if args.apply:
+        apply_ddl(args.dataflow)
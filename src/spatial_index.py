@@ -0,0 +1,208 @@
+import argparse
+import time
+import numpy as np
+import pandas as pd
+import psycopg2
+from psycopg2 import sql
+from bulk_loader import copy_frame
+from db import get_db_connection, read_query
+from location_rollup import COMMUNE_PATTERN, HIERARCHY_TABLE
+
+try:    # Optional, ball tree with the haversine metric
+    from sklearn.neighbors import BallTree
+except ImportError:
+    BallTree = None
+
+# Spatial queries over the geocoded communes of gerarchia_luogo: radius and k nearest neighbour searches by
+# great-circle distance, batched over many centres, returning (origin, id, distance_km) frames that join to the facts
+# on REF_AREA. Uses a scikit-learn BallTree (a dependency of environment.yml), the exact vectorized scan in blocks is
+# only the fallback of the environments without it (a few thousand communes fit comfortably). The neighbours of every
+# commune are also saved in a table, so the dashboards answer "nights within 30 km of Portofino" in SQL:
+#   SELECT SUM(f."OBS_VALUE") FROM gerarchia_luogo_neighbours n JOIN facts_turismo f ON f."REF_AREA" = n.neighbour
+#   WHERE n.origin = '010044' AND n.distance_km <= 30 AND f."DATA_TYPE" = 'NI' AND ...
+
+NEIGHBOUR_TABLE = f"{HIERARCHY_TABLE}_neighbours"
+EARTH_RADIUS_KM = 6371.0088
+DEFAULT_RADIUS_KM = 30
+DEFAULT_K = 10          # Nearest communes always kept in the table, also beyond the radius
+BLOCK_ROWS = 1024       # Centres per block of the scan without BallTree
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Great-circle distance in km between points in radians, numpy broadcasting rules"""
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+class SpatialIndex:
+    """Points with an id, queried by radius or k nearest, all coordinates in degrees"""
+
+    def __init__(self, ids, lat, lon):
+        lat, lon = np.asarray(lat, dtype=np.float64), np.asarray(lon, dtype=np.float64)
+        valid = ~(np.isnan(lat) | np.isnan(lon))
+        self.ids = np.asarray(ids, dtype=object)[valid]
+        self.points = np.radians(np.column_stack([lat[valid], lon[valid]]))
+        self.position = dict(zip(self.ids, range(len(self.ids))))
+        self.tree = BallTree(self.points, metric='haversine') if BallTree is not None and len(self.ids) else None
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame, id_column: str = 'id') -> 'SpatialIndex':
+        return cls(df[id_column].astype(str), pd.to_numeric(df['Latitudine'], errors='coerce'),
+                   pd.to_numeric(df['Longitudine'], errors='coerce'))
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def coordinates(self, codes) -> np.ndarray:
+        """Points (radians) of indexed codes, KeyError for the codes that aren't geocoded"""
+        return self.points[[self.position[code] for code in codes]]
+
+    def _blocks(self, centres: np.ndarray):
+        """Distances of every block of centres to all the points"""
+        for start in range(0, len(centres), BLOCK_ROWS):
+            block = centres[start:start + BLOCK_ROWS]
+            yield start, haversine_km(block[:, :1], block[:, 1:], self.points[:, 0], self.points[:, 1])
+
+    def _radius(self, centres: np.ndarray, radius_km: float) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """(centre, point, distance_km) of every point within radius_km of a centre"""
+        if not len(centres) or not len(self):
+            return np.empty(0, dtype=int), np.empty(0, dtype=int), np.empty(0)
+        if self.tree is not None:
+            positions, distances = self.tree.query_radius(centres, r=radius_km / EARTH_RADIUS_KM, return_distance=True)
+            rows = np.repeat(np.arange(len(centres)), [len(p) for p in positions])
+            return rows, np.concatenate(positions), np.concatenate(distances) * EARTH_RADIUS_KM
+        parts = []
+        for start, distances in self._blocks(centres):
+            rows, cols = np.nonzero(distances <= radius_km)
+            parts.append((rows + start, cols, distances[rows, cols]))
+        return tuple(np.concatenate(arrays) for arrays in zip(*parts))
+
+    def _nearest(self, centres: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        k = min(k, len(self))
+        if self.tree is not None:
+            distances, positions = self.tree.query(centres, k=k)
+            return positions, distances * EARTH_RADIUS_KM
+        positions, distances = [], []
+        for _, block in self._blocks(centres):
+            nearest = np.argpartition(block, k - 1, axis=1)[:, :k]
+            near_distances = np.take_along_axis(block, nearest, axis=1)
+            order = np.argsort(near_distances, axis=1)
+            positions.append(np.take_along_axis(nearest, order, axis=1))
+            distances.append(np.take_along_axis(near_distances, order, axis=1))
+        return np.concatenate(positions), np.concatenate(distances)
+
+    def within(self, origins, radius_km: float, lat=None, lon=None) -> pd.DataFrame:
+        """
+        Points within radius_km of every origin, (origin, id, distance_km) sorted by origin and distance
+        origins = indexed codes, or labels of the centres given by lat and lon (degrees)
+        """
+        origins = np.asarray(origins, dtype=object)
+        centres = self.coordinates(origins) if lat is None else np.radians(np.column_stack([lat, lon]))
+        rows, positions, distances = self._radius(centres, radius_km)
+        result = pd.DataFrame({'origin': origins[rows], 'id': self.ids[positions], 'distance_km': distances})
+        return result.sort_values(['origin', 'distance_km'], kind='stable', ignore_index=True)
+
+    def nearest(self, origins, k: int = DEFAULT_K, lat=None, lon=None, include_self: bool = False) -> pd.DataFrame:
+        """k nearest points of every origin, (origin, id, distance_km, rank) with rank 1 for the closest"""
+        origins = np.asarray(origins, dtype=object)
+        centres = self.coordinates(origins) if lat is None else np.radians(np.column_stack([lat, lon]))
+        extra = 0 if include_self or lat is not None else 1
+        positions, distances = self._nearest(centres, k + extra)
+        result = pd.DataFrame({'origin': np.repeat(origins, positions.shape[1]), 'id': self.ids[positions.ravel()],
+                               'distance_km': distances.ravel()})
+        if extra:
+            result = result.loc[result['origin'] != result['id']]
+            result = result.groupby('origin', sort=False).head(k)
+        result['rank'] = result.groupby('origin', sort=False).cumcount() + 1
+        return result.reset_index(drop=True)
+
+
+def load_index(conn: psycopg2.extensions.connection = None) -> SpatialIndex:
+    """Index of the geocoded communes of the hierarchy table"""
+    df = read_query(sql.SQL('SELECT id, "Latitudine", "Longitudine" FROM {} WHERE id ~ %s AND "Latitudine" IS NOT NULL').format(
+        sql.Identifier(HIERARCHY_TABLE)), (COMMUNE_PATTERN,), conn)
+    return SpatialIndex.from_frame(df)
+
+def neighbour_pairs(index: SpatialIndex, radius_km: float = DEFAULT_RADIUS_KM, k: int = DEFAULT_K) -> pd.DataFrame:
+    """(origin, neighbour, distance_km, rank) of every commune: the ones within radius_km and at least the k nearest"""
+    pairs = pd.concat([index.within(index.ids, radius_km), index.nearest(index.ids, k)[['origin', 'id', 'distance_km']]])
+    pairs = pairs.loc[pairs['origin'] != pairs['id']].drop_duplicates(['origin', 'id'])
+    pairs = pairs.sort_values(['origin', 'distance_km'], kind='stable').rename(columns={'id': 'neighbour'})
+    pairs['rank'] = pairs.groupby('origin', sort=False).cumcount() + 1
+    pairs['distance_km'] = pairs['distance_km'].round(3)
+    return pairs.reset_index(drop=True)
+
+def aggregate_facts(conn: psycopg2.extensions.connection, pairs: pd.DataFrame, fact: str = 'facts_turismo',
+                    filter: dict[str, str] = None, by: list[str] = ('TIME_PERIOD',)) -> pd.DataFrame:
+    """
+    SUM(OBS_VALUE) of the facts of the neighbours of every origin, grouped by origin and the by columns
+    pairs = (origin, id) frame, e.g. from within() or nearest()
+    filter = {fact column: code}, fix the dimensions that are not in by to their total code
+    """
+    conditions = [sql.SQL("f.{} = {}").format(sql.Identifier(col), sql.Literal(value)) for col, value in (filter or {}).items()]
+    group = sql.SQL(', ').join([sql.SQL("p.origin")] + [sql.SQL("f.{}").format(sql.Identifier(col)) for col in by])
+    with conn.cursor() as cursor:
+        cursor.execute("CREATE TEMP TABLE spatial_pairs (origin TEXT, id TEXT) ON COMMIT DROP")
+        copy_frame(cursor, pairs[['origin', 'id']], 'spatial_pairs')
+        cursor.execute(sql.SQL("""
+            SELECT {group}, SUM(f."OBS_VALUE") AS "OBS_VALUE", COUNT(DISTINCT f."REF_AREA") AS n_comuni
+            FROM spatial_pairs p JOIN {fact} f ON f."REF_AREA" = p.id
+            {where} GROUP BY {group} ORDER BY {group}
+        """).format(group=group, fact=sql.Identifier(fact),
+                    where=sql.SQL("WHERE ") + sql.SQL(" AND ").join(conditions) if conditions else sql.SQL("")))
+        columns = [desc[0] for desc in cursor.description]
+        rows = cursor.fetchall()
+    conn.commit()
+    return pd.DataFrame(rows, columns=columns)
+
+def ensure_neighbour_table(cursor: psycopg2.extensions.cursor) -> None:
+    cursor.execute(sql.SQL("""
+        CREATE TABLE IF NOT EXISTS {table} (
+            origin VARCHAR(50) NOT NULL,
+            neighbour VARCHAR(50) NOT NULL,
+            distance_km DOUBLE PRECISION NOT NULL,
+            rank INTEGER NOT NULL,
+            PRIMARY KEY (origin, neighbour)
+        )
+    """).format(table=sql.Identifier(NEIGHBOUR_TABLE)))
+    cursor.execute(sql.SQL("CREATE INDEX IF NOT EXISTS {} ON {} (origin, distance_km) INCLUDE (neighbour)").format(
+        sql.Identifier(f"{NEIGHBOUR_TABLE}_distance"), sql.Identifier(NEIGHBOUR_TABLE)))
+
+def build_neighbours(radius_km: float = DEFAULT_RADIUS_KM, k: int = DEFAULT_K,
+                     conn: psycopg2.extensions.connection = None) -> int:
+    """Replace the neighbour table, readers see the old pairs until the commit, returns the pairs saved"""
+    start = time.time()
+    own_conn = conn is None
+    conn = conn or get_db_connection()
+    try:
+        index = load_index(conn)
+        pairs = neighbour_pairs(index, radius_km, k)
+        with conn.cursor() as cursor:
+            ensure_neighbour_table(cursor)
+            cursor.execute(sql.SQL("DELETE FROM {}").format(sql.Identifier(NEIGHBOUR_TABLE)))
+            copy_frame(cursor, pairs, NEIGHBOUR_TABLE)
+            cursor.execute(sql.SQL("ANALYZE {}").format(sql.Identifier(NEIGHBOUR_TABLE)))
+        conn.commit()
+    finally:
+        if own_conn:
+            conn.close()
+    print(f"Saved {len(pairs)} neighbours of {len(index)} communes (within {radius_km} km, at least {k} each) "
+          f"into {NEIGHBOUR_TABLE} in {time.time() - start:.1f}s" + (" without BallTree" if BallTree is None else ""))
+    return len(pairs)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the neighbour table of the geocoded communes, or query it")
+    parser.add_argument('--radius', type=float, default=DEFAULT_RADIUS_KM, help="km around every commune")
+    parser.add_argument('-k', type=int, default=DEFAULT_K, help="nearest communes kept also beyond the radius")
+    parser.add_argument('--near', metavar='CODE', help="print the communes within the radius of a commune instead")
+    args = parser.parse_args()
+
+    if args.near:
+        conn = get_db_connection()
+        try:
+            print(load_index(conn).within([args.near], args.radius).to_string(index=False))
+        finally:
+            conn.close()
+    else:
+        build_neighbours(args.radius, args.k)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules of src/ are flat scripts importing each other by name
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
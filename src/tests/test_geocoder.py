@@ -0,0 +1,174 @@
+import json
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+import pytest
+import requests
+from geocoder import GeocoderBackend, GeocodingEngine, NominatimBackend, TokenBucket
+from geocoding_cache import GeocodingCache
+
+# Geocoder against a stub Nominatim: an http.server in a thread answering from a script of (status, headers, body,
+# delay) responses, and the coordinates of the place otherwise
+
+
+class StubNominatim(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        query = parse_qs(urlsplit(self.path).query).get('q', [''])[0]
+        with server.lock:
+            server.requests.append((time.monotonic(), query))
+            status, headers, body, delay = server.script.pop(0) if server.script else (200, {}, None, 0)
+        time.sleep(delay)
+        if body is None:
+            body = [{'lat': str(len(query.split(',')[0])), 'lon': '9.0'}] if query in server.places else []
+        data = json.dumps(body).encode()
+        try:
+            self.send_response(status)
+            for header, value in headers.items():
+                self.send_header(header, value)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            pass    # The client timed out
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def stub():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubNominatim)
+    server.lock, server.requests, server.script = threading.Lock(), [], []
+    server.places = {'Genova, Genova, Italy', 'Chiavari, Genova, Italy'}
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def backend(stub, **kwargs) -> NominatimBackend:
+    options = {'rate': 1000, 'burst': 10, 'backoff': 0.01, 'timeout': 2} | kwargs
+    return NominatimBackend(stub.url, **options)
+
+
+def test_retries_5xx_with_backoff(stub):
+    stub.script = [(503, {}, {}, 0), (500, {}, {}, 0), (429, {}, {}, 0)]
+    assert backend(stub).geocode('Genova', 'Genova', 'Italy') == (6.0, 9.0)
+    assert len(stub.requests) == 4
+    gaps = [b[0] - a[0] for a, b in zip(stub.requests, stub.requests[1:])]
+    assert gaps[2] >= 0.04     # backoff * 2 ** attempt, growing exponentially
+
+def test_gives_up_after_max_retries(stub):
+    stub.script = [(502, {}, {}, 0)] * 3
+    with pytest.raises(requests.HTTPError):
+        backend(stub, max_retries=2).geocode('Genova', 'Genova', 'Italy')
+    assert len(stub.requests) == 3
+
+def test_client_errors_are_not_retried(stub):
+    stub.script = [(404, {}, {}, 0)]
+    with pytest.raises(requests.HTTPError):
+        backend(stub).geocode('Genova', 'Genova', 'Italy')
+    assert len(stub.requests) == 1
+
+def test_retry_after_is_respected(stub):
+    stub.script = [(429, {'Retry-After': '1'}, {}, 0)]
+    assert backend(stub).geocode('Genova', 'Genova', 'Italy') == (6.0, 9.0)
+    assert stub.requests[1][0] - stub.requests[0][0] >= 1.0
+
+def test_timeouts_are_retried(stub):
+    stub.script = [(200, {}, None, 1.0)]
+    assert backend(stub, timeout=0.2).geocode('Genova', 'Genova', 'Italy') == (6.0, 9.0)
+    assert len(stub.requests) == 2
+
+def test_connection_errors_are_retried():
+    with socket.socket() as probe:      # A port nobody listens on
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    geocoder = NominatimBackend(f"http://127.0.0.1:{port}", rate=1000, max_retries=2, backoff=0.01)
+    start = time.monotonic()
+    with pytest.raises(requests.ConnectionError):
+        geocoder.geocode('Genova', 'Genova', 'Italy')
+    assert time.monotonic() - start >= 0.03    # Two backoffs of 0.01 and 0.02 before giving up
+
+def test_token_bucket_rate():
+    bucket = TokenBucket(rate=20, capacity=1)
+    start = time.monotonic()
+    for _ in range(6):
+        bucket.acquire()
+    assert time.monotonic() - start >= 5 / 20 * 0.95
+
+def test_token_bucket_burst():
+    bucket = TokenBucket(rate=1, capacity=5)
+    start = time.monotonic()
+    for _ in range(5):
+        bucket.acquire()
+    assert time.monotonic() - start < 0.5
+
+def test_rate_limit_spaces_requests(stub):
+    geocoder = backend(stub, rate=10, burst=1)
+    for _ in range(4):
+        geocoder.geocode('Genova', 'Genova', 'Italy')
+    assert stub.requests[-1][0] - stub.requests[0][0] >= 3 / 10 * 0.95
+
+def test_engine_dedup_and_cache_write_through(stub, tmp_path):
+    queries = [('Genova', 'Genova', 'Italy'), (' genova', 'GENOVA', 'italy'), ('Chiavari', 'Genova', 'Italy'),
+               ('Nowhere', 'Genova', 'Italy'), ('Genova', 'Genova', 'Italy')]
+    with GeocodingCache(str(tmp_path / 'cache.sqlite')) as cache:
+        results = GeocodingEngine(backend(stub), cache).geocode_many(queries)
+        assert len(stub.requests) == 3      # One request per normalized name
+        assert results[queries[1]] == results[queries[0]] == (6.0, 9.0)
+        assert results[queries[3]] == (None, None)
+        assert cache.get('Chiavari', 'Genova', 'Italy') == (8.0, 9.0)
+        assert cache.get('Nowhere', 'Genova', 'Italy') == (None, None)     # Negative results are cached too
+
+        again = GeocodingEngine(backend(stub), cache).geocode_many(queries)
+        assert again == results
+        assert len(stub.requests) == 3      # Everything from the cache
+
+def test_engine_does_not_cache_errors(stub, tmp_path):
+    stub.script = [(500, {}, {}, 0)] * 3
+    with GeocodingCache(str(tmp_path / 'cache.sqlite')) as cache:
+        results = GeocodingEngine(backend(stub, max_retries=2), cache).geocode_many([('Genova', 'Genova', 'Italy')])
+        assert results[('Genova', 'Genova', 'Italy')] == (None, None)
+        assert cache.get('Genova', 'Genova', 'Italy') is None     # Retried at the next run
+
+def test_engine_keys_on_istat_code(stub, tmp_path):
+    homonyms = [('Genova', 'Genova', 'Italy', '010025'), ('Genova', 'Genova', 'Italy', '010099')]
+    with GeocodingCache(str(tmp_path / 'cache.sqlite')) as cache:
+        GeocodingEngine(backend(stub), cache).geocode_many(homonyms + [('Genova', 'Genova', 'Italy', '010025')])
+        assert len(stub.requests) == 2      # Same names, different codes
+        assert cache.get('Genova', 'Genova', 'Italy', '010099') == (6.0, 9.0)
+        assert cache.get('Genova', 'Genova', 'Italy') is None       # Cached under the codes only
+
+
+class CodeBackend(GeocoderBackend):
+    """Resolves its codes in bulk and the names one at a time"""
+    name = 'codes'
+    threaded = False
+
+    def __init__(self):
+        super().__init__()
+        self.by_name = []
+
+    def geocode_codes(self, codes):
+        return {code: (44.0, float(code[-1])) for code in codes if code.startswith('010')}
+
+    def geocode(self, comune, provincia, nazione, codice=None):
+        self.by_name.append(comune)
+        return 45.0, 8.0
+
+def test_engine_resolves_codes_in_bulk_first(tmp_path):
+    queries = [('Genova', 'Genova', 'Italy', '010025'), ('Genova', 'Genova', 'Italy', '010026'),
+               ('Torino', 'Torino', 'Italy', '001272'), ('Roma', 'Roma', 'Italy')]
+    geocoder = CodeBackend()
+    with GeocodingCache(str(tmp_path / 'cache.sqlite')) as cache:
+        results = GeocodingEngine(geocoder, cache).geocode_many(queries)
+        assert results[queries[0]] == (44.0, 5.0) and results[queries[1]] == (44.0, 6.0)
+        assert sorted(geocoder.by_name) == ['Roma', 'Torino']     # Unknown code and no code: by name
+        assert cache.get('Genova', 'Genova', 'Italy', '010026') == (44.0, 6.0)
+        assert cache.get('Torino', 'Torino', 'Italy', '001272') == (45.0, 8.0)
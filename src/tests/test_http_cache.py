@@ -0,0 +1,51 @@
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+from http_cache import HttpCache, cache_key
+
+# HTTP cache against a stub server answering /<name>/<size> with size random bytes
+
+
+class StubServer(BaseHTTPRequestHandler):
+    def do_GET(self):
+        size = int(self.path.rsplit('/', 1)[1])
+        body = os.urandom(size)     # Random, so the compressed blob is as large as the body
+        self.send_response(200)
+        self.send_header('Content-Length', str(size))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubServer)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_response_larger_than_the_cap_is_readable(server, tmp_path):
+    with HttpCache(str(tmp_path), max_mb=0.1) as cache:
+        assert len(cache.get_bytes(f"{server}/a/300000")) == 300000
+
+def test_open_body_is_not_evicted(server, tmp_path):
+    with HttpCache(str(tmp_path), max_mb=0.1) as cache:
+        first = cache.open(f"{server}/a/60000")
+        cache.get_bytes(f"{server}/b/60000")   # Over the cap, the least recently used body is the open one
+        assert len(first.read()) == 60000
+        first.close()
+        assert cache.pins == {}
+        cache.get_bytes(f"{server}/c/60000")
+        assert cache.size() <= 0.1 * 1024 * 1024 + 70000  # Closed, it can go now
+
+def test_least_recently_used_is_evicted(server, tmp_path):
+    with HttpCache(str(tmp_path), max_mb=0.1) as cache:
+        for name in 'abc':
+            cache.get_bytes(f"{server}/{name}/40000")
+        assert cache.size() <= 0.1 * 1024 * 1024
+        assert cache._lookup(cache_key(f"{server}/a/40000", None)) is None